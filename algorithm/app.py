@@ -4,19 +4,38 @@
 如果 LLM API 不可用，自动降级到 dummy 模式
 海报与上传图片持久化到磁盘，重启不丢失
 """
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
+import fcntl
 import hashlib
 import os
 import json
-import re
+import queue
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
 from dotenv import load_dotenv
 
-from llm_service import LLMService
+from llm_service import LLMService, MAX_VARIANTS
+from design_cache import normalize_prompt
 from template_service import TemplateService
 from poster_renderer import PosterRenderer
-from image_service import ImageService
+from image_service import ImageService, ImageRejected
+from path_utils import safe_id
+from json_patch import (JsonPatchError, JsonPatchTestFailed, apply_element_deltas,
+                        apply_patch, patched_element_ids)
+from job_service import JobManager, JobQueueFull, TERMINAL_STATES
+from render_cache import RenderCache, canonical_hash
+from render_executor import RenderExecutor
+from thumbnail_service import ThumbnailService
+from rendition_service import RenditionStore
+from encoder import IMAGE_FORMATS, resolve_encoder
+from upload_store import UploadStore, upload_path
+from poster_store import PosterStore
+from lifecycle_service import StorageLifecycle
 
 load_dotenv()
 
@@ -28,6 +47,12 @@ llm_service = LLMService()
 template_service = TemplateService()
 poster_renderer = PosterRenderer()
 image_service = ImageService()
+# 请求体上限（上传图片上限 + multipart 开销）：超出时解析表单阶段即拒绝，不会读完整个请求
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv(
+    'MAX_REQUEST_BYTES', str(image_service.max_file_size + 1024 * 1024)))
+# 渲染放到预热好的进程池执行，请求线程只等结果
+render_executor = RenderExecutor(poster_renderer)
+render_executor.start()
 
 # 持久化目录（与 docker-compose volumes 对应）
 POSTERS_DIR = os.environ.get('POSTERS_DIR', '/tmp/posters')
@@ -35,16 +60,92 @@ UPLOADS_DIR = os.environ.get('UPLOADS_DIR', '/tmp/uploads')
 os.makedirs(POSTERS_DIR, exist_ok=True)
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
-# 仅允许字母数字与下划线，防止路径穿越
-def _safe_id(raw_id: str) -> str:
-    if not raw_id or not re.match(r'^[a-zA-Z0-9_\-]+$', raw_id):
-        return ''
-    return raw_id
+# 海报按 id 哈希前缀分片存储，元数据索引放在 POSTERS_DIR 下
+poster_store = PosterStore(POSTERS_DIR)
+
+# 上传图片按内容寻址存储（重复上传只查表），索引放在 UPLOADS_DIR 下
+upload_store = UploadStore(UPLOADS_DIR)
+
+# 导出渲染缓存（放在 POSTERS_DIR 旁边；属于可再生数据，不放进海报持久化目录）
+RENDER_CACHE_DIR = os.environ.get(
+    'RENDER_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(POSTERS_DIR)), 'render_cache')
+)
+render_cache = RenderCache(RENDER_CACHE_DIR)
+
+# 异步生成任务（状态文件供多个 gunicorn worker 共享查询）
+JOBS_DIR = os.environ.get(
+    'JOBS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(POSTERS_DIR)), 'jobs')
+)
+job_manager = JobManager(JOBS_DIR)
+
+# 海报图片的尺寸 / 格式版本（按需生成后落盘）
+RENDITIONS_DIR = os.environ.get(
+    'RENDITIONS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(POSTERS_DIR)), 'renditions')
+)
+rendition_store = RenditionStore(poster_store, RENDITIONS_DIR)
+
+# 模板缩略图（启动及模板热加载后在后台预渲染）
+THUMBNAILS_DIR = os.environ.get(
+    'THUMBNAILS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(POSTERS_DIR)), 'thumbnails')
+)
+THUMBNAIL_MAX_AGE = int(os.getenv('THUMBNAIL_MAX_AGE', '604800'))
+thumbnail_service = ThumbnailService(template_service, render_executor, THUMBNAILS_DIR)
+thumbnail_service.start()
+
+# 海报读-改-写的跨进程锁文件目录
+LOCKS_DIR = os.environ.get(
+    'LOCKS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(POSTERS_DIR)), 'locks')
+)
+os.makedirs(LOCKS_DIR, exist_ok=True)
+
+# 存储生命周期：派生文件配额 / LRU / TTL 淘汰与草稿图片清理（后台执行，同一时间只有一个 worker）
+storage_lifecycle = StorageLifecycle(
+    poster_store, upload_store,
+    {'render_cache': RENDER_CACHE_DIR, 'renditions': RENDITIONS_DIR},
+    LOCKS_DIR
+)
+storage_lifecycle.start()
+
+# 仅允许字母数字与下划线，防止路径穿越（渲染子进程解析图片 id 时共用同一校验）
+_safe_id = safe_id
+
+
+@contextmanager
+def _poster_lock(pid: str):
+    """单张海报的写锁（flock，gunicorn 多个 worker 之间互斥）"""
+    with open(os.path.join(LOCKS_DIR, f"{pid}.lock"), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _poster_etag(poster_data: dict) -> str:
+    """海报版本号：poster_data 规范化哈希，作为 ETag"""
+    return canonical_hash(poster_data)[:32]
+
+
+class _PosterChanged(Exception):
+    """导出期间海报被并发修改：读取到的文档（args[0]）与先前读到的内容哈希不一致"""
+
+
+def _version_conflict(current_etag: str, expected_version=None) -> bool:
+    """If-Match 头或 body 中的 version 与当前版本不一致时返回 True（都没给则不校验）"""
+    if request.if_match and not request.if_match.contains(current_etag):
+        return True
+    return expected_version is not None and expected_version != current_etag
 
 
 def get_dummy_response(prompt: str) -> dict:
     """生成 dummy 响应"""
     return {
+        'status': 'dummy',
         'poster_url': f'https://via.placeholder.com/800x1200/4A90E2/FFFFFF?text={prompt.replace(" ", "+")}',
         'poster_data': {
             'prompt': prompt,
@@ -73,7 +174,7 @@ def get_dummy_response(prompt: str) -> dict:
 
 @app.route('/health', methods=['GET'])
 def health():
-    """健康检查端点 - 检查 LLM API 可用性"""
+    """健康检查端点 - 返回缓存的 LLM API 可用性（由后台探测维护，不阻塞）"""
     try:
         llm_available = llm_service.is_available()
         
@@ -82,12 +183,31 @@ def health():
             'llm_api': {
                 'available': llm_available,
                 'provider': llm_service.provider if llm_service.enabled else None,
-                'enabled': llm_service.enabled
+                'enabled': llm_service.enabled,
+                'state': llm_service.availability.snapshot(),
+                'transports': llm_service.transport_stats(),
+                'router': llm_service.router_stats()
             },
             'services': {
                 'template': True,
                 'renderer': True,
                 'image': True
+            },
+            'jobs': job_manager.stats(),
+            'render_pool': render_executor.stats(),
+            'templates': template_service.store.stats(),
+            'thumbnails': thumbnail_service.stats(),
+            'renditions': rendition_store.stats(),
+            'uploads': image_service.stats(),
+            'upload_store': upload_store.stats(),
+            'posters': poster_store.stats(),
+            'storage': storage_lifecycle.stats(),
+            'caches': {
+                'render': render_cache.stats(),
+                'design': llm_service.design_cache.stats(),
+                'fonts': poster_renderer.fonts.stats(),
+                'backgrounds': poster_renderer.backgrounds.stats(),
+                'images': poster_renderer.images.stats()
             }
         }), 200
     except Exception as e:
@@ -97,85 +217,425 @@ def health():
         }), 500
 
 
+def _noop_progress(state: str, **info):
+    pass
+
+
+# 流式设计中提前上报的字段（异步任务的 progress 里可见）
+EARLY_DESIGN_FIELDS = ('template_id', 'color_scheme', 'title')
+
+
+def _design_listener(progress):
+    """
+    LLM 流式输出的字段回调：早到的字段先上报进度；
+    template_id 与 color_scheme 都到齐后立即预热该模板的背景层，不等文案写完
+    """
+    partial = {}
+    
+    def on_field(field, value):
+        if field not in EARLY_DESIGN_FIELDS:
+            return
+        partial[field] = value
+        try:
+            progress('designing', **{field: value})
+            if field in ('template_id', 'color_scheme') and 'template_id' in partial \
+                    and isinstance(partial.get('color_scheme'), dict):
+                compiled = template_service.get_compiled(str(partial['template_id'])) \
+                    or template_service.get_compiled('template_001')
+                preview = compiled.apply_design({'color_scheme': partial['color_scheme']})
+                size = preview['size']
+                render_executor.prewarm((size['width'], size['height']), preview['background'])
+        except Exception as e:
+            # 预热只是优化，失败不影响生成
+            print(f"Design prewarm failed: {e}")
+    
+    return on_field
+
+
+# LLM 返回的占位标题（兜底为用户输入）
+_PLACEHOLDER_TITLES = ('', '标题内容', '标题', '海报主标题', '主标题', '根据用户需求写的标题', '与上面 title 一致的具体标题文案')
+
+
+def _fix_placeholder_design(design: dict, prompt: str) -> dict:
+    """兜底：若 LLM 返回占位文案或空标题，用用户输入作为标题，保证每次输入不同则海报不同"""
+    raw_title = (design.get('title') or '').strip()
+    if not raw_title or raw_title in _PLACEHOLDER_TITLES:
+        design['title'] = prompt[:80] if isinstance(prompt, str) else str(prompt)[:80]
+        for el in design.get('elements') or []:
+            if el.get('id') == 'title' and (not (el.get('content') or '').strip() or (el.get('content') or '').strip() in _PLACEHOLDER_TITLES):
+                el['content'] = design['title']
+        # 占位时按 prompt 轮换模板，使不同输入至少版式不同（用 md5 保证同输入同模板）
+        _tpls = ('template_001', 'template_002', 'template_003')
+        design['template_id'] = _tpls[int(hashlib.md5(prompt.encode()).hexdigest(), 16) % 3]
+    return design
+
+
+def _design_to_poster(design: dict):
+    """设计方案套用模板（模板不存在时用默认模板），返回 (模板 id, 海报数据)"""
+    template_id = design.get('template_id', 'template_001')
+    template = template_service.get_template(template_id)
+    
+    if not template:
+        # 如果模板不存在，使用默认模板
+        template = template_service.get_template('template_001')
+    
+    return template['id'], template_service.apply_design_to_template(template, design)
+
+
+def _render_and_store(poster_data: dict) -> dict:
+    """渲染海报并持久化到磁盘（重启不丢失），返回 poster_id / poster_url"""
+    poster_image = render_executor.render(poster_data, format='PNG')
+    
+    poster_id = uuid.uuid4().hex
+    poster_store.save(poster_id, poster_data, poster_image.read())
+    
+    return {
+        'poster_id': poster_id,
+        'poster_url': f"/api/poster/{poster_id}/image",
+    }
+
+
+def run_generation(prompt: str, progress=_noop_progress, llm_slots=None, llm_prompt=None) -> dict:
+    """
+    生成流水线：LLM 设计 → 套模板 → 渲染 → 持久化
+    同步接口、异步任务与批量生成共用；progress(state, **info) 上报 designing / rendering 阶段
+    llm_slots 为信号量时 LLM 调用期间占用一个名额（批量生成限制并发调用数）
+    llm_prompt 为发给 LLM 的需求（同时决定设计缓存键），默认即 prompt；兜底标题与模板轮换始终按 prompt
+    LLM 不可用或调用失败时降级为 dummy 响应
+    """
+    # 检查 LLM API 是否可用（缓存状态）
+    if not llm_service.is_available():
+        # 降级到 dummy 模式
+        return get_dummy_response(prompt)
+    
+    try:
+        # 1. 调用 LLM 生成设计方案（相同需求命中缓存或合并进行中的调用）
+        progress('designing')
+        with (llm_slots or nullcontext()):
+            design, design_cache = llm_service.generate_poster_design(
+                llm_prompt or prompt, return_cache_status=True, on_field=_design_listener(progress)
+            )
+        design = _fix_placeholder_design(design, prompt)
+        
+        # 2. 获取模板并应用设计
+        template_id, poster_data = _design_to_poster(design)
+        
+        # 3. 渲染并持久化
+        progress('rendering', template_id=template_id, design_cache=design_cache)
+        stored = _render_and_store(poster_data)
+        
+        return {
+            **stored,
+            'poster_data': poster_data,
+            'design_cache': design_cache,
+            'status': 'success'
+        }
+        
+    except Exception as e:
+        # LLM 调用失败，降级到 dummy
+        print(f"LLM API call failed: {e}, falling back to dummy mode")
+        return get_dummy_response(prompt)
+
+
+def run_variant_generation(prompt: str, variants: int, progress=_noop_progress,
+                           llm_slots=None, on_variant=None, llm_prompt=None) -> dict:
+    """
+    多方案生成：一次 LLM 调用拿到 variants 个设计方案，各自套模板后并发渲染
+    返回第一个成功方案的字段（与单方案响应兼容）加上 variants 列表；
+    单个方案渲染失败只标记该条（status 为 error），已保存的方案照常返回，全部失败时才降级为 dummy。
+    on_variant(序号, 结果) 在每个方案渲染完成或失败时回调（批量接口据此逐条输出）；llm_prompt 同 run_generation
+    """
+    if not llm_service.is_available():
+        return get_dummy_response(prompt)
+    
+    try:
+        progress('designing', variants=variants)
+        with (llm_slots or nullcontext()):
+            designs, design_cache = llm_service.generate_poster_design(
+                llm_prompt or prompt, return_cache_status=True, variants=variants
+            )
+        posters = [_design_to_poster(_fix_placeholder_design(design, prompt)) for design in designs]
+    except Exception as e:
+        print(f"LLM API call failed: {e}, falling back to dummy mode")
+        return get_dummy_response(prompt)
+    
+    progress('rendering', template_id=[template_id for template_id, _ in posters], design_cache=design_cache)
+    
+    # 渲染在进程池中执行，这里每个方案一个线程等待结果
+    results = [None] * len(posters)
+    with ThreadPoolExecutor(max_workers=len(posters), thread_name_prefix='variant') as executor:
+        futures = {executor.submit(_render_and_store, poster_data): i
+                   for i, (_, poster_data) in enumerate(posters)}
+        for future in as_completed(futures):
+            i = futures[future]
+            template_id, poster_data = posters[i]
+            try:
+                results[i] = {**future.result(), 'template_id': template_id,
+                              'poster_data': poster_data, 'status': 'success'}
+            except Exception as e:
+                print(f"Variant {i} render failed: {e}")
+                results[i] = {'template_id': template_id, 'status': 'error', 'error': str(e)}
+            if on_variant is not None:
+                on_variant(i, results[i])
+    
+    succeeded = [result for result in results if result['status'] == 'success']
+    if not succeeded:
+        # 没有任何方案被保存，降级为 dummy
+        return get_dummy_response(prompt)
+    return {
+        **succeeded[0],
+        'variants': results,
+        'failed': len(results) - len(succeeded),
+        'design_cache': design_cache,
+        'status': 'success'
+    }
+
+
+# 批量生成：单批条数上限、每批流水线线程数、本进程同时进行的 LLM 调用数
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '50'))
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '8'))
+_batch_llm_slots = threading.BoundedSemaphore(int(os.getenv('BATCH_LLM_CONCURRENCY', '4')))
+
+
+def _batch_tasks(data: dict):
+    """
+    解析批量请求：{"prompts": [...]} 或 {"prompt": "...", "variants": N}
+
+    Returns:
+        (输出条数, 任务列表)；任务为 (prompt, 方案数, 对应的输出下标列表, 发给 LLM 的需求)。
+        多条需求时规范化后相同的合并为一个任务；一个需求多方案时每 MAX_VARIANTS 个方案一次 LLM 调用
+
+    Raises:
+        ValueError: 参数不合法
+    """
+    if 'prompts' in data:
+        prompts = data['prompts']
+        if not isinstance(prompts, list) or not prompts \
+                or not all(isinstance(p, str) and p.strip() for p in prompts):
+            raise ValueError('prompts must be a non-empty list of non-empty strings')
+        if len(prompts) > BATCH_MAX_ITEMS:
+            raise ValueError(f'At most {BATCH_MAX_ITEMS} posters per batch')
+        groups = {}
+        for index, prompt in enumerate(prompts):
+            groups.setdefault(normalize_prompt(prompt), []).append(index)
+        return len(prompts), [(prompts[indexes[0]], 1, indexes, prompts[indexes[0]]) for indexes in groups.values()]
+    
+    prompt = data.get('prompt')
+    variants = data.get('variants', 1)
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise ValueError('Prompt is required')
+    if isinstance(variants, bool) or not isinstance(variants, int) or variants < 1:
+        raise ValueError('variants must be a positive integer')
+    if variants > BATCH_MAX_ITEMS:
+        raise ValueError(f'At most {BATCH_MAX_ITEMS} posters per batch')
+    tasks = []
+    for group, start in enumerate(range(0, variants, MAX_VARIANTS)):
+        count = min(MAX_VARIANTS, variants - start)
+        # 超过单次上限时分组调用；组号只写进发给 LLM 的需求（也就进了设计缓存键），避免各组被合并成同一批方案，
+        # 兜底标题与模板轮换仍按原需求
+        llm_prompt = prompt if group == 0 else f"{prompt}\n（第 {group + 1} 组备选方案）"
+        tasks.append((prompt, count, list(range(start, start + count)), llm_prompt))
+    return variants, tasks
+
+
+def _variants_param(data: dict) -> int:
+    """
+    /generate 的 variants 参数（默认 1）
+
+    Raises:
+        ValueError: 参数不合法
+    """
+    variants = data.get('variants', 1)
+    if isinstance(variants, bool) or not isinstance(variants, int) or not 1 <= variants <= MAX_VARIANTS:
+        raise ValueError(f'variants must be an integer between 1 and {MAX_VARIANTS}')
+    return variants
+
+
 @app.route('/generate', methods=['POST'])
 def generate_poster():
-    """生成海报"""
+    """
+    生成海报；?async=1 时提交后台任务，立即返回 job_id
+    body 中 variants 大于 1 时一次 LLM 调用生成多个方案并发渲染，结果在 variants 列表中
+    """
     try:
         data = request.get_json()
         prompt = data.get('prompt', '')
         
         if not prompt:
             return jsonify({'error': 'Prompt is required'}), 400
+        try:
+            variants = _variants_param(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # 检查 LLM API 是否可用
-        if not llm_service.is_available():
-            # 降级到 dummy 模式
-            return jsonify(get_dummy_response(prompt)), 200
+        def handler(payload, progress=_noop_progress):
+            if payload['variants'] > 1:
+                return run_variant_generation(payload['prompt'], payload['variants'], progress)
+            return run_generation(payload['prompt'], progress)
         
-        try:
-            # 1. 调用 LLM 生成设计方案
-            design = llm_service.generate_poster_design(prompt)
-            
-            # 兜底：若 LLM 返回占位文案或空标题，用用户输入作为标题，保证每次输入不同则海报不同
-            _placeholder_titles = ('', '标题内容', '标题', '海报主标题', '主标题', '根据用户需求写的标题', '与上面 title 一致的具体标题文案')
-            raw_title = (design.get('title') or '').strip()
-            if not raw_title or raw_title in _placeholder_titles:
-                design['title'] = prompt[:80] if isinstance(prompt, str) else str(prompt)[:80]
-                for el in design.get('elements') or []:
-                    if el.get('id') == 'title' and (not (el.get('content') or '').strip() or (el.get('content') or '').strip() in _placeholder_titles):
-                        el['content'] = design['title']
-                # 占位时按 prompt 轮换模板，使不同输入至少版式不同（用 md5 保证同输入同模板）
-                _tpls = ('template_001', 'template_002', 'template_003')
-                design['template_id'] = _tpls[int(hashlib.md5(prompt.encode()).hexdigest(), 16) % 3]
-            
-            # 2. 获取模板
-            template_id = design.get('template_id', 'template_001')
-            template = template_service.get_template(template_id)
-            
-            if not template:
-                # 如果模板不存在，使用默认模板
-                template = template_service.get_template('template_001')
-            
-            # 3. 应用设计到模板
-            poster_data = template_service.apply_design_to_template(template, design)
-            
-            # 4. 渲染海报
-            poster_image = poster_renderer.render(poster_data, format='PNG')
-            
-            # 5. 持久化到磁盘（重启不丢失）
-            poster_id = uuid.uuid4().hex
-            poster_png_path = os.path.join(POSTERS_DIR, f"{poster_id}.png")
-            poster_json_path = os.path.join(POSTERS_DIR, f"{poster_id}.json")
-            with open(poster_png_path, 'wb') as f:
-                f.write(poster_image.read())
-            with open(poster_json_path, 'w', encoding='utf-8') as f:
-                json.dump(poster_data, f, ensure_ascii=False, indent=2)
-            
-            poster_url = f"/api/poster/{poster_id}/image"
-            
+        if request.args.get('async') in ('1', 'true'):
+            try:
+                job = job_manager.submit('generate', {'prompt': prompt, 'variants': variants}, handler)
+            except JobQueueFull:
+                return jsonify({'error': 'Generation queue is full, retry later'}), 503, {'Retry-After': '5'}
             return jsonify({
-                'poster_id': poster_id,
-                'poster_url': poster_url,
-                'poster_data': poster_data,
-                'status': 'success'
-            }), 200
+                'job_id': job['job_id'],
+                'state': job['state'],
+                'status_url': f"/jobs/{job['job_id']}",
+                'events_url': f"/jobs/{job['job_id']}/events"
+            }), 202
+        
+        return jsonify(handler({'prompt': prompt, 'variants': variants})), 200
             
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    """
+    批量生成海报，body: {"prompts": [...]} 或 {"prompt": "...", "variants": N}
+    规范化后相同的需求只生成一次；同一需求的多个方案由一次 LLM 调用给出。
+    LLM 调用限并发，渲染在进程池中并行。
+    响应为 NDJSON：每完成一条输出一行 {"index", "prompt", ...生成结果}，最后一行为汇总
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            count, tasks = _batch_tasks(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    def run_task(task, results):
+        """执行一个任务，每得到一条结果就放入队列：(输出下标列表, 结果)"""
+        prompt, variants, indexes, llm_prompt = task
+        emitted = set()
+        try:
+            _run_task(prompt, variants, indexes, llm_prompt, results, emitted)
         except Exception as e:
-            # LLM 调用失败，降级到 dummy
-            print(f"LLM API call failed: {e}, falling back to dummy mode")
-            return jsonify(get_dummy_response(prompt)), 200
-            
+            missing = [index for i, index in enumerate(indexes) if i not in emitted]
+            if missing:
+                results.put((missing, {'status': 'error', 'error': str(e)}))
+    
+    def _run_task(prompt, variants, indexes, llm_prompt, results, emitted):
+        if variants == 1:
+            results.put((indexes, run_generation(prompt, llm_slots=_batch_llm_slots, llm_prompt=llm_prompt)))
+            emitted.update(range(len(indexes)))
+            return
+        
+        def on_variant(i, result):
+            emitted.add(i)
+            results.put(([indexes[i]], result))
+        
+        outcome = run_variant_generation(prompt, variants, llm_slots=_batch_llm_slots, on_variant=on_variant,
+                                         llm_prompt=llm_prompt)
+        missing = [index for i, index in enumerate(indexes) if i not in emitted]
+        if missing:
+            emitted.update(range(len(indexes)))
+            if outcome.get('status') != 'success':
+                # 降级为 dummy：尚未输出的条目都返回 dummy
+                results.put((missing, outcome))
+            else:
+                results.put((missing, {'status': 'error', 'error': 'LLM returned fewer variants than requested'}))
+    
+    def stream():
+        started = time.time()
+        results = queue.Queue()
+        executor = ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(tasks))),
+                                      thread_name_prefix='batch')
+        futures = [executor.submit(run_task, task, results) for task in tasks]
+        failed = 0
+        try:
+            finished = 0
+            while finished < count:
+                indexes, result = results.get()
+                if result.get('status') != 'success':
+                    failed += len(indexes)
+                for index in indexes:
+                    finished += 1
+                    prompt = data['prompts'][index] if 'prompts' in data else data['prompt']
+                    line = {'index': index, 'prompt': prompt, **result}
+                    yield json.dumps(line, ensure_ascii=False) + '\n'
+            yield json.dumps({
+                'done': True,
+                'count': count,
+                'unique': len(tasks),
+                'failed': failed,
+                'elapsed_ms': round((time.time() - started) * 1000, 1)
+            }) + '\n'
+        finally:
+            # 客户端断开时取消尚未开始的任务
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+    
+    return Response(
+        stream_with_context(stream()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查询生成任务状态"""
+    try:
+        jid = _safe_id(job_id)
+        if not jid:
+            return jsonify({'error': 'Invalid job id'}), 400
+        job = job_manager.get(jid)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """生成任务状态 SSE 流：每次状态变化推送一条 event: state，结束态后关闭"""
+    jid = _safe_id(job_id)
+    if not jid:
+        return jsonify({'error': 'Invalid job id'}), 400
+    job = job_manager.get(jid)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    stream_timeout = float(os.environ.get('JOB_EVENTS_TIMEOUT', '120'))
+    
+    def stream(job):
+        deadline = time.time() + stream_timeout
+        version = -1
+        while job is not None:
+            if job['version'] != version:
+                version = job['version']
+                yield f"event: state\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+            if job['state'] in TERMINAL_STATES or time.time() >= deadline:
+                return
+            job = job_manager.wait_for_change(jid, version, timeout=min(15.0, max(0.0, deadline - time.time())))
+            if job is not None and job['version'] == version:
+                # 保活注释，避免代理断开空闲连接
+                yield ": keep-alive\n\n"
+    
+    return Response(
+        stream_with_context(stream(job)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/templates', methods=['GET'])
 def list_templates():
     """获取模板列表"""
     try:
         category = request.args.get('category')
-        templates = template_service.list_templates(category=category)
-        return jsonify({'templates': templates}), 200
+        # 列表在模板加载 / 热加载时已预先计算并序列化
+        _, etag, body = template_service.list_templates_cached(category=category)
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -192,6 +652,24 @@ def get_template(template_id):
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/templates/<template_id>/thumbnail', methods=['GET'])
+def get_template_thumbnail(template_id):
+    """获取模板缩略图：w 向上取整到预渲染宽度，format 为 webp（默认）或 png"""
+    try:
+        width = request.args.get('w', type=int)
+        fmt = (request.args.get('format') or 'webp').lower()
+        result = thumbnail_service.get(template_id, width, fmt)
+        if result is None:
+            return jsonify({'error': 'Template not found'}), 404
+        path, mimetype, etag = result
+        response = send_file(path, mimetype=mimetype, etag=etag, max_age=THUMBNAIL_MAX_AGE,
+                             conditional=True)
+        response.cache_control.public = True
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/upload/image', methods=['POST'])
 def upload_image():
     """上传图片"""
@@ -207,33 +685,61 @@ def upload_image():
         if not image_service.allowed_file(file.filename):
             return jsonify({'error': 'Invalid file type'}), 400
         
-        # 读取文件数据
-        file_data = file.read()
-        
-        # 检查文件大小
-        if len(file_data) > image_service.max_file_size:
-            return jsonify({'error': 'File too large'}), 400
-        
-        # 处理图片
-        processed_image = image_service.process_image(
-            file_data,
-            file.filename
-        )
+        # 流式读取（超过大小上限立即停止，同时计算原始内容哈希）
+        try:
+            source, size, raw_sha256 = image_service.read_capped(file.stream)
+        except ImageRejected as e:
+            return jsonify({'error': str(e)}), 400
         
-        # 持久化到磁盘
-        image_id = uuid.uuid4().hex
-        image_path = os.path.join(UPLOADS_DIR, f"{image_id}.jpg")
-        with open(image_path, 'wb') as f:
-            f.write(processed_image.read())
+        # 同样的内容按同样的参数处理过：直接复用，不再解码 / 缩放 / 编码
+        params = upload_store.params_key(image_service.output_format(file.filename),
+                                         image_service.max_size, 85)
+        record = upload_store.lookup(raw_sha256, params)
+        ingest_info = None
+        if record is None:
+            # 文件头校验 → draft 解码缩放
+            try:
+                processed_image, ingest_info = image_service.process_source(source, size, file.filename)
+            except ImageRejected as e:
+                return jsonify({'error': str(e)}), 400
+            # 按内容哈希落盘（实际格式的扩展名），相同输出只存一份
+            record = upload_store.put(raw_sha256, params, processed_image, ingest_info)
         
+        image_id = record['image_id']
         image_url = f"/api/image/{image_id}"
         
         return jsonify({
             'image_id': image_id,
             'url': image_url,
-            'message': 'Image uploaded successfully'
+            'release_token': record['release_token'],
+            'message': 'Image uploaded successfully',
+            'deduplicated': ingest_info is None,
+            'similar': record.get('similar', []),
+            'ingest': ingest_info
         }), 200
         
+    except RequestEntityTooLarge:
+        return jsonify({'error': 'File too large'}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/posters', methods=['GET'])
+def list_posters():
+    """海报列表（按创建时间倒序，查元数据索引）"""
+    try:
+        limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+        offset = max(0, request.args.get('offset', 0, type=int))
+        template_id = request.args.get('template_id')
+        posters = poster_store.list(limit=limit, offset=offset, template_id=template_id)
+        for poster in posters:
+            poster['poster_url'] = f"/api/poster/{poster['id']}/image"
+        return jsonify({
+            'posters': posters,
+            'total': poster_store.count(template_id),
+            'limit': limit,
+            'offset': offset
+        }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -245,19 +751,115 @@ def get_poster(poster_id):
         pid = _safe_id(poster_id)
         if not pid:
             return jsonify({'error': 'Invalid poster id'}), 400
-        json_path = os.path.join(POSTERS_DIR, f"{pid}.json")
-        if not os.path.isfile(json_path):
+        # 条件请求先比对内容哈希（二进制文档只读 META 段），未变化时不解析元素
+        loaded = poster_store.load_unless(
+            pid, lambda content_hash: bool(request.if_none_match)
+            and request.if_none_match.contains(content_hash[:32])
+        )
+        if loaded is None:
             return jsonify({'error': 'Poster not found'}), 404
-        with open(json_path, 'r', encoding='utf-8') as f:
-            poster_data = json.load(f)
-        return jsonify({
+        poster_data, content_hash = loaded
+        etag = content_hash[:32]
+        if poster_data is None:
+            not_modified = Response(status=304)
+            not_modified.set_etag(etag)
+            return not_modified
+        response = jsonify({
             'poster_id': poster_id,
-            'poster_data': poster_data
-        }), 200
+            'poster_data': poster_data,
+            'version': etag
+        })
+        response.set_etag(etag)
+        return response, 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/poster/<poster_id>', methods=['PATCH'])
+def patch_poster(poster_id):
+    """
+    局部更新海报
+    body 为 RFC 6902 操作数组（或 {"operations": [...]}），或按元素 id 的增量 {"elements": {"title": {...}}}；
+    通过 If-Match 头或 body 中的 version 做乐观并发控制，版本不一致返回 412
+    """
+    try:
+        pid = _safe_id(poster_id)
+        if not pid:
+            return jsonify({'error': 'Invalid poster id'}), 400
+        body = request.get_json(silent=True)
+        if not isinstance(body, (list, dict)):
+            return jsonify({'error': 'Patch body is required'}), 400
+        
+        with _poster_lock(pid):
+            old_data = poster_store.load(pid)
+            if old_data is None:
+                return jsonify({'error': 'Poster not found'}), 404
+            
+            current = _poster_etag(old_data)
+            expected = body.get('version') if isinstance(body, dict) else None
+            if _version_conflict(current, expected):
+                response = jsonify({'error': 'Poster has been modified', 'version': current})
+                response.set_etag(current)
+                return response, 412
+            
+            try:
+                operations = body if isinstance(body, list) else body.get('operations')
+                if operations is not None:
+                    poster_data = apply_patch(old_data, operations)
+                    dirty_ids = patched_element_ids(old_data, poster_data, operations)
+                elif isinstance(body.get('elements'), dict):
+                    poster_data = apply_element_deltas(old_data, body['elements'])
+                    dirty_ids = set(body['elements'])
+                else:
+                    return jsonify({'error': 'operations or elements is required'}), 400
+            except JsonPatchTestFailed as e:
+                return jsonify({'error': str(e)}), 409
+            except JsonPatchError as e:
+                return jsonify({'error': str(e)}), 422
+            if not isinstance(poster_data, dict) or not isinstance(poster_data.get('size'), dict):
+                return jsonify({'error': 'Patched document is not a valid poster'}), 422
+            elements = poster_data.get('elements')
+            if elements is not None and not (
+                    isinstance(elements, list) and all(isinstance(el, dict) for el in elements)):
+                return jsonify({'error': 'Patched elements must be a list of objects'}), 422
+            
+            render_info = _store_poster_update(pid, old_data, poster_data, dirty_ids=dirty_ids)
+        
+        etag = _poster_etag(poster_data)
+        response = jsonify({
+            'poster_id': poster_id,
+            'poster_url': f"/api/poster/{poster_id}/image",
+            'poster_data': poster_data,
+            'version': etag,
+            'render': render_info,
+            'message': 'Poster updated successfully'
+        })
+        response.set_etag(etag)
+        return response, 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def _store_poster_update(pid: str, old_data: dict, poster_data: dict, dirty_ids=None) -> dict:
+    """
+    重新渲染并保存更新后的海报：已有旧 PNG 时只重绘变化元素的脏区域，否则整张渲染
+    返回渲染信息（mode / dirty_ids / dirty_ratio）
+    """
+    poster_png_path = poster_store.png_path(pid)
+    if poster_png_path is not None:
+        poster_image, render_info = render_executor.render_update(
+            old_data, poster_data, poster_png_path, format='PNG', dirty_ids=dirty_ids
+        )
+    else:
+        poster_image = render_executor.render(poster_data, format='PNG')
+        render_info = {'mode': 'full', 'dirty_ids': None, 'dirty_ratio': 1.0}
+    poster_store.save(pid, poster_data, poster_image.read())
+    # 只清理本海报的导出缓存与尺寸版本
+    render_cache.invalidate(pid)
+    rendition_store.invalidate(pid)
+    return render_info
+
+
 @app.route('/poster/<poster_id>/update', methods=['PUT'])
 def update_poster(poster_id):
     """更新海报内容"""
@@ -270,42 +872,74 @@ def update_poster(poster_id):
         if not poster_data:
             return jsonify({'error': 'poster_data is required'}), 400
         
-        poster_json_path = os.path.join(POSTERS_DIR, f"{pid}.json")
-        if not os.path.isfile(poster_json_path):
-            return jsonify({'error': 'Poster not found'}), 404
-        
-        poster_image = poster_renderer.render(poster_data, format='PNG')
-        poster_png_path = os.path.join(POSTERS_DIR, f"{pid}.png")
-        with open(poster_png_path, 'wb') as f:
-            f.write(poster_image.read())
-        with open(poster_json_path, 'w', encoding='utf-8') as f:
-            json.dump(poster_data, f, ensure_ascii=False, indent=2)
+        with _poster_lock(pid):
+            old_data = poster_store.load(pid)
+            if old_data is None:
+                return jsonify({'error': 'Poster not found'}), 404
+            
+            current = _poster_etag(old_data)
+            if _version_conflict(current, data.get('version')):
+                response = jsonify({'error': 'Poster has been modified', 'version': current})
+                response.set_etag(current)
+                return response, 412
+            render_info = _store_poster_update(pid, old_data, poster_data)
         
-        return jsonify({
+        etag = _poster_etag(poster_data)
+        response = jsonify({
             'poster_id': poster_id,
             'poster_url': f"/api/poster/{poster_id}/image",
             'poster_data': poster_data,
+            'version': etag,
+            'render': render_info,
             'message': 'Poster updated successfully'
-        }), 200
+        })
+        response.set_etag(etag)
+        return response, 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/poster/<poster_id>/image', methods=['GET'])
 def get_poster_image(poster_id):
-    """获取海报图片"""
+    """
+    获取海报图片
+    可选 w（宽度，向上取整到 RENDITION_WIDTHS）与 format（png / webp / jpeg），版本文件首次请求时生成；
+    支持 If-None-Match / If-Modified-Since，未变化时只 stat 源文件即返回 304
+    """
     try:
         pid = _safe_id(poster_id)
         if not pid:
             return jsonify({'error': 'Invalid poster id'}), 400
-        png_path = os.path.join(POSTERS_DIR, f"{pid}.png")
-        if not os.path.isfile(png_path):
+        width = request.args.get('w', type=int)
+        fmt = request.args.get('format')
+        try:
+            rendition = rendition_store.resolve(pid, width, fmt)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if rendition is None:
             return jsonify({'error': 'Poster not found'}), 404
-        return send_file(
-            png_path,
-            mimetype='image/png',
-            as_attachment=False
+        
+        not_modified = Response(status=304)
+        not_modified.set_etag(rendition.etag)
+        not_modified.last_modified = rendition.last_modified
+        not_modified.headers['Cache-Control'] = 'no-cache'
+        if request.if_none_match:
+            if request.if_none_match.contains(rendition.etag):
+                return not_modified
+        elif request.if_modified_since and int(rendition.last_modified) <= request.if_modified_since.timestamp():
+            return not_modified
+        
+        rendition = rendition_store.ensure(pid, rendition, width, fmt)
+        response = send_file(
+            rendition.path,
+            mimetype=rendition.mimetype,
+            as_attachment=False,
+            etag=rendition.etag,
+            last_modified=rendition.last_modified,
+            max_age=0
         )
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -317,56 +951,129 @@ def export_poster(poster_id):
         pid = _safe_id(poster_id)
         if not pid:
             return jsonify({'error': 'Invalid poster id'}), 400
-        json_path = os.path.join(POSTERS_DIR, f"{pid}.json")
-        if not os.path.isfile(json_path):
+        # 缓存键只需内容哈希（读文档头部）；缓存未命中需要渲染时才读取整个文档
+        header = poster_store.load_header(pid)
+        if header is None:
             return jsonify({'error': 'Poster not found'}), 404
-        with open(json_path, 'r', encoding='utf-8') as f:
-            poster_data = json.load(f)
+        content_hash = header[1]
+        
+        def render_cached(fmt, ext, render_with, params=None):
+            """按头部哈希取缓存，未命中时读取整个文档交给 render_with 渲染"""
+            def render():
+                poster_data = poster_store.load(pid)
+                if poster_data is None:
+                    raise Exception('Poster not found')
+                if canonical_hash(poster_data) != content_hash:
+                    # 读头部之后文档被 PUT / PATCH 改写：不能把新内容的渲染结果缓存在旧哈希下
+                    raise _PosterChanged(poster_data)
+                return render_with(poster_data)
+            
+            try:
+                return render_cache.get_or_render(
+                    pid, None, fmt, ext, render, params=params, content_hash=content_hash
+                )
+            except _PosterChanged as changed:
+                # 改用实际读到的文档及其哈希作缓存键
+                poster_data = changed.args[0]
+                return render_cache.get_or_render(
+                    pid, poster_data, fmt, ext, lambda: render_with(poster_data),
+                    params=params, content_hash=canonical_hash(poster_data)
+                )
         
         data = request.get_json() or {}
         format_type = data.get('format', 'png').lower()
+        # 编码档位：fast-preview / web / print，不传为默认；quality、lossless（WEBP）、colors（PNG 量化）可单独覆盖
+        profile = data.get('profile')
+        encode_info = None
         if format_type == 'pdf':
-            output = poster_renderer.render_to_pdf(poster_data)
             mimetype = 'application/pdf'
             filename = f'poster_{poster_id}.pdf'
-        elif format_type == 'jpeg' or format_type == 'jpg':
-            output = poster_renderer.render(poster_data, format='JPEG')
-            mimetype = 'image/jpeg'
-            filename = f'poster_{poster_id}.jpg'
+            output, cache_source = render_cached('PDF', 'pdf', render_executor.render_to_pdf)
         else:
-            output = poster_renderer.render(poster_data, format='PNG')
-            mimetype = 'image/png'
-            filename = f'poster_{poster_id}.png'
+            try:
+                pil_format, params = resolve_encoder(
+                    format_type, profile,
+                    {key: data.get(key) for key in ('quality', 'lossless', 'colors')}
+                )
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            _, ext, mimetype = IMAGE_FORMATS[format_type]
+            filename = f'poster_{poster_id}.{ext}'
+            png_path = poster_store.png_path(pid)
+            if pil_format == 'PNG' and not params and png_path is not None:
+                # 生成/更新时写入的 PNG 与当前 JSON 同步，即是现成的渲染结果
+                output, cache_source = png_path, 'disk'
+            else:
+                def render(poster_data):
+                    nonlocal encode_info
+                    result, encode_info = render_executor.render_encoded(
+                        poster_data, format=pil_format, params=params
+                    )
+                    return result
+                
+                # 编码参数属于缓存键：不同档位 / 参数的结果分别缓存
+                output, cache_source = render_cached(pil_format, ext, render, params=params)
         
-        return send_file(
+        response = send_file(
             output,
             mimetype=mimetype,
             as_attachment=True,
             download_name=filename
         )
+        response.headers['X-Render-Cache'] = cache_source
+        if encode_info:
+            response.headers['X-Encode-Time-Ms'] = str(encode_info['encode_ms'])
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/image/<image_id>', methods=['GET'])
 def get_image(image_id):
-    """获取上传的图片"""
+    """获取上传的图片（按实际格式返回 mimetype）"""
     try:
         iid = _safe_id(image_id)
         if not iid:
             return jsonify({'error': 'Invalid image id'}), 400
-        image_path = os.path.join(UPLOADS_DIR, f"{iid}.jpg")
-        if not os.path.isfile(image_path):
+        found = upload_path(UPLOADS_DIR, iid)
+        if found is None:
             return jsonify({'error': 'Image not found'}), 404
+        image_path, mimetype = found
         return send_file(
             image_path,
-            mimetype='image/jpeg',
+            mimetype=mimetype,
             as_attachment=False
         )
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/image/<image_id>', methods=['DELETE'])
+def release_image(image_id):
+    """
+    凭上传返回的 release_token（?token= 或 body 中的 release_token）释放那一次引用；
+    引用归零且没有已保存的海报使用时删除图片，仍被使用时保留（由存储生命周期稍后清理）
+    """
+    try:
+        iid = _safe_id(image_id)
+        if not iid:
+            return jsonify({'error': 'Invalid image id'}), 400
+        token = request.args.get('token') or (request.get_json(silent=True) or {}).get('release_token')
+        if not isinstance(token, str) or not token:
+            return jsonify({'error': 'release_token is required'}), 400
+        
+        def referenced(image_id):
+            # 引用表尚未补齐（旧索引未迁移）时无法确认，一律保留
+            return not poster_store.references_complete() or bool(poster_store.referenced_images([image_id]))
+        
+        released = upload_store.release(iid, token, referenced=referenced)
+        if released is None:
+            return jsonify({'error': 'Image not found or release token invalid'}), 404
+        return jsonify({'image_id': iid, **released}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
     app.run(host='0.0.0.0', port=port, debug=True)
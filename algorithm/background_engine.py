@@ -0,0 +1,166 @@
+"""
+背景渲染模块
+用 NumPy 直接按像素坐标生成背景数组（纯色 / 任意角度线性渐变 / 径向渐变 / 多色标），
+相同 (尺寸, 背景描述) 的结果做 LRU 缓存，三套模板的渐变基本都能命中
+"""
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_GRADIENT_COLORS = ["#4A90E2", "#357ABD"]
+# 按渐变绘制的背景类型；gradient 为旧模板写法，与 linear 相同（shape 为 radial 时按径向）
+GRADIENT_TYPES = ("gradient", "linear", "radial")
+
+
+@lru_cache(maxsize=1024)
+def parse_color(value: str) -> Tuple[int, int, int]:
+    """解析十六进制颜色（#RGB / #RRGGBB / #RRGGBBAA，忽略透明度）为 RGB"""
+    hex_color = value.strip().lstrip('#')
+    if len(hex_color) == 3:
+        hex_color = ''.join(ch * 2 for ch in hex_color)
+    if len(hex_color) not in (6, 8):
+        raise ValueError(f"Invalid color: {value}")
+    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+
+
+def _normalize_stops(colors: Sequence[str], stops: Optional[Sequence[float]]) -> Tuple[np.ndarray, np.ndarray]:
+    """色标位置归一化到 [0, 1] 且单调不减；未给出时均匀分布"""
+    if not colors:
+        colors = DEFAULT_GRADIENT_COLORS
+    if len(colors) == 1:
+        colors = [colors[0], colors[0]]
+    if stops and len(stops) == len(colors):
+        positions = np.clip(np.asarray(stops, dtype=np.float64), 0.0, 1.0)
+        positions = np.maximum.accumulate(positions)
+    else:
+        positions = np.linspace(0.0, 1.0, len(colors))
+    rgb = np.asarray([parse_color(c) for c in colors], dtype=np.float64)
+    return positions, rgb
+
+
+def _interpolate(t: np.ndarray, positions: np.ndarray, rgb: np.ndarray) -> np.ndarray:
+    """按色标对参数 t 逐通道线性插值，返回 uint8 数组（最后一维为 RGB）"""
+    out = np.empty(t.shape + (3,), dtype=np.uint8)
+    for channel in range(3):
+        # 截断取整，与原先 int() 的结果保持一致
+        out[..., channel] = np.interp(t, positions, rgb[:, channel])
+    return out
+
+
+class BackgroundEngine:
+    """背景生成器：NumPy 向量化 + (尺寸, 背景描述) LRU 缓存"""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = max_entries or int(os.getenv('POSTER_BACKGROUND_CACHE_SIZE', '16'))
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple[int, int, str], Image.Image]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, size: Tuple[int, int], background: Optional[Dict[str, Any]]) -> Image.Image:
+        """生成背景图（返回副本，调用方可以直接在上面绘制）"""
+        width, height = int(size[0]), int(size[1])
+        spec = background or {}
+        key = (width, height, json.dumps(spec, sort_keys=True, ensure_ascii=False))
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached.copy()
+            self.misses += 1
+        img = self._build(width, height, spec)
+        with self._lock:
+            self._cache[key] = img
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return img.copy()
+
+    def _build(self, width: int, height: int, spec: Dict[str, Any]) -> Image.Image:
+        bg_type = spec.get("type", "solid")
+        if bg_type == "solid":
+            return Image.new('RGB', (width, height), color=parse_color(spec.get("color", "#FFFFFF")))
+        if bg_type not in GRADIENT_TYPES:
+            # 不认识的背景类型按白底处理
+            return Image.new('RGB', (width, height), color=(255, 255, 255))
+        positions, rgb = _normalize_stops(spec.get("colors") or DEFAULT_GRADIENT_COLORS, spec.get("stops"))
+        if bg_type == "radial" or spec.get("shape") == "radial":
+            t = self._radial_param(width, height, spec)
+        else:
+            t = self._linear_param(width, height, float(spec.get("angle", 180)))
+        arr = _interpolate(t, positions, rgb)
+        if arr.shape[:2] != (height, width):
+            # 一维渐变只计算一行/一列，再广播到整张画布
+            arr = np.broadcast_to(arr, (height, width, 3))
+        return Image.fromarray(np.ascontiguousarray(arr), 'RGB')
+
+    def _linear_param(self, width: int, height: int, angle: float) -> np.ndarray:
+        """
+        线性渐变参数 t（CSS 角度约定：180 为自上而下，90 为自左向右）。
+        坐标取像素索引，首尾像素正好落在首尾色标上
+        """
+        rad = math.radians(angle % 360)
+        dx, dy = math.sin(rad), -math.cos(rad)
+        if abs(dx) < 1e-9:
+            dx = 0.0
+        if abs(dy) < 1e-9:
+            dy = 0.0
+        length = abs((width - 1) * dx) + abs((height - 1) * dy)
+        if length <= 0:
+            return np.zeros((1, 1), dtype=np.float64)
+        if dx == 0.0:
+            ys = np.arange(height, dtype=np.float64) - (height - 1) / 2
+            return (ys * dy / length + 0.5).reshape(height, 1)
+        if dy == 0.0:
+            xs = np.arange(width, dtype=np.float64) - (width - 1) / 2
+            return (xs * dx / length + 0.5).reshape(1, width)
+        xs = (np.arange(width, dtype=np.float64) - (width - 1) / 2) * (dx / length)
+        ys = (np.arange(height, dtype=np.float64) - (height - 1) / 2) * (dy / length)
+        return ys[:, None] + xs[None, :] + 0.5
+
+    def _radial_param(self, width: int, height: int, spec: Dict[str, Any]) -> np.ndarray:
+        """径向渐变参数 t：center 为相对坐标（默认画布中心），radius 默认到最远角的距离"""
+        center = spec.get("center") or {}
+        cx = float(center.get("x", 0.5)) * (width - 1)
+        cy = float(center.get("y", 0.5)) * (height - 1)
+        radius = spec.get("radius")
+        if radius:
+            r = float(radius) * math.hypot(width - 1, height - 1) / 2
+        else:
+            r = max(math.hypot(x - cx, y - cy) for x in (0, width - 1) for y in (0, height - 1))
+        r = r or 1.0
+        xs = (np.arange(width, dtype=np.float64) - cx) ** 2
+        ys = (np.arange(height, dtype=np.float64) - cy) ** 2
+        return np.sqrt(ys[:, None] + xs[None, :]) / r
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存命中统计"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'cached': len(self._cache),
+                'max_size': self.max_entries,
+            }
+
+
+_engine: Optional[BackgroundEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_background_engine() -> BackgroundEngine:
+    """进程内共享的背景生成器"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = BackgroundEngine()
+    return _engine
@@ -0,0 +1,129 @@
+"""
+LLM 设计方案缓存模块
+按 规范化 prompt + provider + model + 系统提示词版本 缓存设计方案（TTL + 条数上限 LRU），
+并对并发的相同请求做 single-flight 合并，只发起一次上游调用
+"""
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+def normalize_prompt(prompt: str) -> str:
+    """prompt 规范化：全角/半角统一（NFKC），去首尾空白并合并连续空白"""
+    return ' '.join(unicodedata.normalize('NFKC', prompt or '').split())
+
+
+class _Flight:
+    """一次进行中的上游调用，后到的相同请求等待它的结果"""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[BaseException] = None
+
+
+class DesignCache:
+    """设计方案缓存 + 进行中请求合并"""
+
+    def __init__(self, ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv('LLM_DESIGN_CACHE_TTL', '600'))
+        self.max_entries = max_entries if max_entries is not None else int(
+            os.getenv('LLM_DESIGN_CACHE_SIZE', '256'))
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._flights: Dict[str, _Flight] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(prompt: str, provider: str, model: str, prompt_version: str) -> str:
+        raw = json.dumps([normalize_prompt(prompt), provider, model, prompt_version], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取未过期的缓存（返回深拷贝，调用方可随意修改）"""
+        with self._lock:
+            return self._get_locked(key)
+
+    def _get_locked(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, design = entry
+        if time.time() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return copy.deepcopy(design)
+
+    def put(self, key: str, design: Dict[str, Any]):
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), copy.deepcopy(design))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key: str,
+                       compute: Callable[[], Dict[str, Any]]) -> Tuple[Dict[str, Any], str]:
+        """
+        命中缓存直接返回；相同 key 已有调用在进行时等待其结果；否则自己发起调用
+
+        Returns:
+            (设计方案, 状态)：状态为 'hit' / 'coalesced' / 'miss'
+        """
+        with self._lock:
+            cached = self._get_locked(key)
+            if cached is not None:
+                self.hits += 1
+                return cached, 'hit'
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result), 'coalesced'
+
+        try:
+            design = compute()
+            flight.result = copy.deepcopy(design)
+            self.put(key, design)
+            return design, 'miss'
+        except BaseException as e:
+            # 失败不缓存，等待中的请求收到同一个错误
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'entries': len(self._entries),
+                'in_flight': len(self._flights),
+                'max_size': self.max_entries,
+                'ttl': self.ttl,
+            }
@@ -0,0 +1,153 @@
+"""
+图片编码模块
+输出格式 PNG（可调色板量化）/ JPEG / WEBP（有损或无损），
+编码档位（profile）在编码耗时与文件大小之间取舍：
+    fast-preview  最快编码，用于预览
+    web           体积优先（PNG 量化为 256 色、WEBP 有损），用于网页展示
+    print         画质优先（无损 / 高质量），用于打印与下载
+未指定档位时保持原有输出（PNG 默认压缩、JPEG 质量 95）
+"""
+import threading
+import time
+from io import BytesIO
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image
+
+# 导出 format 参数 → (Pillow 格式, 扩展名, mimetype)
+IMAGE_FORMATS = {
+    'png': ('PNG', 'png', 'image/png'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+    'jpg': ('JPEG', 'jpg', 'image/jpeg'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+}
+
+# 调用方可覆盖的参数：格式 → {参数: (类型, 最小值, 最大值)}
+OVERRIDABLE_PARAMS = {
+    'PNG': {'colors': (int, 2, 256)},
+    'JPEG': {'quality': (int, 1, 100)},
+    'WEBP': {'quality': (int, 0, 100), 'lossless': (bool, None, None)},
+}
+
+# 各档位的编码参数（按 Pillow 格式）；colors 表示 PNG 调色板量化的颜色数
+ENCODER_PROFILES: Dict[Optional[str], Dict[str, Dict[str, Any]]] = {
+    None: {
+        'PNG': {},
+        'JPEG': {'quality': 95},
+        'WEBP': {'quality': 90, 'method': 4},
+    },
+    'fast-preview': {
+        'PNG': {'compress_level': 1},
+        'JPEG': {'quality': 75},
+        'WEBP': {'quality': 70, 'method': 0},
+    },
+    'web': {
+        'PNG': {'colors': 256, 'optimize': True},
+        'JPEG': {'quality': 85, 'optimize': True, 'progressive': True},
+        'WEBP': {'quality': 82, 'method': 4},
+    },
+    'print': {
+        'PNG': {'compress_level': 9},
+        'JPEG': {'quality': 95, 'subsampling': 0},
+        'WEBP': {'lossless': True, 'quality': 80, 'method': 4},
+    },
+}
+
+
+def resolve_encoder(format: str, profile: Optional[str] = None,
+                    overrides: Optional[Dict[str, Any]] = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    解析编码参数
+
+    Args:
+        format: 输出格式（png / jpeg / jpg / webp，大小写不敏感）
+        profile: 编码档位（fast-preview / web / print），None 为默认
+        overrides: 覆盖档位中的个别参数（如 {'lossless': True} 或 {'colors': 64}），
+            值为 None 或该格式不适用的参数忽略
+
+    Returns:
+        (Pillow 格式, 编码参数)；编码参数同时用作渲染缓存键的一部分
+
+    Raises:
+        ValueError: 不支持的格式、档位或参数值
+    """
+    entry = IMAGE_FORMATS.get((format or 'png').lower())
+    if entry is None:
+        raise ValueError(f"Unsupported format: {format}")
+    if profile not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder profile: {profile}")
+    pil_format = entry[0]
+    params = dict(ENCODER_PROFILES[profile][pil_format])
+    allowed = OVERRIDABLE_PARAMS[pil_format]
+    for key, value in (overrides or {}).items():
+        if value is None or key not in allowed:
+            continue
+        kind, low, high = allowed[key]
+        if kind is bool:
+            if not isinstance(value, bool):
+                raise ValueError(f"{key} must be a boolean")
+        elif isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+            raise ValueError(f"{key} must be an integer between {low} and {high}")
+        params[key] = value
+    return pil_format, params
+
+
+def encode_image(img: Image.Image, format: str = 'PNG',
+                 params: Optional[Dict[str, Any]] = None) -> Tuple[BytesIO, Dict[str, Any]]:
+    """
+    按格式与参数编码
+
+    Returns:
+        (BytesIO, 编码信息 {format, bytes, encode_ms})
+    """
+    pil_format = format.upper()
+    if pil_format == 'JPG':
+        pil_format = 'JPEG'
+    params = dict(params if params is not None else ENCODER_PROFILES[None].get(pil_format, {}))
+    start = time.perf_counter()
+    if pil_format == 'JPEG' and img.mode != 'RGB':
+        # JPEG 不支持透明，需要转换为 RGB（透明部分铺白底）
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3] if img.mode == 'RGBA' else None)
+        img = background
+    colors = params.pop('colors', None)
+    if pil_format == 'PNG' and colors:
+        # 调色板量化：渐变 + 文字的海报 256 色下肉眼几乎无差别，体积通常降到 1/3 以下
+        img = img.quantize(colors=int(colors), method=Image.Quantize.FASTOCTREE)
+    output = BytesIO()
+    img.save(output, format=pil_format, **params)
+    info = {
+        'format': pil_format,
+        'bytes': output.tell(),
+        'encode_ms': round((time.perf_counter() - start) * 1000, 2),
+    }
+    output.seek(0)
+    return output, info
+
+
+class EncodeStats:
+    """按格式累计编码次数、字节数与耗时（供 /health 展示）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._formats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, info: Optional[Dict[str, Any]]):
+        if not info:
+            return
+        with self._lock:
+            entry = self._formats.setdefault(info['format'], {'count': 0, 'bytes': 0, 'encode_ms': 0.0})
+            entry['count'] += 1
+            entry['bytes'] += info['bytes']
+            entry['encode_ms'] += info['encode_ms']
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                fmt: {
+                    'count': int(e['count']),
+                    'avg_bytes': int(e['bytes'] / e['count']),
+                    'avg_encode_ms': round(e['encode_ms'] / e['count'], 2),
+                }
+                for fmt, e in self._formats.items() if e['count']
+            }
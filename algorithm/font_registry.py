@@ -0,0 +1,174 @@
+"""
+字体注册模块
+启动时解析一次字体路径（支持 POSTER_FONT_PATH 与 fontFamily 映射），
+按 (path, index, size) 用 LRU 缓存 FreeTypeFont，PNG / JPEG / PDF 渲染共用同一份
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import ImageFont
+
+# 默认候选字体：优先支持中文（路径需与 Docker/系统安装一致，否则会乱码/方框）
+DEFAULT_FONT_PATHS = [
+    "/usr/share/fonts/wenquanyi/wqy-zenhei/wqy-zenhei.ttc",  # Debian/Ubuntu fonts-wqy-zenhei
+    "/usr/share/fonts/truetype/wqy-zenhei/wqy-zenhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "C:/Windows/Fonts/msyh.ttc",
+    "C:/Windows/Fonts/simhei.ttf",
+]
+
+FONT_EXTENSIONS = ('.ttf', '.ttc', '.otf')
+
+# reportlab 内置字体，找不到可注册的 TrueType 字体时使用
+PDF_FALLBACK_FONT = "Helvetica-Bold"
+
+
+def _family_key(name: str) -> str:
+    """fontFamily 归一化：忽略大小写、空格、连字符与下划线"""
+    return ''.join(ch for ch in name.lower() if ch not in ' -_')
+
+
+class FontRegistry:
+    """字体注册表：路径解析一次，FreeTypeFont 按 (path, index, size) LRU 缓存"""
+
+    def __init__(self, max_fonts: Optional[int] = None):
+        self.max_fonts = max_fonts or int(os.getenv('POSTER_FONT_CACHE_SIZE', '64'))
+        self._lock = threading.Lock()
+        self._fonts: "OrderedDict[Tuple[str, int, int], ImageFont.FreeTypeFont]" = OrderedDict()
+        self._pdf_fonts: Dict[Tuple[str, int], str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.default_path = self._resolve_default_path()
+        self.families = self._load_families()
+
+    def _resolve_default_path(self) -> Optional[str]:
+        """按 POSTER_FONT_PATH → 默认候选顺序找到第一个可加载的字体"""
+        candidates = []
+        env_font = os.environ.get("POSTER_FONT_PATH")
+        if env_font:
+            candidates.append(env_font)
+        candidates += DEFAULT_FONT_PATHS
+        for path in candidates:
+            if not os.path.exists(path):
+                continue
+            try:
+                ImageFont.truetype(path, size=12, index=0)
+                return path
+            except (OSError, IOError):
+                continue
+        return None
+
+    def _load_families(self) -> Dict[str, str]:
+        """
+        fontFamily → 字体路径映射：
+        - POSTER_FONT_DIR：目录下的字体文件按文件名（不含扩展名）注册
+        - POSTER_FONT_FAMILIES：显式映射，格式 "Arial=/path/a.ttf;思源黑体=/path/b.otf"
+        未映射的 fontFamily 使用默认中文字体，避免模板里的 "Arial" 把中文渲染成方框
+        """
+        families: Dict[str, str] = {}
+        font_dir = os.environ.get("POSTER_FONT_DIR")
+        if font_dir and os.path.isdir(font_dir):
+            for root, _, files in os.walk(font_dir):
+                for name in files:
+                    stem, ext = os.path.splitext(name)
+                    if ext.lower() in FONT_EXTENSIONS:
+                        families.setdefault(_family_key(stem), os.path.join(root, name))
+        for item in os.environ.get("POSTER_FONT_FAMILIES", "").split(';'):
+            if '=' not in item:
+                continue
+            name, path = item.split('=', 1)
+            if name.strip() and os.path.exists(path.strip()):
+                families[_family_key(name.strip())] = path.strip()
+        return families
+
+    def resolve(self, family: Optional[str] = None) -> Optional[Tuple[str, int]]:
+        """解析 fontFamily 对应的 (path, index)，无可用字体时返回 None"""
+        path = None
+        if family:
+            path = self.families.get(_family_key(family))
+        path = path or self.default_path
+        if not path:
+            return None
+        # .ttc 需显式 index=0，否则部分环境会乱码
+        return path, 0
+
+    def get_font(self, size: int, family: Optional[str] = None) -> ImageFont.ImageFont:
+        """获取指定字号的字体（命中缓存时不再解析字体文件）"""
+        resolved = self.resolve(family)
+        if resolved is None:
+            return ImageFont.load_default()
+        return self.get_font_at(resolved[0], resolved[1], size)
+
+    def get_font_at(self, path: str, index: int, size: int) -> ImageFont.ImageFont:
+        """按已解析的 (path, index) 获取字体"""
+        key = (path, index, int(size))
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._fonts.move_to_end(key)
+                self.hits += 1
+                return font
+            self.misses += 1
+        try:
+            font = ImageFont.truetype(path, size=int(size), index=index)
+        except (OSError, IOError):
+            return ImageFont.load_default()
+        with self._lock:
+            self._fonts[key] = font
+            self._fonts.move_to_end(key)
+            while len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+        return font
+
+    def pdf_font_name(self, family: Optional[str] = None) -> str:
+        """返回 reportlab 可用的字体名（首次使用时注册 TrueType 字体，中文不再依赖 Helvetica）"""
+        resolved = self.resolve(family)
+        if resolved is None:
+            return PDF_FALLBACK_FONT
+        with self._lock:
+            name = self._pdf_fonts.get(resolved)
+        if name:
+            return name
+        try:
+            from reportlab.pdfbase import pdfmetrics
+            from reportlab.pdfbase.ttfonts import TTFont
+            path, index = resolved
+            name = f"PosterFont-{len(self._pdf_fonts)}"
+            pdfmetrics.registerFont(TTFont(name, path, subfontIndex=index))
+        except Exception as e:
+            print(f"Failed to register PDF font {resolved[0]}: {e}")
+            name = PDF_FALLBACK_FONT
+        with self._lock:
+            self._pdf_fonts[resolved] = name
+        return name
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存命中统计"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'cached': len(self._fonts),
+                'max_size': self.max_fonts,
+                'default_path': self.default_path,
+                'families': len(self.families),
+            }
+
+
+_registry: Optional[FontRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_font_registry() -> FontRegistry:
+    """进程内共享的字体注册表"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = FontRegistry()
+    return _registry
@@ -1,13 +1,36 @@
 """
 图片上传和处理服务
+上传按流读取并在读取过程中限制字节数；解码前只读文件头校验格式与尺寸，
+JPEG 用 draft 模式按 1/2、1/4、1/8 直接解码到接近目标尺寸，再做最终缩放，
+每次处理报告估算的峰值内存
 """
+import hashlib
 import os
+import tempfile
+import threading
+import time
 from PIL import Image
 from io import BytesIO
 from werkzeug.utils import secure_filename
-from typing import Tuple, Optional
+from typing import Any, BinaryIO, Dict, Tuple, Optional
 import base64
 
+# 允许的实际图片格式（按文件内容判断，不看扩展名）
+ALLOWED_FORMATS = {'PNG', 'JPEG', 'GIF', 'WEBP'}
+
+# 各模式每像素字节数（用于估算内存）
+_MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'LA': 4, 'PA': 4, 'RGB': 4, 'RGBA': 4, 'CMYK': 4,
+               'YCbCr': 4, 'I': 4, 'F': 4, 'I;16': 2}
+
+
+class ImageRejected(ValueError):
+    """上传的图片不符合限制（大小、尺寸或格式）"""
+
+
+def _pixel_bytes(size: Tuple[int, int], mode: str) -> int:
+    """解码后图像缓冲区的近似字节数（Pillow 的 RGB 按每像素 4 字节存储）"""
+    return size[0] * size[1] * _MODE_BYTES.get(mode, 4)
+
 
 class ImageService:
     """图片处理服务"""
@@ -17,59 +40,212 @@ class ImageService:
         os.makedirs(upload_dir, exist_ok=True)
         self.allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
         self.max_size = (1920, 1920)  # 最大尺寸
-        self.max_file_size = 10 * 1024 * 1024  # 10MB
+        self.max_file_size = int(os.getenv('UPLOAD_MAX_BYTES', str(10 * 1024 * 1024)))  # 默认 10MB
+        # 文件头声明的宽 / 高上限
+        self.max_dimension = int(os.getenv('UPLOAD_MAX_DIMENSION', '16384'))
+        # 实际解码的像素数上限（JPEG 按 draft 缩小后的尺寸计），约束单次上传的解码内存
+        self.max_decode_pixels = int(os.getenv('UPLOAD_MAX_DECODE_PIXELS', str(25 * 1000 * 1000)))
+        # 上传内容超过该大小时落盘暂存，不整体放在内存
+        self.spool_size = int(os.getenv('UPLOAD_SPOOL_BYTES', str(1024 * 1024)))
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.rejected = 0
+        self.peak_memory_max = 0
+        self.peak_memory_total = 0
     
     def allowed_file(self, filename: str) -> bool:
         """检查文件扩展名是否允许"""
         return '.' in filename and \
                filename.rsplit('.', 1)[1].lower() in self.allowed_extensions
     
-    def process_image(self, file_data: bytes, filename: str, 
-                     max_size: Optional[Tuple[int, int]] = None,
-                     quality: int = 85) -> BytesIO:
+    def read_capped(self, stream: BinaryIO, limit: Optional[int] = None,
+                    chunk_size: int = 64 * 1024) -> Tuple[BinaryIO, int, str]:
         """
-        处理图片：压缩、调整大小等
+        分块读取上传流，超过 limit 字节立即停止；读取的同时计算原始内容的 sha256
+        
+        Returns:
+            (可 seek 的文件对象（已回到开头）, 字节数, sha256 十六进制)；
+            可 seek 的输入直接复用，否则写入临时文件
+            
+        Raises:
+            ImageRejected: 超过大小限制
+        """
+        limit = self.max_file_size if limit is None else limit
+        seekable = hasattr(stream, 'seekable') and stream.seekable()
+        target = stream if seekable else tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        total = 0
+        digest = hashlib.sha256()
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            total += len(chunk)
+            digest.update(chunk)
+            if total > limit:
+                if target is not stream:
+                    target.close()
+                raise ImageRejected('File too large')
+            if target is not stream:
+                target.write(chunk)
+        target.seek(0)
+        return target, total, digest.hexdigest()
+    
+    @staticmethod
+    def output_format(filename: str) -> str:
+        """输出格式由扩展名决定：png 输出 PNG，其余输出 JPEG"""
+        ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+        return 'PNG' if ext == 'png' else 'JPEG'
+    
+    def ingest(self, stream: BinaryIO, filename: str,
+               max_size: Optional[Tuple[int, int]] = None,
+               quality: int = 85) -> Tuple[BytesIO, Dict[str, Any]]:
+        """
+        上传图片处理流水线：限字节读取 → 文件头校验 → draft 解码 → 缩放 → 编码
         
         Args:
-            file_data: 图片二进制数据
-            filename: 文件名
+            stream: 上传内容（文件对象）
+            filename: 文件名（决定输出格式，见 output_format）
             max_size: 最大尺寸，默认使用 self.max_size
             quality: JPEG 质量 (1-100)
             
         Returns:
-            处理后的图片 BytesIO
+            (处理后的图片 BytesIO, 处理信息 {source, decoded, output, peak_memory_bytes, elapsed_ms})
+            
+        Raises:
+            ImageRejected: 大小、尺寸或格式不符合限制
         """
-        if max_size is None:
-            max_size = self.max_size
-        
-        # 打开图片
-        img = Image.open(BytesIO(file_data))
+        try:
+            source, size, _ = self.read_capped(stream)
+        except ImageRejected:
+            with self._lock:
+                self.rejected += 1
+            raise
+        return self.process_source(source, size, filename, max_size, quality)
+    
+    def process_source(self, source: BinaryIO, size: int, filename: str,
+                       max_size: Optional[Tuple[int, int]] = None,
+                       quality: int = 85) -> Tuple[BytesIO, Dict[str, Any]]:
+        """处理已经用 read_capped 读入的上传内容（参数与返回值同 ingest）"""
+        start = time.perf_counter()
+        try:
+            output, info = self._process(source, size, filename, max_size or self.max_size, quality)
+        except ImageRejected:
+            with self._lock:
+                self.rejected += 1
+            raise
+        info['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        with self._lock:
+            self.processed += 1
+            self.peak_memory_total += info['peak_memory_bytes']
+            self.peak_memory_max = max(self.peak_memory_max, info['peak_memory_bytes'])
+        return output, info
+    
+    def _process(self, source: BinaryIO, size: int, filename: str,
+                 max_size: Tuple[int, int], quality: int) -> Tuple[BytesIO, Dict[str, Any]]:
+        # Image.open 只读取文件头，此时还没有解码像素
+        try:
+            img = Image.open(source)
+        except (OSError, Image.DecompressionBombError):
+            raise ImageRejected('Invalid image file')
+        with img:
+            if img.format not in ALLOWED_FORMATS:
+                raise ImageRejected(f'Unsupported image format: {img.format}')
+            source_format = img.format
+            width, height = img.size
+            if width > self.max_dimension or height > self.max_dimension:
+                raise ImageRejected(f'Image dimensions {width}x{height} exceed {self.max_dimension}')
+            
+            scale = min(1.0, max_size[0] / width, max_size[1] / height)
+            target = (max(1, round(width * scale)), max(1, round(height * scale)))
+            if img.format == 'JPEG' and scale < 1.0:
+                # draft 让解码器直接按 1/2、1/4、1/8 输出，尺寸不小于目标
+                img.draft('RGB', target)
+            decoded_size = img.size
+            if decoded_size[0] * decoded_size[1] > self.max_decode_pixels:
+                # 只看文件头即可拒绝，不分配任何像素缓冲区
+                raise ImageRejected(
+                    f'Image dimensions {width}x{height} exceed {self.max_decode_pixels} decoded pixels')
+            
+            # 估算峰值：同一时刻存活的缓冲区之和（内存中暂存的原始字节 + 各阶段图像）
+            spooled = size if size <= self.spool_size else 0
+            try:
+                img.load()
+            except (OSError, Image.DecompressionBombError):
+                raise ImageRejected('Invalid image file')
+            decoded_bytes = _pixel_bytes(decoded_size, img.mode)
+            peak = spooled + decoded_bytes
+            
+            work = img
+            if work.mode not in ('RGB', 'RGBA'):
+                # 调色板 / 灰度等模式先转成 RGB(A)，否则 LANCZOS 缩放会退化为最近邻
+                has_alpha = work.mode in ('LA', 'PA') or 'transparency' in work.info
+                work = work.convert('RGBA' if has_alpha else 'RGB')
+                peak = max(peak, spooled + decoded_bytes + _pixel_bytes(decoded_size, work.mode))
+            if work.size != target:
+                # 先缩放再处理透明通道：合成在小图上进行
+                resized = work.resize(target, Image.Resampling.LANCZOS, reducing_gap=2.0)
+                live = decoded_bytes + (_pixel_bytes(decoded_size, work.mode) if work is not img else 0)
+                peak = max(peak, spooled + live + _pixel_bytes(target, resized.mode))
+                work = resized
+            elif work is img:
+                work = img.copy()
         
-        # 转换为 RGB（如果是 RGBA）
+        img = work
         if img.mode == 'RGBA':
+            # 转换为 RGB（透明部分铺白底）
             background = Image.new('RGB', img.size, (255, 255, 255))
             background.paste(img, mask=img.split()[3])
             img = background
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # 调整大小
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+            peak = max(peak, spooled + _pixel_bytes(target, 'RGBA') + _pixel_bytes(target, 'RGB'))
         
         # 保存
         output = BytesIO()
-        ext = filename.rsplit('.', 1)[1].lower()
+        out_format = self.output_format(filename)
         
-        if ext in ['jpg', 'jpeg']:
-            img.save(output, format='JPEG', quality=quality, optimize=True)
-        elif ext == 'png':
+        if out_format == 'PNG':
             img.save(output, format='PNG', optimize=True)
         else:
             img.save(output, format='JPEG', quality=quality, optimize=True)
+        peak = max(peak, spooled + _pixel_bytes(target, 'RGB') + output.tell())
         
+        info = {
+            'source': {'format': source_format, 'width': width, 'height': height, 'bytes': size},
+            'decoded': {'width': decoded_size[0], 'height': decoded_size[1]},
+            'output': {'format': out_format, 'width': target[0], 'height': target[1], 'bytes': output.tell()},
+            'peak_memory_bytes': peak,
+        }
         output.seek(0)
+        return output, info
+    
+    def process_image(self, file_data: bytes, filename: str, 
+                     max_size: Optional[Tuple[int, int]] = None,
+                     quality: int = 85) -> BytesIO:
+        """
+        处理图片：压缩、调整大小等
+        
+        Args:
+            file_data: 图片二进制数据
+            filename: 文件名
+            max_size: 最大尺寸，默认使用 self.max_size
+            quality: JPEG 质量 (1-100)
+            
+        Returns:
+            处理后的图片 BytesIO
+        """
+        output, _ = self.ingest(BytesIO(file_data), filename, max_size, quality)
         return output
     
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'processed': self.processed,
+                'rejected': self.rejected,
+                'max_bytes': self.max_file_size,
+                'max_decode_pixels': self.max_decode_pixels,
+                'peak_memory_max': self.peak_memory_max,
+                'peak_memory_avg': int(self.peak_memory_total / self.processed) if self.processed else 0,
+            }
+    
     def save_image(self, image_data: BytesIO, filename: str) -> str:
         """
         保存图片到本地
@@ -0,0 +1,178 @@
+"""
+图片元素来源解析模块
+本服务自己的图片地址（/api/image/<id>、/image/<id> 或元素上的 image_id）经 safe_id 校验后
+直接映射到 UPLOADS_DIR 下的文件（按扩展名查找，不查上传索引）；真正的外部地址走带连接池的 keep-alive Session。
+解码并缩放到目标尺寸后的图片按 (来源, 目标尺寸) 做 LRU 缓存，按内存占用淘汰
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Any, Dict, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from path_utils import safe_id
+from upload_store import upload_path
+
+# 本服务图片地址的路径部分（前端/后端代理为 /api/image/<id>，算法服务直连为 /image/<id>）
+LOCAL_IMAGE_PATH = re.compile(r'^(?:/api)?/image/([^/?#]+)/?$')
+
+
+def local_image_hosts() -> Set[str]:
+    """带主机名时也视为本服务地址的主机（如后端通过服务名访问 algorithm:8000）"""
+    return {
+        h.strip().lower() for h in os.getenv('LOCAL_IMAGE_HOSTS', 'localhost,127.0.0.1,algorithm').split(',')
+        if h.strip()
+    }
+
+
+def upload_image_id(element: Dict[str, Any], local_hosts: Set[str]) -> Optional[str]:
+    """元素指向本服务上传图片时返回（已校验的）image_id，否则返回 None"""
+    image_id = element.get("image_id")
+    if not image_id:
+        url = element.get("url") or ""
+        parsed = urlparse(url)
+        if parsed.netloc and (parsed.hostname or '').lower() not in local_hosts:
+            return None
+        match = LOCAL_IMAGE_PATH.match(parsed.path)
+        if not match:
+            return None
+        image_id = match.group(1)
+    return safe_id(image_id) or None
+
+
+def poster_image_ids(poster_data: Dict[str, Any], local_hosts: Optional[Set[str]] = None) -> Set[str]:
+    """海报引用的上传图片 id（供存储生命周期判断上传图片是否仍被使用）"""
+    local_hosts = local_hosts if local_hosts is not None else local_image_hosts()
+    ids = set()
+    for element in poster_data.get('elements') or []:
+        if isinstance(element, dict) and element.get('type') == 'image':
+            image_id = upload_image_id(element, local_hosts)
+            if image_id:
+                ids.add(image_id)
+    return ids
+
+
+class ImageSourceResolver:
+    """图片来源解析 + 解码缓存"""
+
+    def __init__(self, uploads_dir: Optional[str] = None, max_cache_bytes: Optional[int] = None,
+                 timeout: Optional[float] = None, pool_size: Optional[int] = None):
+        self.uploads_dir = uploads_dir or os.environ.get('UPLOADS_DIR', '/tmp/uploads')
+        self.max_cache_bytes = max_cache_bytes if max_cache_bytes is not None else int(
+            float(os.getenv('IMAGE_CACHE_MB', '64')) * 1024 * 1024)
+        self.timeout = timeout if timeout is not None else float(os.getenv('IMAGE_FETCH_TIMEOUT', '10'))
+        pool_size = pool_size or int(os.getenv('IMAGE_FETCH_POOL_SIZE', '8'))
+        self.local_hosts = local_image_hosts()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple, Image.Image]" = OrderedDict()
+        self._cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.local_loads = 0
+        self.remote_fetches = 0
+
+    def local_path(self, element: Dict[str, Any]) -> Optional[str]:
+        """元素指向本服务上传图片时返回文件路径，否则返回 None"""
+        iid = upload_image_id(element, self.local_hosts)
+        if not iid:
+            return None
+        found = upload_path(self.uploads_dir, iid)
+        return found[0] if found else None
+
+    def get_image(self, element: Dict[str, Any],
+                  size: Optional[Tuple[int, int]] = None) -> Optional[Image.Image]:
+        """
+        获取元素图片（已缩放到 size）。返回的是缓存中的共享对象，调用方只能读取（如 paste），不能修改
+
+        Returns:
+            图片；元素没有图片来源时返回 None
+        """
+        path = self.local_path(element)
+        if path is not None:
+            # 本地文件以 mtime 区分版本，文件被替换后自动失效
+            source = ('file', path, os.path.getmtime(path))
+        elif element.get("url"):
+            if not urlparse(element["url"]).scheme:
+                # 相对地址只可能是本服务的图片，本地找不到就不必再发 HTTP 请求
+                raise ValueError(f"Image not found: {element['url']}")
+            source = ('url', element["url"])
+        else:
+            return None
+        key = (source, tuple(size) if size else None)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        img = self._load(source)
+        if size:
+            img = img.resize((int(size[0]), int(size[1])), Image.Resampling.LANCZOS)
+        self._remember(key, img)
+        return img
+
+    def _load(self, source: Tuple) -> Image.Image:
+        if source[0] == 'file':
+            with self._lock:
+                self.local_loads += 1
+            img = Image.open(source[1])
+        else:
+            with self._lock:
+                self.remote_fetches += 1
+            response = self.session.get(source[1], timeout=self.timeout)
+            response.raise_for_status()
+            img = Image.open(BytesIO(response.content))
+        img.load()
+        return img
+
+    def _remember(self, key: Tuple, img: Image.Image):
+        nbytes = img.width * img.height * len(img.getbands())
+        if nbytes > self.max_cache_bytes:
+            return
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._cache_bytes -= old.width * old.height * len(old.getbands())
+            self._cache[key] = img
+            self._cache_bytes += nbytes
+            while self._cache_bytes > self.max_cache_bytes and self._cache:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= evicted.width * evicted.height * len(evicted.getbands())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'local_loads': self.local_loads,
+                'remote_fetches': self.remote_fetches,
+                'cached': len(self._cache),
+                'cached_bytes': self._cache_bytes,
+                'max_bytes': self.max_cache_bytes,
+            }
+
+
+_resolver: Optional[ImageSourceResolver] = None
+_resolver_lock = threading.Lock()
+
+
+def get_image_resolver() -> ImageSourceResolver:
+    """进程内共享的图片来源解析器"""
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                _resolver = ImageSourceResolver()
+    return _resolver
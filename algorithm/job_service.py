@@ -0,0 +1,286 @@
+"""
+异步生成任务模块
+有界队列 + 固定数量的工作线程执行生成流水线，任务状态按
+queued → designing → rendering → stored（失败或降级为 dummy 时为 failed）推进；
+状态同时写入 JOBS_DIR，多个 gunicorn worker 之间都能查询。
+任务只在提交它的进程的内存队列里：状态文件记录所属进程（主机名 + pid），未结束的任务每
+JOB_HEARTBEAT_SECONDS 秒（默认 10）刷新一次心跳；所属进程已退出或心跳超过 JOB_STALE_SECONDS 秒
+（默认 60）未更新的未结束任务，查询时标记为 failed
+"""
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+JOB_STATES = ('queued', 'designing', 'rendering', 'stored', 'failed')
+TERMINAL_STATES = ('stored', 'failed')
+
+
+class JobQueueFull(Exception):
+    """任务队列已满"""
+
+
+class JobManager:
+    """生成任务管理：有界队列、工作线程池、状态持久化与变更通知"""
+
+    def __init__(self, jobs_dir: str, workers: Optional[int] = None,
+                 max_queue: Optional[int] = None, ttl: Optional[float] = None):
+        self.jobs_dir = jobs_dir
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.workers = workers if workers is not None else int(os.getenv('GENERATION_WORKERS', '2'))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv('GENERATION_QUEUE_SIZE', '16'))
+        self.ttl = ttl if ttl is not None else float(os.getenv('JOB_TTL_SECONDS', '3600'))
+        self.heartbeat = float(os.getenv('JOB_HEARTBEAT_SECONDS', '10'))
+        self.stale_after = float(os.getenv('JOB_STALE_SECONDS', '60'))
+        self.host = socket.gethostname()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=self.max_queue)
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._cond = threading.Condition()
+        # 状态文件按快照顺序写入：快照与写文件在同一把锁内，较旧的快照不会覆盖较新的
+        self._persist_lock = threading.Lock()
+        self._threads = []
+        self._threads_pid: Optional[int] = None
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._last_prune = time.time()
+        self._running = 0
+
+    def submit(self, kind: str, payload: Dict[str, Any],
+               handler: Callable[[Dict[str, Any], Callable[..., None]], Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        提交任务
+
+        Args:
+            kind: 任务类型（如 'generate'）
+            payload: 任务参数，原样交给 handler
+            handler: handler(payload, progress) 返回结果字典；progress(state, **info) 上报阶段
+
+        Raises:
+            JobQueueFull: 队列已满
+        """
+        self._ensure_workers()
+        self._maybe_prune()
+        now = time.time()
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'kind': kind,
+            'state': 'queued',
+            'version': 0,
+            'created_at': now,
+            'updated_at': now,
+            'heartbeat_at': now,
+            'owner': {'host': self.host, 'pid': os.getpid()},
+            'progress': {},
+            'result': None,
+            'error': None,
+        }
+        snapshot = dict(job)
+        # 入队前先落盘，避免覆盖工作线程随后写入的新状态
+        with self._persist_lock:
+            with self._cond:
+                self._jobs[job['job_id']] = job
+            self._persist(snapshot)
+        try:
+            self._queue.put_nowait((job['job_id'], payload, handler))
+        except queue.Full:
+            with self._cond:
+                self._jobs.pop(job['job_id'], None)
+            try:
+                os.remove(self._path(job['job_id']))
+            except OSError:
+                pass
+            raise JobQueueFull('Job queue is full')
+        return snapshot
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        查询任务（本进程内存优先，其次读其他 worker 写入的状态文件）；
+        所属进程已不在的未结束任务标记为 failed 后返回
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        job = self._read(self._path(job_id))
+        if job is not None and self._is_stale(job, time.time()):
+            job.update(state='failed', error='Job lost: the worker running it exited',
+                       version=job.get('version', 0) + 1, updated_at=time.time())
+            self._persist(job)
+        return job
+
+    def _is_stale(self, job: Dict[str, Any], now: float) -> bool:
+        """未结束的任务：所属进程（同一主机）已退出，或心跳超过 stale_after 未更新"""
+        if job.get('state') in TERMINAL_STATES:
+            return False
+        owner = job.get('owner') or {}
+        if owner.get('host') == self.host and owner.get('pid') != os.getpid():
+            try:
+                os.kill(int(owner['pid']), 0)
+            except ProcessLookupError:
+                return True
+            except (KeyError, TypeError, ValueError, PermissionError):
+                pass
+        heartbeat = max(job.get('heartbeat_at') or 0, job.get('updated_at') or 0)
+        return now - heartbeat > self.stale_after
+
+    @staticmethod
+    def _read(path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return job if isinstance(job, dict) else None
+
+    def wait_for_change(self, job_id: str, after_version: int, timeout: float) -> Optional[Dict[str, Any]]:
+        """等待任务版本号超过 after_version（或超时），返回最新状态"""
+        deadline = time.time() + timeout
+        with self._cond:
+            if job_id in self._jobs:
+                self._cond.wait_for(
+                    lambda: self._jobs.get(job_id, {}).get('version', after_version + 1) > after_version,
+                    timeout=timeout
+                )
+                return self.get(job_id)
+        # 其他 worker 的任务：轮询状态文件
+        poll = float(os.getenv('JOB_EVENTS_POLL', '0.5'))
+        while True:
+            job = self.get(job_id)
+            if job is None or job['version'] > after_version or time.time() >= deadline:
+                return job
+            time.sleep(min(poll, max(0.0, deadline - time.time())))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            states: Dict[str, int] = {}
+            for job in self._jobs.values():
+                states[job['state']] = states.get(job['state'], 0) + 1
+            return {
+                'workers': self.workers,
+                'running': self._running,
+                'queued': self._queue.qsize(),
+                'max_queue': self.max_queue,
+                'states': states,
+            }
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _persist(self, job: Dict[str, Any]):
+        """原子写入状态文件（先写临时文件再替换）"""
+        path = self._path(job['job_id'])
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(job, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to persist job {job['job_id']}: {e}")
+
+    def _update(self, job_id: str, **fields):
+        with self._persist_lock:
+            with self._cond:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return
+                job.update(fields)
+                job['version'] += 1
+                job['updated_at'] = time.time()
+                snapshot = dict(job)
+                self._cond.notify_all()
+            self._persist(snapshot)
+
+    def _ensure_workers(self):
+        """懒启动工作线程；gunicorn fork 后按 pid 重新启动"""
+        pid = os.getpid()
+        with self._cond:
+            if self._threads_pid == pid and all(t.is_alive() for t in self._threads):
+                return
+            self._threads_pid = pid
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                t = threading.Thread(target=self._work, name=f'generation-worker-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+            if self._heartbeat_thread is None or not self._heartbeat_thread.is_alive():
+                self._heartbeat_thread = threading.Thread(target=self._beat, name='generation-heartbeat',
+                                                          daemon=True)
+                self._heartbeat_thread.start()
+
+    def _beat(self):
+        """定期刷新本进程未结束任务的心跳（不增加版本号，SSE 不会因此推送）"""
+        while True:
+            time.sleep(self.heartbeat)
+            with self._cond:
+                job_ids = [jid for jid, job in self._jobs.items() if job['state'] not in TERMINAL_STATES]
+            for job_id in job_ids:
+                with self._persist_lock:
+                    with self._cond:
+                        job = self._jobs.get(job_id)
+                        if job is None or job['state'] in TERMINAL_STATES:
+                            continue
+                        job['heartbeat_at'] = time.time()
+                        snapshot = dict(job)
+                    self._persist(snapshot)
+
+    def _work(self):
+        while True:
+            job_id, payload, handler = self._queue.get()
+            with self._cond:
+                self._running += 1
+
+            def progress(state: str, **info):
+                fields: Dict[str, Any] = {'state': state}
+                if info:
+                    with self._cond:
+                        merged = dict(self._jobs.get(job_id, {}).get('progress') or {})
+                    merged.update(info)
+                    fields['progress'] = merged
+                self._update(job_id, **fields)
+
+            try:
+                result = handler(payload, progress)
+                status = result.get('status', 'success') if isinstance(result, dict) else 'success'
+                if status == 'success':
+                    self._update(job_id, state='stored', result=result)
+                else:
+                    # 降级结果（如 LLM 不可用时的 dummy）没有存储海报：记为失败，结果照常附上
+                    self._update(job_id, state='failed', result=result,
+                                 error=result.get('error') or f"Generation degraded to {status} response")
+            except Exception as e:
+                self._update(job_id, state='failed', error=str(e))
+            finally:
+                with self._cond:
+                    self._running -= 1
+                self._queue.task_done()
+
+    def _maybe_prune(self):
+        """
+        清理超过 TTL 的已结束任务（内存与状态文件），最多每分钟一次；
+        超过 TTL 未更新、所属进程已不在的未结束任务的状态文件一并清理
+        """
+        now = time.time()
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        with self._cond:
+            expired = [jid for jid, job in self._jobs.items()
+                       if job['state'] in TERMINAL_STATES and now - job['updated_at'] > self.ttl]
+            for jid in expired:
+                del self._jobs[jid]
+        try:
+            for entry in os.scandir(self.jobs_dir):
+                if not entry.is_file() or now - entry.stat().st_mtime <= self.ttl:
+                    continue
+                if entry.name.endswith('.json'):
+                    job = self._read(entry.path)
+                    if job is not None and job.get('state') not in TERMINAL_STATES \
+                            and not self._is_stale(job, now):
+                        # 其他 worker 仍在排队 / 执行的任务
+                        continue
+                os.remove(entry.path)
+        except OSError:
+            pass
@@ -0,0 +1,197 @@
+"""
+海报局部更新模块
+支持 RFC 6902 JSON Patch（add / remove / replace / move / copy / test）
+与按元素 id 的增量更新（content 覆盖，position / style 浅合并），
+并推导出受影响的元素 id，供渲染器只重绘这些元素
+"""
+import copy
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+class JsonPatchError(Exception):
+    """补丁格式错误或无法应用"""
+
+
+class JsonPatchTestFailed(JsonPatchError):
+    """test 操作不成立"""
+
+
+def _parse_pointer(pointer: str) -> List[str]:
+    """JSON Pointer（RFC 6901）拆分为路径片段"""
+    if not isinstance(pointer, str):
+        raise JsonPatchError(f"Invalid pointer: {pointer!r}")
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise JsonPatchError(f"Invalid pointer: {pointer}")
+    return [part.replace('~1', '/').replace('~0', '~') for part in pointer[1:].split('/')]
+
+
+def _array_index(container: list, token: str, allow_end: bool) -> int:
+    if token == '-' and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+        raise JsonPatchError(f"Invalid array index: {token}")
+    index = int(token)
+    limit = len(container) if allow_end else len(container) - 1
+    if index > limit:
+        raise JsonPatchError(f"Array index out of range: {token}")
+    return index
+
+
+def _resolve_parent(doc: Any, parts: List[str]) -> Tuple[Any, str]:
+    target = doc
+    for token in parts[:-1]:
+        if isinstance(target, list):
+            target = target[_array_index(target, token, allow_end=False)]
+        elif isinstance(target, dict):
+            if token not in target:
+                raise JsonPatchError(f"Path not found: /{'/'.join(parts)}")
+            target = target[token]
+        else:
+            raise JsonPatchError(f"Path not found: /{'/'.join(parts)}")
+    return target, parts[-1]
+
+
+def _get(doc: Any, pointer: str) -> Any:
+    target = doc
+    for token in _parse_pointer(pointer):
+        if isinstance(target, list):
+            target = target[_array_index(target, token, allow_end=False)]
+        elif isinstance(target, dict) and token in target:
+            target = target[token]
+        else:
+            raise JsonPatchError(f"Path not found: {pointer}")
+    return target
+
+
+def _add(doc: Any, pointer: str, value: Any) -> Any:
+    parts = _parse_pointer(pointer)
+    if not parts:
+        return value
+    parent, token = _resolve_parent(doc, parts)
+    if isinstance(parent, list):
+        parent.insert(_array_index(parent, token, allow_end=True), value)
+    elif isinstance(parent, dict):
+        parent[token] = value
+    else:
+        raise JsonPatchError(f"Path not found: {pointer}")
+    return doc
+
+
+def _remove(doc: Any, pointer: str) -> Tuple[Any, Any]:
+    parts = _parse_pointer(pointer)
+    if not parts:
+        raise JsonPatchError("Cannot remove the document root")
+    parent, token = _resolve_parent(doc, parts)
+    if isinstance(parent, list):
+        return doc, parent.pop(_array_index(parent, token, allow_end=False))
+    if isinstance(parent, dict) and token in parent:
+        return doc, parent.pop(token)
+    raise JsonPatchError(f"Path not found: {pointer}")
+
+
+def apply_patch(doc: Dict[str, Any], operations: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    应用 RFC 6902 补丁（不修改入参，返回新文档）；任一操作失败则整体失败
+
+    Raises:
+        JsonPatchError: 操作非法或路径不存在
+        JsonPatchTestFailed: test 操作不成立
+    """
+    if not isinstance(operations, list):
+        raise JsonPatchError("Patch must be a list of operations")
+    result = copy.deepcopy(doc)
+    for op in operations:
+        if not isinstance(op, dict) or 'op' not in op or not isinstance(op.get('path'), str):
+            raise JsonPatchError(f"Invalid operation: {op!r}")
+        name, path = op['op'], op['path']
+        if name in ('add', 'replace', 'test') and 'value' not in op:
+            raise JsonPatchError(f"Operation '{name}' requires a value")
+        if name == 'add':
+            result = _add(result, path, copy.deepcopy(op['value']))
+        elif name == 'remove':
+            result, _ = _remove(result, path)
+        elif name == 'replace':
+            _get(result, path)
+            result, _ = _remove(result, path) if _parse_pointer(path) else (result, None)
+            result = _add(result, path, copy.deepcopy(op['value']))
+        elif name == 'move':
+            from_path = op.get('from')
+            if not isinstance(from_path, str) or path.startswith(from_path + '/'):
+                raise JsonPatchError(f"Invalid move from {from_path!r} to {path}")
+            result, value = _remove(result, from_path)
+            result = _add(result, path, value)
+        elif name == 'copy':
+            from_path = op.get('from')
+            if not isinstance(from_path, str):
+                raise JsonPatchError("Operation 'copy' requires from")
+            result = _add(result, path, copy.deepcopy(_get(result, from_path)))
+        elif name == 'test':
+            if _get(result, path) != op['value']:
+                raise JsonPatchTestFailed(f"Test failed at {path}")
+        else:
+            raise JsonPatchError(f"Unsupported operation: {name}")
+    return result
+
+
+def apply_element_deltas(doc: Dict[str, Any], deltas: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    按元素 id 应用增量：{"title": {"content": "...", "style": {"color": "#FFF"}}}
+    content 等字段直接覆盖，position / style 与原值浅合并（与模板应用设计的规则一致）
+
+    Raises:
+        JsonPatchError: 元素 id 不存在或增量格式错误
+    """
+    if not isinstance(deltas, dict):
+        raise JsonPatchError("Element deltas must be an object keyed by element id")
+    result = copy.deepcopy(doc)
+    elements = result.get('elements')
+    if elements is None:
+        elements = []
+    elif not isinstance(elements, list):
+        raise JsonPatchError("Poster elements must be a list")
+    by_id = {el['id']: el for el in elements
+             if isinstance(el, dict) and isinstance(el.get('id'), str) and el['id']}
+    for element_id, delta in deltas.items():
+        if element_id not in by_id:
+            raise JsonPatchError(f"Element not found: {element_id}")
+        if not isinstance(delta, dict):
+            raise JsonPatchError(f"Invalid delta for element {element_id}")
+        element = by_id[element_id]
+        for key, value in delta.items():
+            if key == 'id':
+                continue
+            if key in ('position', 'style') and isinstance(value, dict):
+                current = element.get(key)
+                element[key] = {**(current if isinstance(current, dict) else {}), **value}
+            else:
+                element[key] = copy.deepcopy(value)
+    return result
+
+
+def patched_element_ids(before: Dict[str, Any], after: Dict[str, Any],
+                        operations: List[Dict[str, Any]]) -> Optional[Set[str]]:
+    """
+    由补丁路径推导受影响的元素 id；补丁触及元素以外的字段（如 size、background）
+    或整体替换元素列表时返回 None，表示需要完整比较
+    """
+    ids: Set[str] = set()
+    for op in operations:
+        for pointer in (op.get('path'), op.get('from')):
+            if pointer is None:
+                continue
+            parts = _parse_pointer(pointer)
+            if len(parts) < 2 or parts[0] != 'elements':
+                return None
+            for doc in (before, after):
+                elements = doc.get('elements') if isinstance(doc, dict) else None
+                if not isinstance(elements, list):
+                    return None
+                if parts[1].isdigit() and int(parts[1]) < len(elements):
+                    element = elements[int(parts[1])]
+                    element_id = element.get('id') if isinstance(element, dict) else None
+                    if not element_id or not isinstance(element_id, str):
+                        return None
+                    ids.add(element_id)
+    return ids
@@ -0,0 +1,147 @@
+"""
+增量 JSON 解析模块
+LLM 流式输出时逐块喂入文本，顶层对象的每个字段一完整就立即可用
+（如 template_id、color_scheme 先于 description 到达），不必等整个回复结束。
+忽略 JSON 之前的说明文字与 ```json 代码块标记
+"""
+import json
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+_WHITESPACE = ' \t\r\n'
+
+
+class IncrementalJSONParser:
+    """顶层 JSON 对象的增量解析器"""
+
+    def __init__(self, on_field: Optional[Callable[[str, Any], None]] = None):
+        """
+        Args:
+            on_field: 顶层字段解析完成时回调 on_field(字段名, 值)
+        """
+        self.on_field = on_field
+        self.fields: Dict[str, Any] = {}
+        self.done = False
+        self._text = ''
+        self._pos = 0
+        self._start: Optional[int] = None
+        self._end: Optional[int] = None
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+        self._expect = 'key'
+        self._key: Optional[str] = None
+        self._token_start: Optional[int] = None
+        self._primitive = False
+
+    @property
+    def text(self) -> str:
+        """目前收到的全部文本"""
+        return self._text
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """
+        喂入一段文本
+
+        Returns:
+            本次新完成的 (字段名, 值) 列表
+        """
+        if not chunk:
+            return []
+        self._text += chunk
+        completed: List[Tuple[str, Any]] = []
+        text = self._text
+        for i in range(self._pos, len(text)):
+            if self.done:
+                break
+            self._step(text, i, text[i], completed)
+        self._pos = len(text)
+        for key, value in completed:
+            if self.on_field is not None:
+                self.on_field(key, value)
+        return completed
+
+    def result(self) -> Dict[str, Any]:
+        """
+        完整对象
+
+        Raises:
+            ValueError: 对象尚未结束或不是合法 JSON
+        """
+        if not self.done:
+            raise ValueError("Incomplete JSON object")
+        return json.loads(self._text[self._start:self._end])
+
+    def _step(self, text: str, i: int, c: str, completed: List[Tuple[str, Any]]):
+        if self._start is None:
+            if c == '{':
+                self._start = i
+                self._depth = 1
+            return
+        if self._in_str:
+            if self._escape:
+                self._escape = False
+            elif c == '\\':
+                self._escape = True
+            elif c == '"':
+                self._in_str = False
+                if self._depth == 1:
+                    self._finish_string(text, i, completed)
+            return
+        if c == '"':
+            self._in_str = True
+            if self._depth == 1 and self._expect in ('key', 'value'):
+                self._token_start = i
+            return
+        if c in '{[':
+            if self._depth == 1 and self._expect == 'value':
+                self._token_start = i
+                self._expect = 'container'
+            self._depth += 1
+            return
+        if c in '}]':
+            self._depth -= 1
+            if self._depth == 1 and self._expect == 'container':
+                self._complete(text[self._token_start:i + 1], completed)
+            elif self._depth == 0:
+                if self._primitive:
+                    self._complete(text[self._token_start:i], completed)
+                self.done = True
+                self._end = i + 1
+            return
+        if self._depth != 1:
+            return
+        if c == ':':
+            self._expect = 'value'
+        elif c == ',':
+            if self._primitive:
+                self._complete(text[self._token_start:i], completed)
+            self._expect = 'key'
+        elif c not in _WHITESPACE and self._expect == 'value' and not self._primitive:
+            # 数字 / true / false / null，到下一个逗号或右括号为止
+            self._token_start = i
+            self._primitive = True
+
+    def _finish_string(self, text: str, i: int, completed: List[Tuple[str, Any]]):
+        raw = text[self._token_start:i + 1]
+        if self._expect == 'key':
+            try:
+                self._key = json.loads(raw)
+            except ValueError:
+                self._key = None
+            self._expect = 'colon'
+        elif self._expect == 'value':
+            self._complete(raw, completed)
+
+    def _complete(self, raw: str, completed: List[Tuple[str, Any]]):
+        self._expect = 'comma'
+        self._primitive = False
+        self._token_start = None
+        if self._key is None:
+            return
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            # 单个字段不合法时跳过，整体结果仍以最终完整解析为准
+            return
+        self.fields[self._key] = value
+        completed.append((self._key, value))
@@ -0,0 +1,337 @@
+"""
+存储生命周期模块
+后台线程定期清理磁盘，多个 gunicorn worker 中同一时间只有拿到 flock 的一个执行，
+每轮结果写入状态文件，任何 worker 的 /health 都能看到：
+    派生文件  导出缓存（RENDER_CACHE_DIR）与多尺寸版本（RENDITIONS_DIR）随时可以重新生成；
+              超过 LIFECYCLE_DERIVED_TTL 秒（默认 7 天）未使用的删除，总量超过 LIFECYCLE_DERIVED_QUOTA_MB
+              （默认 1024）时按最近使用时间（文件 mtime，命中时刷新）从旧到新淘汰到配额的 90%
+    草稿图片  上传超过 LIFECYCLE_DRAFT_TTL 秒（默认 7 天，0 关闭）且没有任何海报引用的图片
+    临时文件  派生目录中原子写入中断后残留超过 1 小时的 *.tmp
+    总配额    LIFECYCLE_DISK_QUOTA_MB（默认 0 不限）超出时压缩派生文件的配额；
+              海报 JSON / PNG 从不删除，只有它们本身超出时在统计中标记 over_quota
+每轮最多删除 LIFECYCLE_BATCH 个文件（默认 200），扫描 / 删除每 100 个文件让出一次 CPU；
+有积压时 LIFECYCLE_BACKLOG_INTERVAL 秒（默认 5）后继续，否则每 LIFECYCLE_INTERVAL 秒（默认 300）一轮
+"""
+import fcntl
+import json
+import multiprocessing
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from poster_store import PosterStore
+from upload_store import UploadStore
+
+# 残留临时文件的保留时间（秒）：比任何一次正常写入都长
+_TMP_MAX_AGE = 3600
+# 空的按海报分组目录保留时间（秒），避免与正在写入的请求竞争
+_EMPTY_DIR_MAX_AGE = 3600
+# 每处理多少个文件让出一次 CPU
+_YIELD_EVERY = 100
+# 每轮最多检查的草稿图片数（被引用的图片会跳过，游标跨轮保存）
+_DRAFT_SCAN_FACTOR = 10
+
+
+class StorageLifecycle:
+    """磁盘配额 + 派生文件 LRU / TTL 淘汰 + 草稿图片过期清理"""
+
+    def __init__(self, posters: PosterStore, uploads: UploadStore, derived_dirs: Dict[str, str], state_dir: str,
+                 interval: Optional[float] = None,
+                 backlog_interval: Optional[float] = None,
+                 batch: Optional[int] = None,
+                 derived_quota_bytes: Optional[int] = None,
+                 derived_ttl: Optional[float] = None,
+                 draft_ttl: Optional[float] = None,
+                 disk_quota_bytes: Optional[int] = None,
+                 pause: Optional[float] = None):
+        """
+        Args:
+            posters: 海报存储（只读取统计与引用索引，从不删除）
+            uploads: 上传图片存储
+            derived_dirs: 名称 → 目录，目录下按海报 id 分组存放可再生文件（导出缓存、多尺寸版本）
+            state_dir: 锁文件与状态文件所在目录（多个 worker 共享）
+            其余参数默认读取模块说明中的同名环境变量；pause 为每批之间让出的秒数，默认 LIFECYCLE_PAUSE 或 0.005
+        """
+        self.posters = posters
+        self.uploads = uploads
+        self.derived_dirs = derived_dirs
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        self.lock_path = os.path.join(state_dir, 'lifecycle.lock')
+        self.state_path = os.path.join(state_dir, 'lifecycle.json')
+        self.interval = interval if interval is not None else float(os.getenv('LIFECYCLE_INTERVAL', '300'))
+        self.backlog_interval = backlog_interval if backlog_interval is not None else float(
+            os.getenv('LIFECYCLE_BACKLOG_INTERVAL', '5'))
+        self.batch = batch or int(os.getenv('LIFECYCLE_BATCH', '200'))
+        self.derived_quota_bytes = derived_quota_bytes if derived_quota_bytes is not None else int(
+            float(os.getenv('LIFECYCLE_DERIVED_QUOTA_MB', '1024')) * 1024 * 1024)
+        self.derived_ttl = derived_ttl if derived_ttl is not None else float(
+            os.getenv('LIFECYCLE_DERIVED_TTL', str(7 * 86400)))
+        self.draft_ttl = draft_ttl if draft_ttl is not None else float(
+            os.getenv('LIFECYCLE_DRAFT_TTL', str(7 * 86400)))
+        self.disk_quota_bytes = disk_quota_bytes if disk_quota_bytes is not None else int(
+            float(os.getenv('LIFECYCLE_DISK_QUOTA_MB', '0')) * 1024 * 1024)
+        self.pause = pause if pause is not None else float(os.getenv('LIFECYCLE_PAUSE', '0.005'))
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        self._warned_references = False
+
+    def start(self):
+        """启动后台清理线程（渲染进程池子进程导入主模块时不启动）"""
+        if multiprocessing.parent_process() is not None:
+            return
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        """懒启动后台线程；gunicorn fork 后按 pid 重新启动"""
+        pid = os.getpid()
+        with self._lock:
+            if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+                return
+            self._thread_pid = pid
+            self._thread = threading.Thread(target=self._run, name='storage-lifecycle', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # 错开各 worker 的首轮时间
+        delay = random.uniform(1, 10)
+        while True:
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            try:
+                state = self.run_once()
+                backlog = bool(state and state.get('backlog'))
+            except Exception as e:
+                print(f"Storage lifecycle sweep failed: {e}")
+                backlog = False
+            delay = self.backlog_interval if backlog else self.interval
+
+    def run_once(self, force: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        执行一轮清理（其他 worker 正在执行，或距上一轮不足 interval 且没有积压时跳过）
+
+        Returns:
+            本轮结束后的状态；跳过时返回 None
+        """
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                previous = self._read_state()
+                finished = previous.get('finished_at') or 0
+                wait = self.backlog_interval if previous.get('backlog') else self.interval
+                if not force and time.time() - finished < wait * 0.9:
+                    return None
+                state = self._sweep(previous)
+                self._write_state(state)
+                return state
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sweep(self, previous: Dict[str, Any]) -> Dict[str, Any]:
+        started = time.time()
+        budget = self.batch
+        evictions = dict(previous.get('evictions') or {})
+        freed = previous.get('bytes_freed') or 0
+        now = time.time()
+
+        def count(kind: str, nbytes: int):
+            nonlocal budget, freed
+            evictions[kind] = evictions.get(kind, 0) + 1
+            freed += nbytes
+            budget -= 1
+            if budget % _YIELD_EVERY == 0:
+                time.sleep(self.pause)
+
+        # 1. 派生文件：扫描大小与最近使用时间，顺带清理残留临时文件与长期空置的分组目录
+        derived_bytes: Dict[str, int] = {}
+        files: List[Tuple[float, int, str, str]] = []
+        scanned = 0
+        for name, directory in self.derived_dirs.items():
+            total = 0
+            for mtime, size, path in self._scan(directory):
+                scanned += 1
+                if scanned % _YIELD_EVERY == 0:
+                    time.sleep(self.pause)
+                if path.endswith('.tmp'):
+                    if now - mtime > _TMP_MAX_AGE and budget > 0 and self._remove(path):
+                        count('tmp', size)
+                    continue
+                total += size
+                files.append((mtime, size, name, path))
+            derived_bytes[name] = total
+
+        # 2. 源数据用量来自索引，不扫描目录
+        poster_stats = self.posters.stats()
+        upload_stats = self.uploads.stats()
+        source_bytes = poster_stats['json_bytes'] + poster_stats['png_bytes'] + upload_stats['bytes']
+        quota = self.derived_quota_bytes
+        if self.disk_quota_bytes:
+            quota = min(quota, max(0, self.disk_quota_bytes - source_bytes))
+
+        # 3. 派生文件先按 TTL，再按 LRU 淘汰到配额的 90%
+        files.sort()
+        derived_total = sum(derived_bytes.values())
+        target = int(quota * 0.9)
+        backlog = False
+        lru = None
+        for mtime, size, name, path in files:
+            expired = self.derived_ttl > 0 and now - mtime > self.derived_ttl
+            if not expired:
+                # 过期文件处理完后仍超出配额才开始 LRU 淘汰
+                if lru is None:
+                    lru = derived_total > quota
+                if not lru or derived_total <= target:
+                    break
+            if budget <= 0:
+                backlog = True
+                break
+            if self._remove(path):
+                derived_total -= size
+                derived_bytes[name] -= size
+                count('derived_ttl' if expired else 'derived_lru', size)
+        for directory in self.derived_dirs.values():
+            self._remove_empty_dirs(directory, now)
+
+        # 4. 草稿图片：过期且没有海报引用
+        cursor = previous.get('draft_cursor')
+        upload_bytes = upload_stats['bytes']
+        if self.draft_ttl > 0 and budget > 0:
+            if self.posters.references_complete():
+                cursor, drafts_backlog, released = self._evict_drafts(now - self.draft_ttl, cursor, budget, count)
+                upload_bytes -= released
+                backlog = backlog or drafts_backlog
+            elif not self._warned_references:
+                self._warned_references = True
+                print("Storage lifecycle: poster image references are incomplete, skipping draft cleanup "
+                      "(run `python poster_store.py migrate`)")
+
+        used = {
+            'posters': poster_stats['json_bytes'] + poster_stats['png_bytes'],
+            'uploads': upload_bytes,
+            **derived_bytes,
+        }
+        used['total'] = used['posters'] + used['uploads'] + derived_total
+        return {
+            'finished_at': time.time(),
+            'duration_ms': round((time.time() - started) * 1000, 1),
+            'pid': os.getpid(),
+            'backlog': backlog,
+            'bytes_used': used,
+            'derived_quota_bytes': quota,
+            'over_quota': bool(self.disk_quota_bytes) and used['total'] > self.disk_quota_bytes,
+            'evictions': evictions,
+            'bytes_freed': freed,
+            'draft_cursor': cursor,
+        }
+
+    def _evict_drafts(self, before: float, cursor: Optional[List[Any]], budget: int, count):
+        """
+        从游标处起检查过期图片，删除没有海报引用的；到达末尾后游标归零
+
+        Returns:
+            (新游标, 是否还有积压, 释放的字节数)
+        """
+        checked = 0
+        released = 0
+        limit = min(100, budget)
+        while budget > 0 and checked < self.batch * _DRAFT_SCAN_FACTOR:
+            records = self.uploads.expired(before, limit=limit, after=tuple(cursor) if cursor else None)
+            if not records:
+                return None, False, released
+            checked += len(records)
+            cursor = [records[-1]['created_at'], records[-1]['image_id']]
+            referenced = self.posters.referenced_images([r['image_id'] for r in records])
+            for record in records:
+                if record['image_id'] in referenced or record['used_at'] >= before:
+                    continue
+                if budget <= 0:
+                    return cursor, True, released
+                nbytes = self.uploads.evict(record['image_id'], unused_since=before, refcount=record['refcount'])
+                if not nbytes:
+                    # 扫描之后被重复上传复用（或已被删除）
+                    continue
+                released += nbytes
+                budget -= 1
+                count('drafts', nbytes)
+        return cursor, True, released
+
+    @staticmethod
+    def _scan(directory: str):
+        """遍历 <目录>/<海报 id>/<文件>，产出 (mtime, 字节数, 路径)"""
+        try:
+            groups = list(os.scandir(directory))
+        except FileNotFoundError:
+            return
+        for group in groups:
+            try:
+                if not group.is_dir():
+                    continue
+                entries = list(os.scandir(group.path))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if entry.is_file():
+                    yield st.st_mtime, st.st_size, entry.path
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _remove_empty_dirs(directory: str, now: float):
+        try:
+            groups = list(os.scandir(directory))
+        except FileNotFoundError:
+            return
+        for group in groups:
+            try:
+                if group.is_dir() and now - group.stat().st_mtime > _EMPTY_DIR_MAX_AGE:
+                    os.rmdir(group.path)
+            except OSError:
+                # 非空或正在被使用
+                pass
+
+    def _read_state(self) -> Dict[str, Any]:
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self, state: Dict[str, Any]):
+        tmp_path = f"{self.state_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def stats(self) -> Dict[str, Any]:
+        """最近一轮清理的结果（来自共享状态文件）与当前配置"""
+        state = self._read_state()
+        state.pop('draft_cursor', None)
+        return {
+            **state,
+            'config': {
+                'interval': self.interval,
+                'batch': self.batch,
+                'derived_quota_bytes': self.derived_quota_bytes,
+                'derived_ttl': self.derived_ttl,
+                'draft_ttl': self.draft_ttl,
+                'disk_quota_bytes': self.disk_quota_bytes,
+            },
+        }
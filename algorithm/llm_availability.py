@@ -0,0 +1,134 @@
+"""
+LLM 可用性状态模块
+后台线程按间隔探测 LLM API，结果带 TTL 缓存；真实调用的成功/失败被动更新状态。
+/health、/generate 只读缓存状态，不在请求线程里发起探测调用
+"""
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+class AvailabilityMonitor:
+    """LLM 可用性状态：后台探测 + TTL 缓存 + 真实调用被动更新"""
+
+    def __init__(self, probe: Callable[[], bool], enabled: bool = True,
+                 interval: Optional[float] = None,
+                 failure_interval: Optional[float] = None,
+                 ttl: Optional[float] = None,
+                 failure_threshold: Optional[int] = None):
+        """
+        Args:
+            probe: 实际探测函数，返回 True 表示可用
+            enabled: 未配置 API key 时为 False，直接视为不可用且不启动探测线程
+            interval: 可用状态下的探测间隔（秒），默认 LLM_PROBE_INTERVAL 或 60
+            failure_interval: 不可用状态下的重试间隔（秒），默认 LLM_PROBE_FAILURE_INTERVAL 或 15
+            ttl: 缓存状态的有效期（秒），默认 LLM_PROBE_TTL 或 180；过期视为未知
+            failure_threshold: 连续多少次真实调用失败后标记为不可用，默认 LLM_FAILURE_THRESHOLD 或 2
+        """
+        self._probe = probe
+        self.enabled = enabled
+        self.interval = interval if interval is not None else float(os.getenv('LLM_PROBE_INTERVAL', '60'))
+        self.failure_interval = failure_interval if failure_interval is not None else float(
+            os.getenv('LLM_PROBE_FAILURE_INTERVAL', '15'))
+        self.ttl = ttl if ttl is not None else float(os.getenv('LLM_PROBE_TTL', '180'))
+        self.failure_threshold = failure_threshold if failure_threshold is not None else int(
+            os.getenv('LLM_FAILURE_THRESHOLD', '2'))
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._available: Optional[bool] = None
+        self._checked_at = 0.0
+        self._source: Optional[str] = None
+        self._consecutive_failures = 0
+        self._last_error: Optional[str] = None
+        self._probe_count = 0
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+
+    def is_available(self) -> bool:
+        """读取缓存的可用性，不阻塞。尚未探测或已过期时乐观返回 True，由真实调用被动纠正"""
+        if not self.enabled:
+            return False
+        self._ensure_prober()
+        with self._lock:
+            if self._available is None or time.time() - self._checked_at > self.ttl:
+                return True
+            return self._available
+
+    def record_success(self):
+        """真实调用成功：标记可用，推迟下一次主动探测"""
+        self._update(True, 'call')
+
+    def record_failure(self, error: Any = None):
+        """真实调用失败：连续失败达到阈值后标记不可用，并唤醒探测线程按失败间隔重试"""
+        with self._lock:
+            self._consecutive_failures += 1
+            self._last_error = str(error) if error is not None else None
+            if self._consecutive_failures < self.failure_threshold:
+                return
+            self._available = False
+            self._checked_at = time.time()
+            self._source = 'call'
+        self._wakeup.set()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """当前状态（供 /health 展示）"""
+        with self._lock:
+            checked_at = self._checked_at
+            return {
+                'available': self._available if self.enabled else False,
+                'source': self._source,
+                'age_seconds': round(time.time() - checked_at, 1) if checked_at else None,
+                'consecutive_failures': self._consecutive_failures,
+                'last_error': self._last_error,
+                'probes': self._probe_count,
+            }
+
+    def _update(self, available: bool, source: str, error: Any = None):
+        with self._lock:
+            self._available = available
+            self._checked_at = time.time()
+            self._source = source
+            if available:
+                self._consecutive_failures = 0
+                self._last_error = None
+            else:
+                self._last_error = str(error) if error is not None else self._last_error
+
+    def _ensure_prober(self):
+        """懒启动探测线程；gunicorn fork 后线程不会被继承，按 pid 判断是否需要重新启动"""
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+                return
+            self._thread_pid = pid
+            self._thread = threading.Thread(target=self._run, name='llm-availability-probe', daemon=True)
+            self._thread.start()
+
+    def _next_probe_delay(self) -> float:
+        with self._lock:
+            if self._available is None:
+                return 0.0
+            interval = self.interval if self._available else self.failure_interval
+            return max(0.0, self._checked_at + interval - time.time())
+
+    def _run(self):
+        while True:
+            delay = self._next_probe_delay()
+            if delay > 0:
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                # 被唤醒或期间有真实调用更新了状态，重新计算下一次探测时间
+                if self._next_probe_delay() > 0:
+                    continue
+            try:
+                ok = bool(self._probe())
+                error = None if ok else 'probe failed'
+            except Exception as e:
+                ok, error = False, e
+            with self._lock:
+                self._probe_count += 1
+            self._update(ok, 'probe', error)
@@ -0,0 +1,402 @@
+"""
+LLM 提供商模块
+每个提供商封装为一个类，统一提供 complete（整段文本）/ stream（增量文本）/ probe（可用性探测）：
+    dashscope  通义千问
+    zhipu      智谱 AI
+    baidu      百度文心一言
+    openai     任意 OpenAI 兼容接口（LLM_BASE_URL，如 DeepSeek、Moonshot、本地 vLLM）
+    fake       本地假提供商，不发网络请求，用于开发与联调
+主提供商由 LLM_PROVIDER / LLM_API_KEY / LLM_MODEL 配置；LLM_FALLBACK_PROVIDERS（逗号分隔）
+按顺序追加备用提供商，各自读取 LLM_<PROVIDER>_API_KEY / LLM_<PROVIDER>_MODEL / LLM_<PROVIDER>_BASE_URL
+"""
+import json
+import os
+import random
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from llm_transport import ProviderTransport, TokenCache
+
+# 百度 access_token 失效 / 过期的错误码
+BAIDU_TOKEN_ERRORS = (110, 111)
+
+
+def iter_sse(response) -> Iterator[Dict[str, Any]]:
+    """解析 SSE 响应中的 data: 事件（[DONE] 结束）"""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        payload = line[5:].strip()
+        if payload == '[DONE]':
+            break
+        try:
+            yield json.loads(payload)
+        except ValueError:
+            # 非 JSON 的事件（如心跳）跳过，不影响增量解析
+            continue
+
+
+class LLMProvider:
+    """提供商基类"""
+
+    name = ''
+    default_model: Optional[str] = None
+
+    def __init__(self, api_key: str = '', model: Optional[str] = None):
+        self.api_key = api_key
+        self.model = model or self.default_model
+
+    @property
+    def enabled(self) -> bool:
+        """配置了 API key 才参与路由"""
+        return bool(self.api_key)
+
+    def complete(self, system_prompt: str, user_prompt: str) -> str:
+        """一次性调用，返回完整回复文本"""
+        raise NotImplementedError
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        """流式调用，逐段产出增量文本；默认退化为一次性调用"""
+        yield self.complete(system_prompt, user_prompt)
+
+    def probe(self) -> bool:
+        """探测 API 是否可用（由后台探测线程调用）"""
+        return self.enabled
+
+    def transport_stats(self) -> Optional[Dict[str, Any]]:
+        """连接池状态；不经过 HTTP 连接池的提供商返回 None"""
+        return None
+
+
+class DashScopeProvider(LLMProvider):
+    """通义千问（dashscope SDK）"""
+
+    name = 'dashscope'
+    default_model = 'qwen-turbo'
+
+    def complete(self, system_prompt: str, user_prompt: str) -> str:
+        import dashscope
+
+        response = dashscope.Generation.call(
+            api_key=self.api_key,
+            model=self.model,
+            messages=self._messages(system_prompt, user_prompt),
+            result_format='message'
+        )
+        if response.status_code != 200:
+            raise Exception(f"DashScope API error: {response.message}")
+        return response.output.choices[0].message.content
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        import dashscope
+
+        responses = dashscope.Generation.call(
+            api_key=self.api_key,
+            model=self.model,
+            messages=self._messages(system_prompt, user_prompt),
+            result_format='message',
+            stream=True,
+            incremental_output=True
+        )
+        for response in responses:
+            if response.status_code != 200:
+                raise Exception(f"DashScope API error: {response.message}")
+            yield response.output.choices[0].message.content or ''
+
+    def probe(self) -> bool:
+        if not self.enabled:
+            return False
+        try:
+            import dashscope
+            response = dashscope.Generation.call(
+                api_key=self.api_key,
+                model=self.model,
+                prompt='test',
+                max_tokens=1
+            )
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    @staticmethod
+    def _messages(system_prompt: str, user_prompt: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+
+
+class OpenAICompatibleProvider(LLMProvider):
+    """OpenAI 兼容的 /chat/completions 接口（SSE 流式）"""
+
+    name = 'openai'
+    default_model = 'gpt-4o-mini'
+
+    def __init__(self, api_key: str = '', model: Optional[str] = None, base_url: str = ''):
+        super().__init__(api_key, model)
+        self.base_url = (base_url or '').rstrip('/')
+        self.transport = ProviderTransport(self.name)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.api_key and self.base_url)
+
+    def complete(self, system_prompt: str, user_prompt: str) -> str:
+        response = self.transport.post(
+            f"{self.base_url}/chat/completions",
+            json=self._payload(system_prompt, user_prompt, stream=False),
+            headers=self._headers()
+        )
+        response.raise_for_status()
+        return response.json()['choices'][0]['message']['content']
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        with self.transport.post(
+            f"{self.base_url}/chat/completions",
+            json=self._payload(system_prompt, user_prompt, stream=True),
+            headers=self._headers(),
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            for event in iter_sse(response):
+                choices = event.get('choices') or [{}]
+                delta = choices[0].get('delta') or {}
+                yield delta.get('content') or ''
+
+    def probe(self) -> bool:
+        if not self.enabled:
+            return False
+        try:
+            response = self.transport.get(f"{self.base_url}/models", headers=self._headers(), timeout=5)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    def transport_stats(self) -> Optional[Dict[str, Any]]:
+        return self.transport.stats()
+
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def _payload(self, system_prompt: str, user_prompt: str, stream: bool) -> Dict[str, Any]:
+        data = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": 0.7
+        }
+        if stream:
+            data["stream"] = True
+        return data
+
+
+class ZhipuProvider(OpenAICompatibleProvider):
+    """智谱 AI（接口与 OpenAI 兼容，地址固定）"""
+
+    name = 'zhipu'
+    default_model = 'glm-4'
+
+    def __init__(self, api_key: str = '', model: Optional[str] = None, base_url: str = ''):
+        super().__init__(api_key, model, base_url or "https://open.bigmodel.cn/api/paas/v4")
+
+
+class BaiduProvider(LLMProvider):
+    """百度文心一言（access_token 鉴权，缓存到到期前再刷新）"""
+
+    name = 'baidu'
+    url = "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions"
+
+    def __init__(self, api_key: str = '', model: Optional[str] = None, secret_key: Optional[str] = None):
+        super().__init__(api_key, model)
+        self.secret_key = secret_key if secret_key is not None else os.getenv('BAIDU_SECRET_KEY', '')
+        self.transport = ProviderTransport(self.name)
+        # 百度 access_token 有效期按天计，缓存到到期前再刷新
+        self.token = TokenCache(self._fetch_token)
+
+    def complete(self, system_prompt: str, user_prompt: str) -> str:
+        result = self._request(self._payload(system_prompt, user_prompt, stream=False)).json()
+        if 'error_code' in result:
+            raise Exception(f"Baidu API error: {result.get('error_msg')}")
+        return result['result']
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        with self._request(self._payload(system_prompt, user_prompt, stream=True), stream=True) as response:
+            if response.headers.get('Content-Type', '').startswith('application/json'):
+                # 出错时返回普通 JSON 而不是事件流
+                result = response.json()
+                raise Exception(f"Baidu API error: {result.get('error_msg', result)}")
+            for event in iter_sse(response):
+                if 'error_code' in event:
+                    raise Exception(f"Baidu API error: {event.get('error_msg')}")
+                yield event.get('result') or ''
+                if event.get('is_end'):
+                    break
+
+    def transport_stats(self) -> Optional[Dict[str, Any]]:
+        stats = self.transport.stats()
+        stats['token'] = self.token.stats()
+        return stats
+
+    @staticmethod
+    def _payload(system_prompt: str, user_prompt: str, stream: bool) -> Dict[str, Any]:
+        # 文心接口没有 system 角色，系统提示词并入用户消息
+        data = {
+            "messages": [
+                {"role": "user", "content": f"{system_prompt}\n\n用户需求：{user_prompt}"}
+            ],
+            "temperature": 0.7
+        }
+        if stream:
+            data["stream"] = True
+        return data
+
+    def _request(self, data: Dict[str, Any], stream: bool = False):
+        """
+        带 access_token 调用文心接口；token 被服务端判定失效时清除缓存并重试一次
+        （流式请求出错时同样返回普通 JSON，错误码判断对两种请求都适用）
+        """
+        for attempt in range(2):
+            response = self.transport.post(
+                self.url, params={'access_token': self.token.get()}, json=data, stream=stream
+            )
+            response.raise_for_status()
+            if attempt == 0 and response.headers.get('Content-Type', '').startswith('application/json'):
+                try:
+                    error_code = response.json().get('error_code')
+                except ValueError:
+                    error_code = None
+                if error_code in BAIDU_TOKEN_ERRORS:
+                    response.close()
+                    self.token.invalidate()
+                    continue
+            return response
+        return response
+
+    def _fetch_token(self) -> Tuple[str, float]:
+        """向百度 OAuth 接口申请 access_token，返回 (token, 有效期秒数)"""
+        response = self.transport.post(
+            "https://aip.baidubce.com/oauth/2.0/token",
+            params={
+                "grant_type": "client_credentials",
+                "client_id": self.api_key,
+                "client_secret": self.secret_key
+            },
+            timeout=10
+        )
+        response.raise_for_status()
+
+        result = response.json()
+        if 'access_token' not in result:
+            raise Exception(f"Baidu token error: {result.get('error_description', result)}")
+        # 文心 token 默认 30 天有效
+        return result['access_token'], float(result.get('expires_in', 2592000))
+
+
+class FakeProvider(LLMProvider):
+    """
+    本地假提供商：按设定的延迟分段输出固定的设计 JSON，可按概率失败。
+    用于没有 API key 时联调流水线，或观察路由的对冲 / 熔断行为
+    """
+
+    name = 'fake'
+    default_model = 'fake'
+
+    def __init__(self, api_key: str = '', model: Optional[str] = None,
+                 delay: Optional[float] = None, failure_rate: Optional[float] = None,
+                 text: Optional[str] = None, name: Optional[str] = None):
+        """
+        Args:
+            delay: 整个回复的耗时（秒），默认 LLM_FAKE_DELAY 或 0.5
+            failure_rate: 失败概率 0~1，默认 LLM_FAKE_FAILURE_RATE 或 0
+            text: 回复文本，默认一份固定的设计 JSON
+            name: 同时注册多个假提供商时用于区分
+        """
+        super().__init__(api_key or 'fake', model)
+        if name:
+            self.name = name
+        self.delay = delay if delay is not None else float(os.getenv('LLM_FAKE_DELAY', '0.5'))
+        self.failure_rate = failure_rate if failure_rate is not None else float(
+            os.getenv('LLM_FAKE_FAILURE_RATE', '0'))
+        self.text = text if text is not None else json.dumps({
+            "template_id": "template_001",
+            "color_scheme": {"primary": "#4A90E2", "secondary": "#FFFFFF", "accent": "#FFD700"},
+            "title": "示例海报",
+            "subtitle": "本地假提供商生成",
+            "description": "未调用真实 LLM，仅用于联调",
+            "layout": "vertical",
+            "elements": []
+        }, ensure_ascii=False)
+        self.calls = 0
+
+    def complete(self, system_prompt: str, user_prompt: str) -> str:
+        return ''.join(self.stream(system_prompt, user_prompt))
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        self.calls += 1
+        if self.failure_rate and random.random() < self.failure_rate:
+            time.sleep(self.delay / 2)
+            raise Exception(f"{self.name} provider simulated failure")
+        chunks = [self.text[i:i + 16] for i in range(0, len(self.text), 16)] or ['']
+        for chunk in chunks:
+            time.sleep(self.delay / len(chunks))
+            yield chunk
+
+
+PROVIDER_CLASSES = {
+    'dashscope': DashScopeProvider,
+    'zhipu': ZhipuProvider,
+    'baidu': BaiduProvider,
+    'openai': OpenAICompatibleProvider,
+    'fake': FakeProvider,
+}
+
+
+def create_provider(name: str, primary: bool = False) -> LLMProvider:
+    """
+    按环境变量创建提供商
+
+    Args:
+        name: 提供商名称（见 PROVIDER_CLASSES）
+        primary: 主提供商额外回退读取不带前缀的 LLM_API_KEY / LLM_MODEL / LLM_BASE_URL
+
+    Raises:
+        ValueError: 未知的提供商
+    """
+    cls = PROVIDER_CLASSES.get(name)
+    if cls is None:
+        raise ValueError(f"Unsupported provider: {name}")
+
+    def setting(key: str) -> str:
+        value = os.getenv(f'LLM_{name.upper()}_{key}', '')
+        if not value and primary:
+            value = os.getenv(f'LLM_{key}', '')
+        return value
+
+    kwargs: Dict[str, Any] = {'api_key': setting('API_KEY'), 'model': setting('MODEL') or None}
+    if cls is OpenAICompatibleProvider or cls is ZhipuProvider:
+        kwargs['base_url'] = setting('BASE_URL')
+    return cls(**kwargs)
+
+
+def load_providers() -> List[LLMProvider]:
+    """按路由优先级返回主提供商 + 备用提供商（忽略未知名称与重复项）"""
+    primary = os.getenv('LLM_PROVIDER', 'dashscope').lower()
+    names = [primary] + [
+        n.strip().lower() for n in os.getenv('LLM_FALLBACK_PROVIDERS', '').split(',') if n.strip()
+    ]
+    providers: List[LLMProvider] = []
+    seen = set()
+    for i, name in enumerate(names):
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            providers.append(create_provider(name, primary=(i == 0)))
+        except ValueError as e:
+            print(f"Skipping LLM provider: {e}")
+    return providers
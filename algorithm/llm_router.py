@@ -0,0 +1,339 @@
+"""
+LLM 提供商路由模块
+按优先级依次使用提供商，每个提供商统计滑动窗口内的延迟分位数与错误率，并带熔断器：
+    熔断      连续失败 LLM_BREAKER_FAILURES 次（默认 3）后打开，LLM_BREAKER_COOLDOWN 秒（默认 30）
+              内跳过该提供商；冷却后放行一个试探请求，成功则恢复
+    对冲      首选提供商超过其 p95 延迟（LLM_HEDGE_PERCENTILE，默认 95）仍未返回时，
+              向下一个提供商并发发出同一请求，先成功者胜出；样本不足 LLM_HEDGE_MIN_SAMPLES（默认 10）
+              时用 LLM_HEDGE_DELAY（默认 10 秒），下限 LLM_HEDGE_MIN_DELAY（默认 1 秒），LLM_HEDGE=0 关闭
+    故障转移  正在进行的请求全部失败时立即换下一个提供商
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from llm_providers import LLMProvider
+
+
+class HedgeCancelled(Exception):
+    """对冲中落败的请求被主动取消（不计入错误）"""
+
+
+class LatencyWindow:
+    """滑动窗口内的调用结果：延迟分位数与错误率"""
+
+    def __init__(self, size: int):
+        self._lock = threading.Lock()
+        # (耗时秒数, 结果)；结果为 'ok' / 'invalid'（有响应但不是合法 JSON）/ 'error'
+        self._samples: deque = deque(maxlen=size)
+        self.total = 0
+        self.errors = 0
+        self.invalid = 0
+        self.cancelled = 0
+
+    def record(self, latency: float, outcome: str):
+        with self._lock:
+            if outcome == 'cancelled':
+                self.cancelled += 1
+                return
+            self._samples.append((latency, outcome))
+            self.total += 1
+            if outcome == 'error':
+                self.errors += 1
+            elif outcome == 'invalid':
+                self.invalid += 1
+
+    def percentile(self, p: float) -> Optional[float]:
+        """有响应的调用的延迟分位数（秒）；没有样本时返回 None"""
+        with self._lock:
+            latencies = sorted(t for t, outcome in self._samples if outcome != 'error')
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, max(0, int(round(p / 100 * len(latencies))) - 1))
+        return latencies[index]
+
+    def responded(self) -> int:
+        with self._lock:
+            return sum(1 for _, outcome in self._samples if outcome != 'error')
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            window = len(self._samples)
+            errors = sum(1 for _, outcome in self._samples if outcome == 'error')
+            total, total_errors, invalid, cancelled = self.total, self.errors, self.invalid, self.cancelled
+
+        def ms(p: float) -> Optional[float]:
+            value = self.percentile(p)
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            'calls': total,
+            'errors': total_errors,
+            'invalid': invalid,
+            'cancelled': cancelled,
+            'window': window,
+            'error_rate': round(errors / window, 3) if window else 0.0,
+            'p50_ms': ms(50),
+            'p95_ms': ms(95),
+            'p99_ms': ms(99),
+        }
+
+
+class CircuitBreaker:
+    """熔断器：closed → open（连续失败）→ half_open（冷却后放行一个试探请求）"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.opens = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.time() - self._opened_at >= self.cooldown:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """是否放行一个请求；半开状态同一时间只放行一个试探请求"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.time() - self._opened_at < self.cooldown:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.opens += 1
+                self._state = self.OPEN
+                self._opened_at = time.time()
+                self._trial_in_flight = False
+
+    def release(self):
+        """请求被取消、没有结论时归还试探名额"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        state = self.state
+        with self._lock:
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'opens': self.opens,
+            }
+
+
+class ProviderRouter:
+    """按优先级路由到多个提供商：统计 + 熔断 + 对冲 + 故障转移"""
+
+    def __init__(self, providers: List[LLMProvider],
+                 hedge: Optional[bool] = None,
+                 hedge_percentile: Optional[float] = None,
+                 hedge_delay: Optional[float] = None,
+                 hedge_min_delay: Optional[float] = None,
+                 hedge_min_samples: Optional[int] = None,
+                 window: Optional[int] = None,
+                 breaker_failures: Optional[int] = None,
+                 breaker_cooldown: Optional[float] = None,
+                 max_workers: Optional[int] = None):
+        """
+        Args:
+            providers: 按优先级排列的提供商
+            其余参数默认读取模块说明中的同名环境变量；window 默认 LLM_STATS_WINDOW 或 100，
+            max_workers 默认 LLM_ROUTER_WORKERS 或 16
+        """
+        self.providers = providers
+        self.hedge = hedge if hedge is not None else os.getenv('LLM_HEDGE', '1').lower() not in ('0', 'false', 'no')
+        self.hedge_percentile = hedge_percentile if hedge_percentile is not None else float(
+            os.getenv('LLM_HEDGE_PERCENTILE', '95'))
+        self.hedge_delay = hedge_delay if hedge_delay is not None else float(os.getenv('LLM_HEDGE_DELAY', '10'))
+        self.hedge_min_delay = hedge_min_delay if hedge_min_delay is not None else float(
+            os.getenv('LLM_HEDGE_MIN_DELAY', '1'))
+        self.hedge_min_samples = hedge_min_samples if hedge_min_samples is not None else int(
+            os.getenv('LLM_HEDGE_MIN_SAMPLES', '10'))
+        window = window or int(os.getenv('LLM_STATS_WINDOW', '100'))
+        failures = breaker_failures or int(os.getenv('LLM_BREAKER_FAILURES', '3'))
+        cooldown = breaker_cooldown if breaker_cooldown is not None else float(
+            os.getenv('LLM_BREAKER_COOLDOWN', '30'))
+        self.max_workers = max_workers or int(os.getenv('LLM_ROUTER_WORKERS', '16'))
+        self.latency = {p.name: LatencyWindow(window) for p in providers}
+        self.breakers = {p.name: CircuitBreaker(failures, cooldown) for p in providers}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    @property
+    def enabled(self) -> bool:
+        return any(p.enabled for p in self.providers)
+
+    def hedge_deadline(self, provider: LLMProvider) -> float:
+        """该提供商多久未返回就发出对冲请求（秒）"""
+        window = self.latency[provider.name]
+        delay = None
+        if window.responded() >= self.hedge_min_samples:
+            delay = window.percentile(self.hedge_percentile)
+        if delay is None:
+            delay = self.hedge_delay
+        return max(self.hedge_min_delay, delay)
+
+    def call(self, fn: Callable[[LLMProvider, threading.Event], Any]) -> Tuple[Any, str]:
+        """
+        路由一次调用
+
+        Args:
+            fn: fn(提供商, 取消事件) 执行实际调用；取消事件被设置时应尽快放弃（抛出 HedgeCancelled）
+
+        Returns:
+            (结果, 胜出的提供商名称)
+
+        Raises:
+            Exception: 所有可用提供商都失败；只要有提供商返回了响应（ValueError）就优先抛出它
+        """
+        candidates = iter([p for p in self.providers if p.enabled])
+        cancel = threading.Event()
+        pending: Dict[Future, LLMProvider] = {}
+        errors: List[Exception] = []
+
+        def launch() -> Optional[LLMProvider]:
+            for provider in candidates:
+                if self.breakers[provider.name].allow():
+                    pending[self._get_executor().submit(self._attempt, provider, fn, cancel)] = provider
+                    return provider
+            return None
+
+        current = launch()
+        if current is None:
+            raise Exception("No LLM provider available (not configured or circuit open)")
+        started = time.time()
+        hedged = not self.hedge
+        hedge_provider = None
+        try:
+            while pending:
+                timeout = None
+                if not hedged:
+                    timeout = max(0.0, started + self.hedge_deadline(current) - time.time())
+                done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    # 首选提供商超过对冲期限仍未返回
+                    hedged = True
+                    hedge_provider = launch()
+                    if hedge_provider is not None:
+                        with self._lock:
+                            self.hedges += 1
+                    continue
+                for future in done:
+                    provider = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        errors.append(e)
+                        continue
+                    if provider is hedge_provider:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return result, provider.name
+                if not pending:
+                    # 进行中的请求全部失败，立即换下一个提供商，并重新计算对冲期限
+                    current = launch()
+                    if current is not None:
+                        with self._lock:
+                            self.failovers += 1
+                        started = time.time()
+                        hedged = not self.hedge
+        finally:
+            # 已有结果或全部失败：通知落败的请求停止消费
+            cancel.set()
+        for e in errors:
+            if isinstance(e, ValueError):
+                raise e
+        if errors:
+            raise errors[-1]
+        raise Exception("No LLM provider available (not configured or circuit open)")
+
+    def _attempt(self, provider: LLMProvider, fn: Callable[[LLMProvider, threading.Event], Any],
+                 cancel: threading.Event) -> Any:
+        """在工作线程中执行一次调用，并记录延迟 / 结果 / 熔断状态"""
+        start = time.perf_counter()
+        breaker = self.breakers[provider.name]
+        window = self.latency[provider.name]
+        try:
+            result = fn(provider, cancel)
+        except HedgeCancelled:
+            window.record(time.perf_counter() - start, 'cancelled')
+            breaker.release()
+            raise
+        except ValueError:
+            # 有响应但内容不合法：提供商本身可用
+            window.record(time.perf_counter() - start, 'invalid')
+            breaker.record_success()
+            raise
+        except Exception as e:
+            window.record(time.perf_counter() - start, 'error')
+            breaker.record_failure()
+            print(f"LLM provider {provider.name} failed: {e}")
+            raise
+        window.record(time.perf_counter() - start, 'ok')
+        breaker.record_success()
+        return result
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """懒创建线程池；gunicorn fork 后线程不会被继承，按 pid 重新创建"""
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix='llm-router')
+                    self._executor_pid = pid
+        return self._executor
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {'hedges': self.hedges, 'hedge_wins': self.hedge_wins, 'failovers': self.failovers}
+        return {
+            'order': [p.name for p in self.providers if p.enabled],
+            'hedge': self.hedge,
+            **counters,
+            'providers': {
+                p.name: {
+                    'enabled': p.enabled,
+                    'model': p.model,
+                    **self.latency[p.name].stats(),
+                    'breaker': self.breakers[p.name].stats(),
+                    'hedge_deadline_ms': round(self.hedge_deadline(p) * 1000, 1),
+                }
+                for p in self.providers
+            },
+        }
@@ -1,102 +1,37 @@
 """
 LLM 服务模块
-支持多个国内 API 提供商
+支持多个国内 API 提供商及 OpenAI 兼容接口，经路由做熔断、对冲与故障转移
 """
 import os
 import json
-import requests
-from typing import Dict, Any, Optional
+import hashlib
+import threading
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple, Union
 from dotenv import load_dotenv
 
-load_dotenv()
+from design_cache import DesignCache
+from json_stream import IncrementalJSONParser
+from llm_availability import AvailabilityMonitor
+from llm_providers import LLMProvider, load_providers
+from llm_router import HedgeCancelled, ProviderRouter
 
+load_dotenv()
 
-class LLMService:
-    """LLM 服务，支持多个 API 提供商"""
-    
-    def __init__(self):
-        self.provider = os.getenv('LLM_PROVIDER', 'dashscope').lower()
-        self.api_key = os.getenv('LLM_API_KEY', '')
-        self.model = os.getenv('LLM_MODEL', 'qwen-turbo')
-        self.base_url = os.getenv('LLM_BASE_URL', '')
-        self.enabled = bool(self.api_key)
-    
-    def is_available(self) -> bool:
-        """检查 API 是否可用"""
-        if not self.enabled:
-            return False
-        
-        try:
-            # 简单的健康检查：尝试调用 API
-            if self.provider == 'dashscope':
-                return self._check_dashscope()
-            elif self.provider == 'zhipu':
-                return self._check_zhipu()
-            elif self.provider == 'baidu':
-                return self._check_baidu()
-            else:
-                return False
-        except Exception:
-            return False
-    
-    def _check_dashscope(self) -> bool:
-        """检查通义千问 API"""
-        try:
-            import dashscope
-            dashscope.api_key = self.api_key
-            response = dashscope.Generation.call(
-                model=self.model,
-                prompt='test',
-                max_tokens=1
-            )
-            return response.status_code == 200
-        except Exception:
-            return False
-    
-    def _check_zhipu(self) -> bool:
-        """检查智谱 AI API"""
-        try:
-            url = "https://open.bigmodel.cn/api/paas/v4/models"
-            headers = {
-                "Authorization": f"Bearer {self.api_key}"
-            }
-            response = requests.get(url, headers=headers, timeout=5)
-            return response.status_code == 200
-        except Exception:
-            return False
-    
-    def _check_baidu(self) -> bool:
-        """检查百度文心一言 API"""
-        # 百度 API 需要 access_token，这里简化检查
-        return bool(self.api_key)
-    
-    def generate_poster_design(self, user_prompt: str) -> Dict[str, Any]:
-        """
-        根据用户需求生成海报设计方案
-        
-        Args:
-            user_prompt: 用户输入的需求描述
-            
-        Returns:
-            海报设计方案字典
-        """
-        if not self.is_available():
-            raise Exception("LLM API not available")
-        
-        system_prompt = """你是一个专业的海报设计师。根据用户的具体需求，生成海报设计方案。
+# 海报设计系统提示词；修改后版本号随之变化，旧的设计缓存自动失效
+SYSTEM_PROMPT = """你是一个专业的海报设计师。根据用户的具体需求，生成海报设计方案。
 重要：title、subtitle、description 必须根据用户输入来写，不能使用示例占位文字（如"标题内容"、"海报主标题"）。每条用户需求都要得到不同的、与之对应的文案。
 template_id 根据内容选择：template_001 活动/竖版、template_002 产品/横版、template_003 节日/方形。color_scheme 的 primary/secondary 可根据主题换不同颜色（如节日用红金、产品用蓝白）。
-请只返回一个 JSON 对象，不要其他说明。格式如下：
+请只返回一个 JSON 对象，不要其他说明，字段按下面的顺序输出。格式如下：
 {
-    "title": "根据用户需求写的标题",
-    "subtitle": "根据用户需求写的副标题",
-    "description": "根据用户需求写的描述",
     "template_id": "template_001 或 template_002 或 template_003",
     "color_scheme": {
         "primary": "#4A90E2",
         "secondary": "#FFFFFF",
         "accent": "#FFD700"
     },
+    "title": "根据用户需求写的标题",
+    "subtitle": "根据用户需求写的副标题",
+    "description": "根据用户需求写的描述",
     "layout": "vertical",
     "elements": [
         {
@@ -108,107 +43,213 @@ template_id 根据内容选择：template_001 活动/竖版、template_002 产
         }
     ]
 }"""
-        
-        try:
-            if self.provider == 'dashscope':
-                return self._call_dashscope(system_prompt, user_prompt)
-            elif self.provider == 'zhipu':
-                return self._call_zhipu(system_prompt, user_prompt)
-            elif self.provider == 'baidu':
-                return self._call_baidu(system_prompt, user_prompt)
-            else:
-                raise Exception(f"Unsupported provider: {self.provider}")
-        except Exception as e:
-            raise Exception(f"LLM API call failed: {str(e)}")
+
+SYSTEM_PROMPT_VERSION = hashlib.sha1(SYSTEM_PROMPT.encode('utf-8')).hexdigest()[:12]
+
+# 一次调用生成多个备选方案时追加的要求（{count} 为方案数）
+VARIANTS_PROMPT = """
+本次需要 {count} 个互不相同的备选方案：template_id、配色与文案角度都应有明显区别。
+请只返回一个 JSON 对象 {"variants": [方案1, 方案2, ...]}，数组中每一项都是上面格式的完整方案，共 {count} 项。"""
+
+VARIANTS_PROMPT_VERSION = hashlib.sha1((SYSTEM_PROMPT + VARIANTS_PROMPT).encode('utf-8')).hexdigest()[:12]
+
+# 单次调用最多请求的方案数
+MAX_VARIANTS = int(os.getenv('LLM_MAX_VARIANTS', '6'))
+
+
+class LLMService:
+    """LLM 服务，按优先级路由到多个 API 提供商"""
     
-    def _call_dashscope(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
-        """调用通义千问 API"""
-        import dashscope
-        dashscope.api_key = self.api_key
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        
-        response = dashscope.Generation.call(
-            model=self.model,
-            messages=messages,
-            result_format='message'
-        )
-        
-        if response.status_code != 200:
-            raise Exception(f"DashScope API error: {response.message}")
-        
-        content = response.output.choices[0].message.content
-        
-        # 尝试提取 JSON
-        json_str = self._extract_json(content)
-        return json.loads(json_str)
+    def __init__(self):
+        self.providers = load_providers()
+        primary = self.providers[0] if self.providers else None
+        self.provider = primary.name if primary else os.getenv('LLM_PROVIDER', 'dashscope').lower()
+        self.model = primary.model if primary else None
+        # 流式输出：字段一完整即可用（先拿到 template_id / color_scheme），LLM_STREAM=0 关闭
+        self.stream = os.getenv('LLM_STREAM', '1').lower() not in ('0', 'false', 'no')
+        # 延迟统计、熔断与对冲请求
+        self.router = ProviderRouter(self.providers)
+        self.enabled = self.router.enabled
+        # 可用性由后台探测维护，请求路径只读缓存状态
+        self.availability = AvailabilityMonitor(self._probe, enabled=self.enabled)
+        # 相同需求的设计方案缓存，并合并并发的相同请求
+        self.design_cache = DesignCache()
     
-    def _call_zhipu(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
-        """调用智谱 AI API"""
-        url = "https://open.bigmodel.cn/api/paas/v4/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": self.model or "glm-4",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            "temperature": 0.7
-        }
-        
-        response = requests.post(url, json=data, headers=headers, timeout=30)
-        response.raise_for_status()
-        
-        result = response.json()
-        content = result['choices'][0]['message']['content']
-        
-        json_str = self._extract_json(content)
-        return json.loads(json_str)
+    def is_available(self) -> bool:
+        """检查 API 是否可用（读取缓存状态，不发起网络请求）"""
+        return self.availability.is_available()
     
-    def _call_baidu(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
-        """调用百度文心一言 API"""
-        # 需要先获取 access_token
-        access_token = self._get_baidu_token()
-        
-        url = f"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions?access_token={access_token}"
+    def _probe(self) -> bool:
+        """实际探测 API 是否可用（由后台探测线程调用）：任一提供商可用即可"""
+        for provider in self.providers:
+            if not provider.enabled:
+                continue
+            try:
+                if provider.probe():
+                    return True
+            except Exception:
+                continue
+        return False
+    
+    def generate_poster_design(self, user_prompt: str,
+                               return_cache_status: bool = False,
+                               on_field: Optional[Callable[[str, Any], None]] = None,
+                               variants: int = 1
+                               ) -> Union[Dict[str, Any], List[Dict[str, Any]], Tuple[Any, str]]:
+        """
+        根据用户需求生成海报设计方案
         
-        data = {
-            "messages": [
-                {"role": "user", "content": f"{system_prompt}\n\n用户需求：{user_prompt}"}
-            ],
-            "temperature": 0.7
-        }
+        Args:
+            user_prompt: 用户输入的需求描述
+            return_cache_status: 为 True 时同时返回缓存状态（'hit' / 'coalesced' / 'miss'）
+            on_field: 流式输出时顶层字段一完整就回调 on_field(字段名, 值)（命中缓存时不回调；多方案时不回调）
+            variants: 大于 1 时在一次调用中请求这么多个备选方案（上限 MAX_VARIANTS）
+            
+        Returns:
+            海报设计方案字典；variants 大于 1 时为方案列表（模型返回不足时可能少于 variants 个）；
+            return_cache_status 为 True 时返回 (设计方案, 缓存状态)
+        """
+        if variants > 1:
+            count = min(variants, MAX_VARIANTS)
+            key = DesignCache.make_key(user_prompt, self.provider, self.model,
+                                       f"{VARIANTS_PROMPT_VERSION}x{count}")
+            result, status = self.design_cache.get_or_compute(
+                key, lambda: {'variants': self._generate_uncached(user_prompt, variants=count)}
+            )
+            design = result['variants']
+        else:
+            key = DesignCache.make_key(user_prompt, self.provider, self.model, SYSTEM_PROMPT_VERSION)
+            design, status = self.design_cache.get_or_compute(
+                key, lambda: self._generate_uncached(user_prompt, on_field)
+            )
+        if return_cache_status:
+            return design, status
+        return design
+    
+    def _generate_uncached(self, user_prompt: str,
+                           on_field: Optional[Callable[[str, Any], None]] = None,
+                           variants: int = 1) -> Any:
+        """实际调用上游 API 生成设计方案（经路由选择提供商）"""
+        if not self.is_available():
+            raise Exception("LLM API not available")
         
-        response = requests.post(url, json=data, timeout=30)
-        response.raise_for_status()
+        # 对冲时两个提供商同时流式输出，只转发最先产出字段的那一个
+        owner: List[str] = []
+        owner_lock = threading.Lock()
         
-        result = response.json()
-        content = result['result']
+        def call(provider: LLMProvider, cancel: threading.Event) -> Any:
+            if variants > 1:
+                return self._call_provider_variants(provider, user_prompt, variants, cancel)
+            
+            def forward(field: str, value: Any):
+                with owner_lock:
+                    if not owner:
+                        owner.append(provider.name)
+                    if owner[0] != provider.name:
+                        return
+                on_field(field, value)
+            return self._call_provider(provider, user_prompt, forward if on_field else None, cancel)
         
-        json_str = self._extract_json(content)
-        return json.loads(json_str)
+        try:
+            design, _ = self.router.call(call)
+        except ValueError as e:
+            # JSON 解析失败说明 API 本身有响应，不计入不可用
+            self.availability.record_success()
+            raise Exception(f"LLM API call failed: {str(e)}")
+        except Exception as e:
+            self.availability.record_failure(e)
+            raise Exception(f"LLM API call failed: {str(e)}")
+        self.availability.record_success()
+        return design
     
-    def _get_baidu_token(self) -> str:
-        """获取百度 access_token"""
-        url = "https://aip.baidubce.com/oauth/2.0/token"
-        params = {
-            "grant_type": "client_credentials",
-            "client_id": self.api_key,
-            "client_secret": os.getenv('BAIDU_SECRET_KEY', '')
-        }
-        
-        response = requests.post(url, params=params, timeout=10)
-        response.raise_for_status()
+    def _call_provider(self, provider: LLMProvider, user_prompt: str,
+                       on_field: Optional[Callable[[str, Any], None]] = None,
+                       cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """调用单个提供商并解析设计 JSON"""
+        if self.stream:
+            return self._consume_stream(provider.stream(SYSTEM_PROMPT, user_prompt), on_field, cancel)
+        content = provider.complete(SYSTEM_PROMPT, user_prompt)
+        if cancel is not None and cancel.is_set():
+            raise HedgeCancelled()
+        return json.loads(self._extract_json(content))
+    
+    def _call_provider_variants(self, provider: LLMProvider, user_prompt: str, count: int,
+                                cancel: Optional[threading.Event] = None) -> List[Dict[str, Any]]:
+        """一次调用请求 count 个备选方案，解析 {"variants": [...]}（也接受裸数组或单个方案）"""
+        system_prompt = SYSTEM_PROMPT + VARIANTS_PROMPT.replace('{count}', str(count))
+        if self.stream:
+            parts = []
+            chunks = provider.stream(system_prompt, user_prompt)
+            try:
+                for chunk in chunks:
+                    if cancel is not None and cancel.is_set():
+                        raise HedgeCancelled()
+                    parts.append(chunk)
+            finally:
+                close = getattr(chunks, 'close', None)
+                if close is not None:
+                    close()
+            text = ''.join(parts)
+        else:
+            text = provider.complete(system_prompt, user_prompt)
+            if cancel is not None and cancel.is_set():
+                raise HedgeCancelled()
+        return self._parse_variants(text, count)
+    
+    def _parse_variants(self, text: str, count: int) -> List[Dict[str, Any]]:
+        """
+        从回复文本中取出方案列表（最多 count 个）
         
-        result = response.json()
-        return result['access_token']
+        Raises:
+            ValueError: 回复中没有可用的方案
+        """
+        stripped = text.strip()
+        start = stripped.find('[')
+        if start != -1 and stripped[:start].strip(' `json\n') == '':
+            # 模型直接返回了数组
+            result = json.loads(stripped[start:stripped.rindex(']') + 1])
+        else:
+            result = json.loads(self._extract_json(text))
+        if isinstance(result, dict):
+            result = result.get('variants', [result])
+        if not isinstance(result, list):
+            raise ValueError("variants must be a list")
+        designs = [d for d in result if isinstance(d, dict)][:count]
+        if not designs:
+            raise ValueError("No design variants in LLM response")
+        return designs
+    
+    def _consume_stream(self, chunks: Iterator[str],
+                        on_field: Optional[Callable[[str, Any], None]] = None,
+                        cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """边接收边增量解析；流结束时对象仍不完整则退回整段文本提取"""
+        parser = IncrementalJSONParser(on_field)
+        try:
+            for chunk in chunks:
+                if cancel is not None and cancel.is_set():
+                    # 对冲中另一提供商已胜出，关闭流（释放连接）
+                    raise HedgeCancelled()
+                parser.feed(chunk)
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        if parser.done:
+            return parser.result()
+        return json.loads(self._extract_json(parser.text))
+    
+    def transport_stats(self) -> Dict[str, Any]:
+        """各提供商连接池与 token 缓存状态（供 /health 展示）"""
+        stats = {}
+        for provider in self.providers:
+            transport = provider.transport_stats()
+            if transport is not None:
+                stats[provider.name] = transport
+        return stats
+    
+    def router_stats(self) -> Dict[str, Any]:
+        """各提供商延迟分位数、错误率、熔断状态与对冲计数（供 /health 展示）"""
+        return self.router.stats()
     
     def _extract_json(self, text: str) -> str:
         """从文本中提取 JSON"""
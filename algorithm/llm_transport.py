@@ -0,0 +1,153 @@
+"""
+LLM 提供商 HTTP 传输模块
+每个提供商一个带 keep-alive 连接池的 requests.Session，连接与读取超时分别可配：
+    LLM_HTTP_POOL_SIZE / LLM_<PROVIDER>_HTTP_POOL_SIZE         连接池大小，默认 8
+    LLM_CONNECT_TIMEOUT / LLM_<PROVIDER>_CONNECT_TIMEOUT        连接超时（秒），默认 5
+    LLM_READ_TIMEOUT / LLM_<PROVIDER>_READ_TIMEOUT              读取超时（秒），默认 30
+以及 access_token 缓存：到期前提前刷新，并发请求只触发一次刷新
+"""
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def _provider_env(provider: str, name: str, default: str) -> str:
+    """先读 LLM_<PROVIDER>_<NAME>，再读 LLM_<NAME>"""
+    return os.getenv(f'LLM_{provider.upper()}_{name}', os.getenv(f'LLM_{name}', default))
+
+
+class ProviderTransport:
+    """单个提供商的 HTTP 连接池"""
+
+    def __init__(self, provider: str, pool_size: Optional[int] = None,
+                 connect_timeout: Optional[float] = None, read_timeout: Optional[float] = None):
+        self.provider = provider
+        self.pool_size = pool_size or int(_provider_env(provider, 'HTTP_POOL_SIZE', '8'))
+        self.connect_timeout = connect_timeout if connect_timeout is not None else float(
+            _provider_env(provider, 'CONNECT_TIMEOUT', '5'))
+        self.read_timeout = read_timeout if read_timeout is not None else float(
+            _provider_env(provider, 'READ_TIMEOUT', '30'))
+        self.session = requests.Session()
+        # 不在传输层重试：生成请求不是幂等的，失败交给上层处理
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        return self.connect_timeout, self.read_timeout
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """发送请求（未指定 timeout 时使用 (连接超时, 读取超时)）"""
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self.requests += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.errors += 1
+            raise
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'connect_timeout': self.connect_timeout,
+                'read_timeout': self.read_timeout,
+                'requests': self.requests,
+                'errors': self.errors,
+            }
+
+
+class TokenCache:
+    """
+    access_token 缓存
+    到期前 refresh_margin 秒开始刷新：旧 token 仍有效时由一个线程刷新、其他请求继续用旧 token；
+    没有可用 token 时所有请求等待同一次刷新
+    """
+
+    def __init__(self, fetch: Callable[[], Tuple[str, float]], refresh_margin: Optional[float] = None):
+        """
+        Args:
+            fetch: 获取新 token，返回 (token, 有效期秒数)
+            refresh_margin: 提前刷新的秒数，默认 LLM_TOKEN_REFRESH_MARGIN 或 3600
+        """
+        self._fetch = fetch
+        self.refresh_margin = refresh_margin if refresh_margin is not None else float(
+            os.getenv('LLM_TOKEN_REFRESH_MARGIN', '3600'))
+        self._cond = threading.Condition()
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refreshing = False
+        self._error: Optional[BaseException] = None
+        self.refreshes = 0
+
+    def get(self) -> str:
+        """
+        获取 token
+
+        Raises:
+            Exception: 没有可用 token 且刷新失败
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                valid = self._token is not None and now < self._expires_at
+                if valid and now < self._expires_at - self.refresh_margin:
+                    return self._token
+                if not self._refreshing:
+                    self._refreshing = True
+                    self._error = None
+                    break
+                if valid:
+                    # 其他线程正在刷新，旧 token 还能用
+                    return self._token
+                self._cond.wait()
+                if self._error is not None and self._token is None:
+                    raise self._error
+        try:
+            token, expires_in = self._fetch()
+        except BaseException as e:
+            with self._cond:
+                self._refreshing = False
+                self._error = e
+                self._cond.notify_all()
+                if self._token is not None and time.time() < self._expires_at:
+                    print(f"Token refresh failed, using cached token: {e}")
+                    return self._token
+            raise
+        with self._cond:
+            self._token = token
+            self._expires_at = time.time() + float(expires_in)
+            self._refreshing = False
+            self.refreshes += 1
+            self._cond.notify_all()
+            return token
+
+    def invalidate(self):
+        """服务端报告 token 无效时清除缓存，下次调用重新获取"""
+        with self._cond:
+            self._token = None
+            self._expires_at = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'cached': self._token is not None,
+                'expires_in': round(self._expires_at - time.time(), 1) if self._token else None,
+                'refreshes': self.refreshes,
+            }
@@ -0,0 +1,25 @@
+"""
+路径与 id 校验工具
+"""
+import os
+import re
+import time
+
+
+# 仅允许字母数字与下划线，防止路径穿越
+def safe_id(raw_id: str) -> str:
+    if not raw_id or not re.match(r'^[a-zA-Z0-9_\-]+$', raw_id):
+        return ''
+    return raw_id
+
+
+def touch(path: str, interval: float = 3600):
+    """
+    把文件 mtime 刷新为当前时间，记作最近一次使用（存储生命周期按 mtime 做 LRU 淘汰）；
+    距上次刷新不足 interval 秒时不写，热点文件不会每次命中都改元数据
+    """
+    try:
+        if time.time() - os.stat(path).st_mtime > interval:
+            os.utime(path)
+    except OSError:
+        pass
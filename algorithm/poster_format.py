@@ -0,0 +1,171 @@
+"""
+海报文档二进制存储格式（.poster）
+对外接口仍是 JSON，磁盘上按长度前缀分段存放，读者可以只读需要的部分：
+    前导    b'PSTR' + 版本（u16）+ 段数（u16）
+    段      4 字节标签 + 长度（u32）+ 内容，依次排列；不认识的标签直接跳过
+      META  紧凑 JSON：{"hash": 规范化哈希, "elements": 元素数（elements 不是数组时为 null）}
+      HEAD  紧凑 JSON：除 elements 外的全部字段（size、background、模板 id 等），
+            elements 的位置用 null 占位以保留字段顺序
+      EIDX  元素索引：数量（u32），每个元素为 id 长度（u16）+ id + 内容长度（u32）
+      ELEM  各元素的紧凑 JSON 依次拼接，偏移由索引中的长度累加得到
+只读尺寸 / 版本号时读前两段即可；条件请求版本未变时不解析元素。
+不兼容的改动需提升 FORMAT_VERSION
+"""
+import json
+import struct
+from io import BytesIO
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+from render_cache import canonical_hash
+
+MAGIC = b'PSTR'
+FORMAT_VERSION = 1
+# 二进制文档的扩展名
+POSTER_FORMAT_EXT = 'poster'
+
+_PREAMBLE = struct.Struct('>4sHH')
+_SECTION = struct.Struct('>4sI')
+_U16 = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+
+
+class PosterFormatError(ValueError):
+    """不是合法的海报二进制文档（或版本过新）"""
+
+
+def _compact(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def encode(poster_data: Dict[str, Any]) -> bytes:
+    """海报数据 → 二进制文档"""
+    elements = poster_data.get('elements')
+    has_elements = isinstance(elements, list)
+    head = {key: (None if key == 'elements' and has_elements else value) for key, value in poster_data.items()}
+    payloads = [_compact(element) for element in elements] if has_elements else []
+
+    index = BytesIO()
+    index.write(_U32.pack(len(payloads)))
+    for element, payload in zip(elements or [], payloads):
+        element_id = element.get('id') if isinstance(element, dict) else None
+        raw_id = str(element_id).encode('utf-8')[:0xFFFF] if element_id is not None else b''
+        index.write(_U16.pack(len(raw_id)))
+        index.write(raw_id)
+        index.write(_U32.pack(len(payload)))
+
+    sections = [
+        (b'META', _compact({'hash': canonical_hash(poster_data),
+                            'elements': len(payloads) if has_elements else None})),
+        (b'HEAD', _compact(head)),
+        (b'EIDX', index.getvalue()),
+        (b'ELEM', b''.join(payloads)),
+    ]
+    out = BytesIO()
+    out.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(sections)))
+    for tag, payload in sections:
+        out.write(_SECTION.pack(tag, len(payload)))
+        out.write(payload)
+    return out.getvalue()
+
+
+def _read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise PosterFormatError("Truncated poster document")
+    return data
+
+
+def _read_preamble(f: BinaryIO) -> int:
+    """校验前导，返回段数"""
+    magic, version, count = _PREAMBLE.unpack(_read_exact(f, _PREAMBLE.size))
+    if magic != MAGIC:
+        raise PosterFormatError("Not a poster document")
+    if version > FORMAT_VERSION:
+        raise PosterFormatError(f"Unsupported poster format version: {version}")
+    return count
+
+
+def _sections(f: BinaryIO, wanted: Tuple[bytes, ...]) -> Dict[bytes, bytes]:
+    """顺序读取段，只读出 wanted 中的内容，其余段按长度跳过；取齐即停止"""
+    count = _read_preamble(f)
+    found: Dict[bytes, bytes] = {}
+    for _ in range(count):
+        tag, length = _SECTION.unpack(_read_exact(f, _SECTION.size))
+        if tag in wanted:
+            found[tag] = _read_exact(f, length)
+            if len(found) == len(wanted):
+                break
+        else:
+            f.seek(length, 1)
+    return found
+
+
+def _parse_index(raw: bytes) -> List[Tuple[str, int, int]]:
+    """元素索引 → [(id, 在 ELEM 段中的偏移, 长度)]"""
+    (count,) = _U32.unpack_from(raw, 0)
+    pos = _U32.size
+    offset = 0
+    entries = []
+    for _ in range(count):
+        (id_len,) = _U16.unpack_from(raw, pos)
+        pos += _U16.size
+        element_id = raw[pos:pos + id_len].decode('utf-8')
+        pos += id_len
+        (length,) = _U32.unpack_from(raw, pos)
+        pos += _U32.size
+        entries.append((element_id, offset, length))
+        offset += length
+    return entries
+
+
+def decode(data: bytes) -> Dict[str, Any]:
+    """二进制文档 → 海报数据（与写入时的 JSON 相同）"""
+    return _assemble(_sections(BytesIO(data), _DOCUMENT_SECTIONS))
+
+
+# 还原整个文档需要的段
+_DOCUMENT_SECTIONS = (b'META', b'HEAD', b'EIDX', b'ELEM')
+
+
+def _assemble(sections: Dict[bytes, bytes]) -> Dict[str, Any]:
+    head = json.loads(sections[b'HEAD'])
+    if json.loads(sections[b'META']).get('elements') is not None:
+        body = sections.get(b'ELEM', b'')
+        head['elements'] = [json.loads(body[offset:offset + length])
+                            for _, offset, length in _parse_index(sections[b'EIDX'])]
+    return head
+
+
+def read(path: str) -> Dict[str, Any]:
+    """读取整个文档"""
+    with open(path, 'rb') as f:
+        return _assemble(_sections(f, _DOCUMENT_SECTIONS))
+
+
+def read_header(path: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    只读前两段
+
+    Returns:
+        (除 elements 外的字段, META：{hash, elements})
+    """
+    with open(path, 'rb') as f:
+        sections = _sections(f, (b'META', b'HEAD'))
+    head = json.loads(sections[b'HEAD'])
+    head.pop('elements', None)
+    return head, json.loads(sections[b'META'])
+
+
+def read_unless(path: str, unchanged: Callable[[str], bool]) -> Tuple[Optional[Dict[str, Any]], str]:
+    """
+    先读 META 段取内容哈希，unchanged(哈希) 为 True 时不再读取其余部分；文件只打开一次
+
+    Returns:
+        (海报数据，unchanged 时为 None, 内容哈希)
+    """
+    with open(path, 'rb') as f:
+        content_hash = json.loads(_sections(f, (b'META',))[b'META'])['hash']
+        if unchanged(content_hash):
+            return None, content_hash
+        f.seek(0)
+        return _assemble(_sections(f, _DOCUMENT_SECTIONS)), content_hash
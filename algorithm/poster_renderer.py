@@ -1,99 +1,283 @@
 """
 海报渲染模块
 使用 Pillow 生成海报图片
+分层模型：背景层（按尺寸+背景描述缓存）+ 每个元素一层（已知包围盒），
+更新海报时只重新合成变化元素所在的脏区域
 """
 from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
+import json
+import math
 import os
-import requests
-from typing import Dict, Any, Optional
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, List, Optional, Tuple, Union
 import base64
 
+from background_engine import get_background_engine, parse_color
+from encoder import encode_image
+from font_registry import get_font_registry
+from image_source import get_image_resolver
+
+# 文字层四周留白，保证抗锯齿边缘完整落在包围盒内
+_TEXT_LAYER_PADDING = 2
+
+Box = Tuple[int, int, int, int]
+
+
+class _Layer:
+    """元素图层：box 为画布坐标下的包围盒；文字层为 L 蒙版 + 纯色，图片层为图片 + 可选蒙版"""
+    
+    __slots__ = ('box', 'image', 'mask', 'fill')
+    
+    def __init__(self, box: Box, image: Optional[Image.Image] = None,
+                 mask: Optional[Image.Image] = None, fill: Optional[tuple] = None):
+        self.box = box
+        self.image = image
+        self.mask = mask
+        self.fill = fill
+
+
+def _intersects(a: Box, b: Box) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _union(a: Box, b: Box) -> Box:
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _merge_boxes(boxes: Iterable[Box]) -> List[Box]:
+    """合并相交的矩形，减少重复合成"""
+    merged: List[Box] = []
+    for box in boxes:
+        while True:
+            for i, other in enumerate(merged):
+                if _intersects(box, other):
+                    box = _union(box, merged.pop(i))
+                    break
+            else:
+                break
+        merged.append(box)
+    return merged
+
 
 class PosterRenderer:
     """海报渲染器"""
     
+    # JPEG 导出质量（同时作为渲染缓存键的编码参数）
+    JPEG_QUALITY = 95
+    # 脏区域超过画布该比例时直接整张重绘
+    FULL_RENDER_RATIO = 0.6
+    
     def __init__(self, upload_dir: str = "/tmp/posters"):
         self.upload_dir = upload_dir
         os.makedirs(upload_dir, exist_ok=True)
+        # 进程内共享字体注册表，避免每个文字元素重复解析字体文件
+        self.fonts = get_font_registry()
+        # 背景按 (尺寸, 背景描述) 缓存，相同模板渐变只生成一次
+        self.backgrounds = get_background_engine()
+        # 图片元素来源解析与解码缓存
+        self.images = get_image_resolver()
+        # 文字层缓存（按元素内容寻址）
+        self._layer_lock = threading.Lock()
+        self._text_layers: "OrderedDict[str, _Layer]" = OrderedDict()
+        self.max_text_layers = int(os.getenv('POSTER_LAYER_CACHE_SIZE', '256'))
     
-    def render(self, poster_data: Dict[str, Any], format: str = "PNG") -> BytesIO:
+    def render(self, poster_data: Dict[str, Any], format: str = "PNG",
+               params: Optional[Dict[str, Any]] = None) -> BytesIO:
         """
         渲染海报
         
         Args:
             poster_data: 海报数据（包含 size, background, elements）
-            format: 输出格式 (PNG, JPEG)
+            format: 输出格式 (PNG, JPEG, WEBP)
+            params: 编码参数（见 encoder.resolve_encoder），None 为默认
             
         Returns:
             BytesIO 对象
         """
-        size = poster_data["size"]
-        width = size["width"]
-        height = size["height"]
+        return self.render_encoded(poster_data, format, params)[0]
+    
+    def render_encoded(self, poster_data: Dict[str, Any], format: str = "PNG",
+                       params: Optional[Dict[str, Any]] = None) -> Tuple[BytesIO, Dict[str, Any]]:
+        """渲染海报，同时返回编码信息（format / bytes / encode_ms）"""
+        return encode_image(self._compose_full(poster_data), format, self._encode_params(format, params))
+    
+    def render_update(self, old_data: Dict[str, Any], new_data: Dict[str, Any],
+                      base: Union[str, BytesIO], format: str = "PNG",
+                      dirty_ids: Optional[Iterable[str]] = None,
+                      params: Optional[Dict[str, Any]] = None) -> Tuple[BytesIO, Dict[str, Any]]:
+        """
+        增量渲染：以旧海报的渲染结果为底图，只重新合成变化元素所在的区域
+        
+        Args:
+            old_data: 底图对应的 poster_data
+            new_data: 新的 poster_data
+            base: 底图（旧数据的渲染结果，文件路径或 BytesIO）
+            format: 输出格式 (PNG, JPEG, WEBP)
+            dirty_ids: 已知变化的元素 id（可选，提供时只比较这些元素与增删的元素）
+            params: 编码参数，None 为默认
+            
+        Returns:
+            (BytesIO, 渲染信息)：信息含 mode（incremental / full）、dirty_ids、dirty_ratio 与 encode
+        """
+        size = (new_data["size"]["width"], new_data["size"]["height"])
+        boxes = self._dirty_boxes(old_data, new_data, dirty_ids)
+        if boxes is None:
+            return self._render_full(new_data, format, params, None, 1.0)
+        
+        changed, boxes = boxes
+        canvas = (0, 0, size[0], size[1])
+        boxes = [
+            (max(b[0], 0), max(b[1], 0), min(b[2], size[0]), min(b[3], size[1]))
+            for b in _merge_boxes(boxes) if _intersects(b, canvas)
+        ]
+        area = sum((b[2] - b[0]) * (b[3] - b[1]) for b in boxes)
+        ratio = area / float(size[0] * size[1])
+        if ratio > self.FULL_RENDER_RATIO:
+            return self._render_full(new_data, format, params, changed, ratio)
+        
+        img = Image.open(base)
+        img.load()
+        if img.mode != 'RGB' or img.size != size:
+            return self._render_full(new_data, format, params, changed, ratio)
         
-        # 创建画布
-        img = Image.new('RGB', (width, height), color='#FFFFFF')
-        draw = ImageDraw.Draw(img)
+        if boxes:
+            background = self.backgrounds.render(size, new_data.get("background", {}))
+            layers = self._layers(new_data)
+            for box in boxes:
+                region = background.crop(box)
+                for layer in layers:
+                    if _intersects(layer.box, box):
+                        self._paste_layer(region, layer, (box[0], box[1]))
+                img.paste(region, box[:2])
+        output, encode_info = encode_image(img, format, self._encode_params(format, params))
+        return output, {'mode': 'incremental', 'dirty_ids': changed, 'dirty_ratio': round(ratio, 4),
+                        'encode': encode_info}
+    
+    def _render_full(self, poster_data: Dict[str, Any], format: str, params: Optional[Dict[str, Any]],
+                     changed: Optional[List[str]], ratio: float) -> Tuple[BytesIO, Dict[str, Any]]:
+        output, encode_info = self.render_encoded(poster_data, format, params)
+        return output, {'mode': 'full', 'dirty_ids': changed, 'dirty_ratio': round(ratio, 4),
+                        'encode': encode_info}
+    
+    def _compose_full(self, poster_data: Dict[str, Any]) -> Image.Image:
+        """背景层 + 逐个元素层合成整张画布"""
+        size = poster_data["size"]
+        img = self.backgrounds.render((size["width"], size["height"]), poster_data.get("background", {}))
+        for layer in self._layers(poster_data):
+            self._paste_layer(img, layer)
+        return img
+    
+    def _encode_params(self, format: str, params: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """未指定编码参数时 JPEG 沿用 JPEG_QUALITY，其余格式用编码模块的默认值"""
+        if params is None and format.upper() in ("JPEG", "JPG"):
+            return {'quality': self.JPEG_QUALITY}
+        return params
+    
+    def _dirty_boxes(self, old_data: Dict[str, Any], new_data: Dict[str, Any],
+                     dirty_ids: Optional[Iterable[str]]) -> Optional[Tuple[List[str], List[Box]]]:
+        """
+        比较新旧数据，返回 (变化元素 id, 脏矩形列表)；尺寸、背景或元素顺序变化时返回 None（需整张重绘）
+        """
+        if old_data.get("size") != new_data.get("size") or \
+                old_data.get("background", {}) != new_data.get("background", {}):
+            return None
+        old_list, new_list = old_data.get("elements", []), new_data.get("elements", [])
+        old_elements = {self._element_key(el, i): el for i, el in enumerate(old_list)}
+        new_elements = {self._element_key(el, i): el for i, el in enumerate(new_list)}
+        if len(old_elements) != len(old_list) or len(new_elements) != len(new_list):
+            # id 重复时无法按 id 对应新旧元素
+            return None
+        old_order = [k for k in old_elements if k in new_elements]
+        new_order = [k for k in new_elements if k in old_elements]
+        if old_order != new_order:
+            return None
         
-        # 绘制背景
-        self._draw_background(draw, img, poster_data.get("background", {}))
+        candidates = set(old_elements) ^ set(new_elements)
+        if dirty_ids is None:
+            candidates |= set(old_elements) | set(new_elements)
+        else:
+            candidates |= {k for k in dirty_ids if k in old_elements or k in new_elements}
         
-        # 绘制元素
+        changed: List[str] = []
+        boxes: List[Box] = []
+        for key in sorted(candidates):
+            old_el, new_el = old_elements.get(key), new_elements.get(key)
+            if old_el == new_el:
+                continue
+            changed.append(key)
+            for el in (old_el, new_el):
+                if el is None:
+                    continue
+                if el.get("type") == "image":
+                    box = self._image_box(el)
+                    if box is None:
+                        layer = self._image_layer(el)
+                        if layer is None:
+                            # 图片现在取不到（上传被删 / 外链失效），不知道旧图上它占了哪块区域
+                            return None
+                        box = layer.box
+                    boxes.append(box)
+                else:
+                    layer = self._element_layer(el)
+                    if layer is not None:
+                        boxes.append(layer.box)
+        return changed, boxes
+    
+    @staticmethod
+    def _image_box(element: Dict[str, Any]) -> Optional[Box]:
+        """图片元素按 position + size 算出的包围盒（与 _image_layer 一致），不需要读取图片；缺少时返回 None"""
+        try:
+            position, size = element["position"], element["size"]
+            width, height = int(size["width"]), int(size["height"])
+            x = int(position["x"] - width // 2)
+            y = int(position["y"] - height // 2)
+        except (KeyError, TypeError, ValueError):
+            return None
+        return (x, y, x + width, y + height)
+    
+    @staticmethod
+    def _element_key(element: Dict[str, Any], index: int) -> str:
+        return element.get("id") or f"#{index}"
+    
+    def _layers(self, poster_data: Dict[str, Any]) -> List[_Layer]:
+        layers = []
         for element in poster_data.get("elements", []):
-            if element["type"] == "text":
-                self._draw_text(draw, element)
-            elif element["type"] == "image":
-                self._draw_image(img, element)
-        
-        # 转换为指定格式
-        output = BytesIO()
-        if format.upper() == "JPEG":
-            # JPEG 不支持透明，需要转换为 RGB
-            if img.mode == 'RGBA':
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[3] if img.mode == 'RGBA' else None)
-                img = background
-            img.save(output, format='JPEG', quality=95)
+            layer = self._element_layer(element)
+            if layer is not None:
+                layers.append(layer)
+        return layers
+    
+    def _element_layer(self, element: Dict[str, Any]) -> Optional[_Layer]:
+        if element.get("type") == "text":
+            return self._text_layer(element)
+        if element.get("type") == "image":
+            return self._image_layer(element)
+        return None
+    
+    def _paste_layer(self, canvas: Image.Image, layer: _Layer, origin: Tuple[int, int] = (0, 0)):
+        """把图层贴到画布（origin 为画布左上角在海报坐标中的位置，用于脏区域局部合成）"""
+        x, y = layer.box[0] - origin[0], layer.box[1] - origin[1]
+        if layer.fill is not None:
+            canvas.paste(layer.fill, (x, y, x + layer.mask.width, y + layer.mask.height), layer.mask)
+        elif layer.mask is not None:
+            canvas.paste(layer.image, (x, y), layer.mask)
         else:
-            img.save(output, format='PNG')
-        
-        output.seek(0)
-        return output
-    
-    def _draw_background(self, draw: ImageDraw, img: Image, background: Dict[str, Any]):
-        """绘制背景"""
-        bg_type = background.get("type", "solid")
-        
-        if bg_type == "solid":
-            color = background.get("color", "#FFFFFF")
-            draw.rectangle([(0, 0), img.size], fill=color)
-        elif bg_type == "gradient":
-            colors = background.get("colors", ["#4A90E2", "#357ABD"])
-            self._draw_gradient(img, colors[0], colors[1])
-    
-    def _draw_gradient(self, img: Image, color1: str, color2: str):
-        """绘制渐变背景（垂直渐变，用条带缩放避免逐像素循环）"""
-        width, height = img.size
-        r1, g1, b1 = self._hex_to_rgb(color1)
-        r2, g2, b2 = self._hex_to_rgb(color2)
-        # 画 1 列 x height 的渐变条，再缩放到整张图
-        strip = Image.new("RGB", (1, height))
-        strip_px = strip.load()
-        for y in range(height):
-            ratio = (y / (height - 1)) if height > 1 else 0
-            strip_px[0, y] = (
-                int(r1 + (r2 - r1) * ratio),
-                int(g1 + (g2 - g1) * ratio),
-                int(b1 + (b2 - b1) * ratio),
-            )
-        img.paste(strip.resize((width, height), Image.Resampling.LANCZOS), (0, 0))
-    
-    def _draw_text(self, draw: ImageDraw, element: Dict[str, Any]):
-        """绘制文字"""
+            canvas.paste(layer.image, (x, y))
+    
+    def _text_layer(self, element: Dict[str, Any]) -> Optional[_Layer]:
+        """文字层（按元素内容缓存，相同文字元素只栅格化一次）"""
         content = element.get("content", element.get("defaultContent", ""))
         if not content:
-            return
+            return None
+        
+        cache_key = json.dumps(element, sort_keys=True, ensure_ascii=False)
+        with self._layer_lock:
+            layer = self._text_layers.get(cache_key)
+            if layer is not None:
+                self._text_layers.move_to_end(cache_key)
+                return layer
         
         position = element["position"]
         x = position["x"]
@@ -103,36 +287,8 @@ class PosterRenderer:
         # 字体大小
         font_size = style.get("fontSize", 24)
         
-        # 优先使用支持中文的字体（路径需与 Docker/系统安装一致，否则会乱码/方框）
-        _env_font = os.environ.get("POSTER_FONT_PATH")
-        _font_paths = []
-        if _env_font and os.path.exists(_env_font):
-            _font_paths.append(_env_font)
-        _font_paths += [
-            "/usr/share/fonts/wenquanyi/wqy-zenhei/wqy-zenhei.ttc",  # Debian/Ubuntu fonts-wqy-zenhei
-            "/usr/share/fonts/truetype/wqy-zenhei/wqy-zenhei.ttc",
-            "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
-            "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-            "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-            "C:/Windows/Fonts/msyh.ttc",
-            "C:/Windows/Fonts/simhei.ttf",
-        ]
-        font = None
-        for path in _font_paths:
-            if not os.path.exists(path):
-                continue
-            try:
-                # .ttc 需显式 index=0，否则部分环境会乱码
-                kw = {"size": font_size}
-                if path.lower().endswith(".ttc"):
-                    kw["index"] = 0
-                font = ImageFont.truetype(path, **kw)
-                break
-            except (OSError, IOError):
-                continue
-        if font is None:
-            font = ImageFont.load_default()
+        # 字体（路径启动时已解析，FreeTypeFont 按字号缓存）
+        font = self.fonts.get_font(font_size, style.get("fontFamily"))
         
         # 颜色
         color = style.get("color", "#000000")
@@ -141,8 +297,8 @@ class PosterRenderer:
         # 对齐方式
         text_align = style.get("textAlign", "left")
         
-        # 获取文字边界框
-        bbox = draw.textbbox((0, 0), content, font=font)
+        # 获取文字边界框（ImageDraw.textbbox 对含换行的内容按多行计算，与绘制一致）
+        bbox = ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), content, font=font)
         text_width = bbox[2] - bbox[0]
         text_height = bbox[3] - bbox[1]
         
@@ -152,47 +308,49 @@ class PosterRenderer:
         elif text_align == "right":
             x = x - text_width
         
-        # 绘制文字
-        draw.text((x, y - text_height), content, fill=color_rgb, font=font)
-    
-    def _draw_image(self, img: Image, element: Dict[str, Any]):
-        """绘制图片"""
-        image_url = element.get("url")
-        if not image_url:
-            return
+        # 文字绘制原点与其在画布上的包围盒
+        origin_x, origin_y = x, y - text_height
+        x0 = math.floor(origin_x + bbox[0]) - _TEXT_LAYER_PADDING
+        y0 = math.floor(origin_y + bbox[1]) - _TEXT_LAYER_PADDING
+        x1 = math.ceil(origin_x + bbox[2]) + _TEXT_LAYER_PADDING
+        y1 = math.ceil(origin_y + bbox[3]) + _TEXT_LAYER_PADDING
+        
+        # 栅格化为 L 蒙版，合成时以纯色 + 蒙版贴到画布
+        mask = Image.new('L', (x1 - x0, y1 - y0), 0)
+        ImageDraw.Draw(mask).text((origin_x - x0, origin_y - y0), content, fill=255, font=font)
+        layer = _Layer((x0, y0, x1, y1), mask=mask, fill=color_rgb)
         
+        with self._layer_lock:
+            self._text_layers[cache_key] = layer
+            while len(self._text_layers) > self.max_text_layers:
+                self._text_layers.popitem(last=False)
+        return layer
+    
+    def _image_layer(self, element: Dict[str, Any]) -> Optional[_Layer]:
+        """图片层（本地上传直接读文件，外部地址走连接池；解码缩放结果由图片缓存负责）"""
         try:
-            # 下载图片
-            response = requests.get(image_url, timeout=10)
-            response.raise_for_status()
-            
-            # 打开图片
-            element_img = Image.open(BytesIO(response.content))
-            
-            # 调整大小
             size = element.get("size", {})
-            if size:
-                element_img = element_img.resize(
-                    (size["width"], size["height"]),
-                    Image.Resampling.LANCZOS
-                )
+            target = (size["width"], size["height"]) if size else None
+            element_img = self.images.get_image(element, target)
+            if element_img is None:
+                return None
             
-            # 粘贴到主图片
             position = element["position"]
             x = position["x"] - element_img.width // 2
             y = position["y"] - element_img.height // 2
+            x, y = int(x), int(y)
+            box = (x, y, x + element_img.width, y + element_img.height)
             
             if element_img.mode == 'RGBA':
-                img.paste(element_img, (x, y), element_img)
-            else:
-                img.paste(element_img, (x, y))
+                return _Layer(box, image=element_img, mask=element_img)
+            return _Layer(box, image=element_img)
         except Exception as e:
             print(f"Failed to draw image: {e}")
+            return None
     
     def _hex_to_rgb(self, hex_color: str) -> tuple:
         """转换十六进制颜色为 RGB"""
-        hex_color = hex_color.lstrip('#')
-        return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+        return parse_color(hex_color)
     
     def render_to_pdf(self, poster_data: Dict[str, Any]) -> BytesIO:
         """渲染为 PDF（使用 reportlab）"""
@@ -207,13 +365,17 @@ class PosterRenderer:
             # 创建 PDF，使用海报尺寸
             c = canvas.Canvas(output, pagesize=(width, height))
             
-            # 绘制背景
+            # 绘制背景（渐变直接使用背景引擎生成的位图）
             background = poster_data.get("background", {})
-            if background.get("type") == "solid":
+            if background.get("type", "solid") == "solid":
                 color = background.get("color", "#FFFFFF")
                 r, g, b = self._hex_to_rgb(color)
                 c.setFillColorRGB(r/255, g/255, b/255)
                 c.rect(0, 0, width, height, fill=1)
+            else:
+                from reportlab.lib.utils import ImageReader
+                bg_img = self.backgrounds.render((width, height), background)
+                c.drawImage(ImageReader(bg_img), 0, 0, width=width, height=height)
             
             # 绘制元素
             for element in poster_data.get("elements", []):
@@ -225,7 +387,7 @@ class PosterRenderer:
                         color = style.get("color", "#000000")
                         r, g, b = self._hex_to_rgb(color)
                         c.setFillColorRGB(r/255, g/255, b/255)
-                        c.setFont("Helvetica-Bold", style.get("fontSize", 24))
+                        c.setFont(self.fonts.pdf_font_name(style.get("fontFamily")), style.get("fontSize", 24))
                         c.drawString(position["x"], height - position["y"], content)
             
             c.save()
@@ -0,0 +1,496 @@
+"""
+海报存储模块
+海报文件按 id 的哈希前缀分两级子目录存放（POSTERS_DIR/ab/cd/<id>.poster|png），
+避免单个目录下堆积上百万个文件；写入一律先写临时文件再 rename。
+海报文档默认以分段二进制格式（见 poster_format）保存，只需尺寸 / 版本号时不必解析整个文档；
+POSTER_FORMAT=json 时仍写缩进 JSON。两种格式都可读取，转换命令：
+    python poster_store.py convert [--to binary|json] [--dry-run]
+SQLite 索引（POSTERS_DIR/posters.sqlite3）记录 id、模板、尺寸、创建 / 更新时间与字节数，
+列表、统计与清理都走索引查询，不扫描目录；索引同时记录每张海报引用的上传图片，
+供存储生命周期判断上传图片是否已无海报使用。
+尚未迁移的扁平目录文件（POSTERS_DIR/<id>.json）仍可读取，迁移命令：
+    python poster_store.py migrate [--posters-dir DIR] [--dry-run]
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import poster_format
+from image_source import poster_image_ids
+from poster_format import POSTER_FORMAT_EXT
+from render_cache import canonical_hash
+from sqlite_index import SQLiteIndex
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS posters (
+    id TEXT PRIMARY KEY,
+    template_id TEXT,
+    width INTEGER,
+    height INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    json_bytes INTEGER NOT NULL DEFAULT 0,
+    png_bytes INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS posters_created ON posters (created_at);
+CREATE INDEX IF NOT EXISTS posters_template ON posters (template_id, created_at);
+CREATE TABLE IF NOT EXISTS poster_images (
+    poster_id TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    PRIMARY KEY (poster_id, image_id)
+);
+CREATE INDEX IF NOT EXISTS poster_images_image ON poster_images (image_id);
+"""
+
+# PRAGMA user_version：1 表示 poster_images 已覆盖全部已索引海报（旧索引由 migrate 补齐）
+_REFERENCES_VERSION = 1
+
+# 海报文档的扩展名（按优先级）与海报全部文件的扩展名
+DOCUMENT_EXTENSIONS = (POSTER_FORMAT_EXT, 'json')
+POSTER_EXTENSIONS = DOCUMENT_EXTENSIONS + ('png',)
+# 文档格式 → 扩展名
+DOCUMENT_FORMATS = {'binary': POSTER_FORMAT_EXT, 'json': 'json'}
+
+
+def _read_document(path: str) -> Dict[str, Any]:
+    """按扩展名读取二进制或 JSON 文档"""
+    if path.endswith(f".{POSTER_FORMAT_EXT}"):
+        return poster_format.read(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _encode_document(poster_data: Dict[str, Any], document_format: str) -> bytes:
+    if document_format == 'binary':
+        return poster_format.encode(poster_data)
+    return json.dumps(poster_data, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def _atomic_write(path: str, data: bytes):
+    """先写同目录临时文件再 rename，读者不会看到写了一半的文件"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class PosterStore:
+    """分片目录 + SQLite 元数据索引的海报存储"""
+
+    def __init__(self, posters_dir: str, index_path: Optional[str] = None, document_format: Optional[str] = None):
+        """
+        Args:
+            posters_dir: 海报目录
+            index_path: 索引路径，默认 POSTER_INDEX_PATH 或 <posters_dir>/posters.sqlite3
+            document_format: 写入格式 binary / json，默认 POSTER_FORMAT 或 binary
+        """
+        self.posters_dir = posters_dir
+        self.document_format = (document_format or os.getenv('POSTER_FORMAT', 'binary')).lower()
+        if self.document_format not in DOCUMENT_FORMATS:
+            raise ValueError(f"Unsupported poster format: {self.document_format}")
+        os.makedirs(posters_dir, exist_ok=True)
+        self.index_path = index_path or os.getenv(
+            'POSTER_INDEX_PATH', os.path.join(posters_dir, 'posters.sqlite3'))
+        self.index = SQLiteIndex(self.index_path, _SCHEMA)
+        with self.index.transaction() as conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] < _REFERENCES_VERSION \
+                    and conn.execute('SELECT COUNT(*) FROM posters').fetchone()[0] == 0:
+                conn.execute(f'PRAGMA user_version = {_REFERENCES_VERSION}')
+
+    def shard_dir(self, poster_id: str) -> str:
+        """id 的 sha1 前 4 位作为两级子目录（256 x 256 个目录）"""
+        digest = hashlib.sha1(poster_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.posters_dir, digest[:2], digest[2:4])
+
+    def path(self, poster_id: str, ext: str) -> Optional[str]:
+        """
+        海报文件路径（分片目录优先，其次尚未迁移的扁平目录）
+
+        Returns:
+            存在的文件路径；都不存在时返回 None。poster_id 需已经过 safe_id 校验
+        """
+        sharded = os.path.join(self.shard_dir(poster_id), f"{poster_id}.{ext}")
+        if os.path.isfile(sharded):
+            return sharded
+        flat = os.path.join(self.posters_dir, f"{poster_id}.{ext}")
+        if os.path.isfile(flat):
+            return flat
+        return None
+
+    def document_path(self, poster_id: str) -> Optional[str]:
+        """海报文档路径（二进制优先，其次 JSON）"""
+        for ext in DOCUMENT_EXTENSIONS:
+            path = self.path(poster_id, ext)
+            if path is not None:
+                return path
+        return None
+
+    def png_path(self, poster_id: str) -> Optional[str]:
+        return self.path(poster_id, 'png')
+
+    def exists(self, poster_id: str) -> bool:
+        return self.document_path(poster_id) is not None
+
+    def load(self, poster_id: str) -> Optional[Dict[str, Any]]:
+        """读取海报数据；不存在时返回 None"""
+        path = self.document_path(poster_id)
+        if path is None:
+            return None
+        try:
+            return _read_document(path)
+        except FileNotFoundError:
+            # 与迁移 / 删除并发时文件刚被移走
+            return None
+
+    def load_header(self, poster_id: str) -> Optional[Tuple[Dict[str, Any], str]]:
+        """
+        只读取除 elements 外的字段与内容哈希（二进制文档只读前两段，JSON 文档需整篇解析）
+
+        Returns:
+            (字段, poster_data 的规范化哈希)；不存在时返回 None
+        """
+        path = self.document_path(poster_id)
+        if path is None:
+            return None
+        try:
+            if path.endswith(f".{POSTER_FORMAT_EXT}"):
+                head, meta = poster_format.read_header(path)
+                return head, meta['hash']
+            poster_data = _read_document(path)
+        except FileNotFoundError:
+            return None
+        content_hash = canonical_hash(poster_data)
+        poster_data.pop('elements', None)
+        return poster_data, content_hash
+
+    def load_unless(self, poster_id: str,
+                    unchanged: Callable[[str], bool]) -> Optional[Tuple[Optional[Dict[str, Any]], str]]:
+        """
+        条件读取：unchanged(内容哈希) 为 True 时不返回文档。
+        二进制文档只读 META 段判断，JSON 文档只解析一次
+
+        Returns:
+            (海报数据，unchanged 时为 None, 内容哈希)；不存在时返回 None
+        """
+        path = self.document_path(poster_id)
+        if path is None:
+            return None
+        try:
+            if path.endswith(f".{POSTER_FORMAT_EXT}"):
+                return poster_format.read_unless(path, unchanged)
+            poster_data = _read_document(path)
+        except FileNotFoundError:
+            return None
+        content_hash = canonical_hash(poster_data)
+        return (None if unchanged(content_hash) else poster_data), content_hash
+
+    def save(self, poster_id: str, poster_data: Dict[str, Any], png: Optional[bytes] = None):
+        """
+        写入海报（先 PNG 后文档，均为原子替换）并更新索引；
+        另一种格式的旧文档与未迁移的扁平文件在写入分片目录后删除
+        """
+        directory = self.shard_dir(poster_id)
+        os.makedirs(directory, exist_ok=True)
+        document = _encode_document(poster_data, self.document_format)
+        sharded_png = os.path.join(directory, f"{poster_id}.png")
+        flat_png = os.path.join(self.posters_dir, f"{poster_id}.png")
+        if png is not None:
+            _atomic_write(sharded_png, png)
+        elif os.path.isfile(flat_png):
+            # 只更新 JSON 时，把扁平目录中的 PNG 一并移入分片目录
+            os.replace(flat_png, sharded_png)
+        self._write_document(poster_id, document, self.document_format)
+        self._remove_flat(poster_id)
+        png_path = self.png_path(poster_id)
+        self._index(poster_id, poster_data, len(document),
+                    os.path.getsize(png_path) if png_path else 0)
+
+    def _write_document(self, poster_id: str, document: bytes, document_format: str):
+        """写入文档，再删除分片目录中另一种格式的旧文档"""
+        directory = self.shard_dir(poster_id)
+        os.makedirs(directory, exist_ok=True)
+        ext = DOCUMENT_FORMATS[document_format]
+        _atomic_write(os.path.join(directory, f"{poster_id}.{ext}"), document)
+        for other in DOCUMENT_EXTENSIONS:
+            if other != ext:
+                try:
+                    os.remove(os.path.join(directory, f"{poster_id}.{other}"))
+                except FileNotFoundError:
+                    pass
+
+    def delete(self, poster_id: str) -> bool:
+        """删除海报文件与索引；返回是否存在过"""
+        found = False
+        for ext in POSTER_EXTENSIONS:
+            for path in (os.path.join(self.shard_dir(poster_id), f"{poster_id}.{ext}"),
+                         os.path.join(self.posters_dir, f"{poster_id}.{ext}")):
+                try:
+                    os.remove(path)
+                    found = True
+                except FileNotFoundError:
+                    pass
+        with self.index.transaction() as conn:
+            found = conn.execute('DELETE FROM posters WHERE id = ?', (poster_id,)).rowcount > 0 or found
+            conn.execute('DELETE FROM poster_images WHERE poster_id = ?', (poster_id,))
+        return found
+
+    def _index(self, poster_id: str, poster_data: Dict[str, Any], json_bytes: int, png_bytes: int,
+               created_at: Optional[float] = None):
+        size = poster_data.get('size') if isinstance(poster_data.get('size'), dict) else {}
+        now = time.time()
+        with self.index.transaction() as conn:
+            conn.execute(
+                'INSERT INTO posters (id, template_id, width, height, created_at, updated_at, json_bytes, png_bytes) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET template_id = excluded.template_id, width = excluded.width, '
+                'height = excluded.height, updated_at = excluded.updated_at, '
+                'json_bytes = excluded.json_bytes, png_bytes = excluded.png_bytes',
+                (poster_id, poster_data.get('id'), size.get('width'), size.get('height'),
+                 created_at or now, now, json_bytes, png_bytes)
+            )
+            self._index_references(conn, poster_id, poster_data)
+
+    @staticmethod
+    def _index_references(conn, poster_id: str, poster_data: Dict[str, Any]):
+        conn.execute('DELETE FROM poster_images WHERE poster_id = ?', (poster_id,))
+        conn.executemany('INSERT INTO poster_images (poster_id, image_id) VALUES (?, ?)',
+                         [(poster_id, image_id) for image_id in poster_image_ids(poster_data)])
+
+    def referenced_images(self, image_ids: List[str]) -> set:
+        """image_ids 中仍被某张海报引用的 id"""
+        if not image_ids:
+            return set()
+        marks = ','.join('?' for _ in image_ids)
+        rows = self.index.connect().execute(
+            f'SELECT DISTINCT image_id FROM poster_images WHERE image_id IN ({marks})', list(image_ids)
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def references_complete(self) -> bool:
+        """引用索引是否覆盖全部海报：没有未迁移的扁平文件，且旧索引已补齐引用"""
+        version = self.index.connect().execute('PRAGMA user_version').fetchone()[0]
+        if version < _REFERENCES_VERSION:
+            return False
+        with os.scandir(self.posters_dir) as entries:
+            return not any(entry.name.endswith('.json') and entry.is_file() for entry in entries)
+
+    def _remove_flat(self, poster_id: str):
+        for ext in POSTER_EXTENSIONS:
+            try:
+                os.remove(os.path.join(self.posters_dir, f"{poster_id}.{ext}"))
+            except FileNotFoundError:
+                pass
+
+    def list(self, limit: int = 50, offset: int = 0, template_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """按创建时间倒序列出海报元数据"""
+        query = 'SELECT * FROM posters'
+        args: List[Any] = []
+        if template_id:
+            query += ' WHERE template_id = ?'
+            args.append(template_id)
+        query += ' ORDER BY created_at DESC LIMIT ? OFFSET ?'
+        args.extend((limit, offset))
+        return [dict(row) for row in self.index.connect().execute(query, args).fetchall()]
+
+    def count(self, template_id: Optional[str] = None) -> int:
+        if template_id:
+            row = self.index.connect().execute(
+                'SELECT COUNT(*) FROM posters WHERE template_id = ?', (template_id,)).fetchone()
+        else:
+            row = self.index.connect().execute('SELECT COUNT(*) FROM posters').fetchone()
+        return row[0]
+
+    def cleanup(self, older_than: float, dry_run: bool = False, limit: int = 1000) -> List[str]:
+        """
+        删除创建时间早于 older_than（时间戳）的海报，每次最多 limit 张
+
+        Returns:
+            删除（dry_run 时为将要删除）的海报 id
+        """
+        rows = self.index.connect().execute(
+            'SELECT id FROM posters WHERE created_at < ? ORDER BY created_at LIMIT ?', (older_than, limit)
+        ).fetchall()
+        ids = [row['id'] for row in rows]
+        if not dry_run:
+            for poster_id in ids:
+                self.delete(poster_id)
+        return ids
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self.index.connect()
+        row = conn.execute(
+            'SELECT COUNT(*) AS posters, COALESCE(SUM(json_bytes), 0) AS json_bytes, '
+            'COALESCE(SUM(png_bytes), 0) AS png_bytes, MIN(created_at) AS oldest FROM posters'
+        ).fetchone()
+        by_template = {
+            r['template_id'] or 'unknown': r['n']
+            for r in conn.execute('SELECT template_id, COUNT(*) AS n FROM posters GROUP BY template_id')
+        }
+        return {
+            'posters': row['posters'],
+            'json_bytes': row['json_bytes'],
+            'png_bytes': row['png_bytes'],
+            'oldest': row['oldest'],
+            'by_template': by_template,
+        }
+
+    def convert(self, document_format: Optional[str] = None, dry_run: bool = False) -> Dict[str, int]:
+        """
+        把已索引海报的文档转换为指定格式（默认当前写入格式），可重复执行；
+        扁平目录中的海报需先 migrate
+
+        Returns:
+            {converted, unchanged, bytes_before, bytes_after}
+        """
+        document_format = (document_format or self.document_format).lower()
+        target = DOCUMENT_FORMATS[document_format]
+        converted = unchanged = bytes_before = bytes_after = 0
+        for row in self.index.connect().execute('SELECT id FROM posters').fetchall():
+            poster_id = row['id']
+            path = self.document_path(poster_id)
+            if path is None or path.endswith(f".{target}"):
+                unchanged += 1
+                continue
+            before = os.stat(path)
+            document = _encode_document(_read_document(path), document_format)
+            bytes_before += before.st_size
+            bytes_after += len(document)
+            converted += 1
+            if dry_run:
+                continue
+            try:
+                if os.stat(path).st_mtime_ns != before.st_mtime_ns:
+                    # 转换期间海报被更新（新文档已按服务的写入格式保存），跳过
+                    continue
+            except FileNotFoundError:
+                continue
+            self._write_document(poster_id, document, document_format)
+            self._remove_flat(poster_id)
+            with self.index.transaction() as conn:
+                conn.execute('UPDATE posters SET json_bytes = ? WHERE id = ?', (len(document), poster_id))
+        return {'converted': converted, 'unchanged': unchanged,
+                'bytes_before': bytes_before, 'bytes_after': bytes_after}
+
+    def migrate(self, dry_run: bool = False) -> Dict[str, int]:
+        """
+        把扁平目录中的海报移入分片目录并建立索引，同时补齐分片目录中缺失的索引记录；
+        可重复执行，中途中断后再次运行即可继续
+
+        Returns:
+            {moved, indexed, skipped}
+        """
+        moved = indexed = skipped = 0
+        with os.scandir(self.posters_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith('.json'):
+                    continue
+                poster_id = entry.name[:-len('.json')]
+                try:
+                    with open(entry.path, 'r', encoding='utf-8') as f:
+                        poster_data = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"Skipping {entry.name}: {e}")
+                    skipped += 1
+                    continue
+                created_at = entry.stat().st_mtime
+                moved += 1
+                if dry_run:
+                    continue
+                directory = self.shard_dir(poster_id)
+                os.makedirs(directory, exist_ok=True)
+                # 先移 PNG 再移 JSON：中断时 JSON 仍在扁平目录，下次重新处理
+                flat_png = os.path.join(self.posters_dir, f"{poster_id}.png")
+                if os.path.isfile(flat_png):
+                    os.replace(flat_png, os.path.join(directory, f"{poster_id}.png"))
+                os.replace(entry.path, os.path.join(directory, f"{poster_id}.json"))
+                self._index_existing(poster_id, poster_data, created_at)
+        indexed = self._reindex_shards(dry_run)
+        if not dry_run:
+            self._backfill_references()
+        return {'moved': moved, 'indexed': indexed, 'skipped': skipped}
+
+    def _backfill_references(self):
+        """为引用表出现之前建立的索引补齐海报引用的上传图片"""
+        conn = self.index.connect()
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= _REFERENCES_VERSION:
+            return
+        for row in conn.execute('SELECT id FROM posters').fetchall():
+            poster_data = self.load(row['id'])
+            if poster_data is not None:
+                with self.index.transaction() as tx:
+                    self._index_references(tx, row['id'], poster_data)
+        conn.execute(f'PRAGMA user_version = {_REFERENCES_VERSION}')
+
+    def _index_existing(self, poster_id: str, poster_data: Dict[str, Any], created_at: float):
+        document_path = self.document_path(poster_id)
+        png_path = self.png_path(poster_id)
+        self._index(poster_id, poster_data, os.path.getsize(document_path) if document_path else 0,
+                    os.path.getsize(png_path) if png_path else 0, created_at=created_at)
+
+    def _reindex_shards(self, dry_run: bool = False) -> int:
+        """为分片目录中没有索引记录的海报补建索引（如索引文件丢失后）"""
+        known = {row[0] for row in self.index.connect().execute('SELECT id FROM posters')}
+        indexed = 0
+        for first in sorted(os.listdir(self.posters_dir)):
+            first_dir = os.path.join(self.posters_dir, first)
+            if len(first) != 2 or not os.path.isdir(first_dir):
+                continue
+            for second in os.listdir(first_dir):
+                second_dir = os.path.join(first_dir, second)
+                if not os.path.isdir(second_dir):
+                    continue
+                for name in os.listdir(second_dir):
+                    poster_id, _, ext = name.rpartition('.')
+                    if ext not in DOCUMENT_EXTENSIONS or poster_id in known:
+                        continue
+                    path = os.path.join(second_dir, name)
+                    try:
+                        poster_data = _read_document(path)
+                    except (OSError, ValueError) as e:
+                        print(f"Skipping {path}: {e}")
+                        continue
+                    known.add(poster_id)
+                    indexed += 1
+                    if not dry_run:
+                        self._index_existing(poster_id, poster_data, os.path.getmtime(path))
+        return indexed
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='海报存储维护工具')
+    parser.add_argument('--posters-dir', default=os.environ.get('POSTERS_DIR', '/tmp/posters'))
+    sub = parser.add_subparsers(dest='command', required=True)
+    migrate = sub.add_parser('migrate', help='扁平目录迁移到分片目录并建立索引')
+    migrate.add_argument('--dry-run', action='store_true')
+    sub.add_parser('stats', help='索引统计')
+    listing = sub.add_parser('list', help='按创建时间倒序列出海报')
+    listing.add_argument('--limit', type=int, default=20)
+    listing.add_argument('--template-id')
+    cleanup = sub.add_parser('cleanup', help='删除早于指定天数的海报')
+    cleanup.add_argument('--older-than-days', type=float, required=True)
+    cleanup.add_argument('--dry-run', action='store_true')
+    convert = sub.add_parser('convert', help='把已有海报文档转换为二进制（或 JSON）格式')
+    convert.add_argument('--to', choices=sorted(DOCUMENT_FORMATS), default='binary')
+    convert.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args(argv)
+
+    store = PosterStore(args.posters_dir)
+    if args.command == 'migrate':
+        result = store.migrate(dry_run=args.dry_run)
+    elif args.command == 'stats':
+        result = store.stats()
+    elif args.command == 'list':
+        result = store.list(limit=args.limit, template_id=args.template_id)
+    elif args.command == 'convert':
+        result = store.convert(args.to, dry_run=args.dry_run)
+    else:
+        result = store.cleanup(time.time() - args.older_than_days * 86400, dry_run=args.dry_run)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
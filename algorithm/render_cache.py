@@ -0,0 +1,138 @@
+"""
+渲染结果缓存模块
+按 poster_data 规范化哈希 + 输出格式 + 编码参数寻址，
+磁盘层放在 POSTERS_DIR 旁边，内存层为按字节数限制的 LRU；
+目录按海报 id 分组，更新海报时只清理该海报自己的条目
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from io import BytesIO
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+from path_utils import touch
+
+
+def canonical_hash(poster_data: Dict[str, Any]) -> str:
+    """poster_data 的规范化哈希（键排序、紧凑分隔符），与字段顺序和缩进无关"""
+    raw = json.dumps(poster_data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """渲染结果两级缓存：内存 LRU + 磁盘"""
+
+    def __init__(self, cache_dir: str, max_memory_bytes: Optional[int] = None):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_memory_bytes = max_memory_bytes if max_memory_bytes is not None else int(
+            float(os.getenv('RENDER_CACHE_MEMORY_MB', '64')) * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def make_key(self, poster_data: Optional[Dict[str, Any]], fmt: str,
+                 params: Optional[Dict[str, Any]] = None, content_hash: Optional[str] = None) -> str:
+        """缓存键：内容哈希（已知时直接传入 content_hash，不必计算）+ 格式 + 编码参数"""
+        raw = json.dumps({
+            'data': content_hash or canonical_hash(poster_data),
+            'format': fmt.upper(),
+            'params': params or {},
+        }, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _path(self, poster_id: str, key: str, ext: str) -> str:
+        return os.path.join(self.cache_dir, poster_id, f"{key}.{ext}")
+
+    def get(self, poster_id: str, key: str, ext: str) -> Tuple[Optional[Union[BytesIO, str]], str]:
+        """
+        查找缓存
+
+        Returns:
+            (内容, 来源)：内存命中返回 BytesIO，磁盘命中返回文件路径（由 send_file 直接流式发送），
+            未命中返回 (None, 'miss')
+        """
+        with self._lock:
+            data = self._memory.get((poster_id, key))
+            if data is not None:
+                self._memory.move_to_end((poster_id, key))
+                self.memory_hits += 1
+                return BytesIO(data), 'memory'
+        path = self._path(poster_id, key, ext)
+        if os.path.isfile(path):
+            # mtime 记作最近使用时间，存储生命周期按它做 LRU 淘汰
+            touch(path)
+            with self._lock:
+                self.disk_hits += 1
+            return path, 'disk'
+        with self._lock:
+            self.misses += 1
+        return None, 'miss'
+
+    def put(self, poster_id: str, key: str, ext: str, data: bytes):
+        """写入两级缓存（磁盘先写临时文件再原子替换，避免多 worker 读到半个文件）"""
+        path = self._path(poster_id, key, ext)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to write render cache {path}: {e}")
+        self._remember(poster_id, key, data)
+
+    def _remember(self, poster_id: str, key: str, data: bytes):
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop((poster_id, key), None)
+            if old is not None:
+                self._memory_bytes -= len(old)
+            self._memory[(poster_id, key)] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def get_or_render(self, poster_id: str, poster_data: Optional[Dict[str, Any]], fmt: str, ext: str,
+                      render: Callable[[], BytesIO],
+                      params: Optional[Dict[str, Any]] = None,
+                      content_hash: Optional[str] = None) -> Tuple[Union[BytesIO, str], str]:
+        """
+        命中则直接返回缓存，否则调用 render() 渲染并写入缓存；
+        传入 content_hash 时 poster_data 可为 None（由 render 自行加载），命中时无需读取整个文档
+        """
+        key = self.make_key(poster_data, fmt, params, content_hash)
+        cached, source = self.get(poster_id, key, ext)
+        if cached is not None:
+            return cached, source
+        data = render().getvalue()
+        self.put(poster_id, key, ext, data)
+        return BytesIO(data), 'miss'
+
+    def invalidate(self, poster_id: str):
+        """清理某张海报的全部缓存条目（其他海报不受影响）"""
+        with self._lock:
+            for mem_key in [k for k in self._memory if k[0] == poster_id]:
+                self._memory_bytes -= len(self._memory.pop(mem_key))
+        shutil.rmtree(os.path.join(self.cache_dir, poster_id), ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """命中统计"""
+        with self._lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes,
+            }
@@ -0,0 +1,325 @@
+"""
+渲染进程池模块
+PosterRenderer.render / render_to_pdf 是 CPU 密集的 Pillow 工作（背景、文字栅格化、PNG 压缩），
+放到预先启动的进程池里执行：poster_data 进、编码好的字节出。
+同步接口保持不变（返回 BytesIO），RENDER_POOL_SIZE=0 时退化为在当前进程内渲染。
+超时从任务在子进程中开始执行时计算（排队时间不算）：子进程用 SIGALRM 中断超时的任务，进程本身继续服务；
+卡在 C 代码里收不到信号的任务，超过 RENDER_KILL_GRACE 秒（默认 5）后由父进程只终止该子进程
+"""
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from encoder import EncodeStats
+
+# 预热字号：模板常用的标题 / 副标题 / 描述字号
+WARM_FONT_SIZES = (18, 20, 24, 28, 48, 56, 64)
+
+_worker_renderer = None
+# 子进程向父进程报告任务开始：(任务 id, pid, 开始时间)
+_worker_started = None
+
+
+class RenderTimeout(BaseException):
+    """任务在子进程中执行超时（继承 BaseException：渲染代码里的 except Exception 不会吞掉它）"""
+
+
+def _init_worker(started=None):
+    """子进程初始化：创建渲染器并预加载常用字号，首个任务不再付解析字体的开销"""
+    global _worker_renderer, _worker_started
+    _worker_started = started
+    from poster_renderer import PosterRenderer
+    _worker_renderer = PosterRenderer()
+    for size in WARM_FONT_SIZES:
+        _worker_renderer.fonts.get_font(size)
+
+
+def _on_alarm(signum, frame):
+    raise RenderTimeout()
+
+
+def _tracked_task(task_id: str, timeout: float, task: Callable[..., Any], *args) -> Any:
+    """在子进程中执行任务：报告开始时间与 pid，超时由 SIGALRM 中断"""
+    if _worker_started is not None:
+        _worker_started.put((task_id, os.getpid(), time.time()))
+    previous = signal.signal(signal.SIGALRM, _on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return task(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _warmup_task() -> int:
+    return os.getpid()
+
+
+def _prewarm_task(size: Tuple[int, int], background: Dict[str, Any]) -> int:
+    _worker_renderer.backgrounds.render(size, background)
+    return os.getpid()
+
+
+def _render_task(poster_data: Dict[str, Any], fmt: str,
+                 params: Optional[Dict[str, Any]]) -> Tuple[bytes, Dict[str, Any]]:
+    output, info = _worker_renderer.render_encoded(poster_data, format=fmt, params=params)
+    return output.getvalue(), info
+
+
+def _render_pdf_task(poster_data: Dict[str, Any]) -> bytes:
+    return _worker_renderer.render_to_pdf(poster_data).getvalue()
+
+
+def _render_update_task(old_data: Dict[str, Any], new_data: Dict[str, Any], base_path: str,
+                        fmt: str, dirty_ids: Optional[List[str]],
+                        params: Optional[Dict[str, Any]]) -> Tuple[bytes, Dict[str, Any]]:
+    output, info = _worker_renderer.render_update(old_data, new_data, base_path, format=fmt,
+                                                  dirty_ids=dirty_ids, params=params)
+    return output.getvalue(), info
+
+
+class RenderExecutor:
+    """渲染执行器：进程池 + 超时控制，同步包装接口与 PosterRenderer 一致"""
+
+    def __init__(self, renderer, pool_size: Optional[int] = None, timeout: Optional[float] = None):
+        """
+        Args:
+            renderer: 当前进程内的 PosterRenderer（进程池关闭或不可用时直接使用）
+            pool_size: 进程数，默认 RENDER_POOL_SIZE 或 min(4, CPU 核数)；0 表示不用进程池
+            timeout: 单个渲染任务超时（秒），默认 RENDER_TASK_TIMEOUT 或 30
+        """
+        self.renderer = renderer
+        default_size = min(4, os.cpu_count() or 1)
+        self.pool_size = pool_size if pool_size is not None else int(
+            os.getenv('RENDER_POOL_SIZE', str(default_size)))
+        self.timeout = timeout if timeout is not None else float(os.getenv('RENDER_TASK_TIMEOUT', '30'))
+        self.kill_grace = float(os.getenv('RENDER_KILL_GRACE', '5'))
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_pid: Optional[int] = None
+        # 子进程报告的任务开始信息：任务 id → (pid, 开始时间)
+        self._started: Dict[str, Tuple[int, float]] = {}
+        self._started_queue = None
+        self.tasks = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.kills = 0
+        self.retries = 0
+        self.inline = 0
+        self.prewarms = 0
+        # 按格式统计编码耗时与字节数（子进程返回的编码信息在这里汇总）
+        self.encoding = EncodeStats()
+
+    def start(self):
+        """启动进程池并异步预热所有子进程（不阻塞调用方）"""
+        pool = self._get_pool()
+        if pool is None:
+            return
+        try:
+            for _ in range(self.pool_size):
+                pool.submit(_warmup_task)
+        except RuntimeError:
+            # spawn 子进程导入主模块期间（如 python app.py）不能再启动进程，留给真正的服务进程
+            self._reset_pool(pool)
+
+    def _get_pool(self) -> Optional[ProcessPoolExecutor]:
+        """按当前 pid 获取进程池；gunicorn fork 出的 worker 各自创建"""
+        if self.pool_size <= 0:
+            return None
+        if multiprocessing.parent_process() is not None:
+            # 本身就是进程池子进程，不再嵌套建池
+            return None
+        pid = os.getpid()
+        with self._lock:
+            if self._pool is None or self._pool_pid != pid:
+                # spawn：子进程不继承父进程的线程与锁，和后台探测/任务线程共存更安全
+                ctx = multiprocessing.get_context('spawn')
+                if self._pool_pid != pid:
+                    self._started_queue = ctx.SimpleQueue()
+                    self._started.clear()
+                    threading.Thread(target=self._collect_started, args=(self._started_queue,),
+                                     name='render-started', daemon=True).start()
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.pool_size, mp_context=ctx, initializer=_init_worker,
+                    initargs=(self._started_queue,)
+                )
+                self._pool_pid = pid
+            return self._pool
+
+    def _reset_pool(self, pool: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _collect_started(self, started_queue):
+        """后台线程：收集子进程报告的任务开始信息"""
+        while True:
+            try:
+                task_id, pid, started = started_queue.get()
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                self._started[task_id] = (pid, started)
+                if len(self._started) > 1000:
+                    # 任务先于开始信息结束时条目不会被 _run 取走，清理很久以前的
+                    horizon = time.time() - self.timeout - self.kill_grace - 60
+                    for stale in [k for k, (_, t) in self._started.items() if t < horizon]:
+                        del self._started[stale]
+
+    def _wait(self, future, task_id: str) -> Any:
+        """
+        等待任务结果；超时从任务开始执行时计算。子进程没能按时中断任务时，
+        超过宽限时间后只终止执行该任务的子进程
+
+        Raises:
+            RenderTimeout: 任务超时；子进程被终止时带上其 pid
+        """
+        while True:
+            with self._lock:
+                started = self._started.get(task_id)
+            if started is None:
+                # 还在排队：等待开始或完成，不计入超时
+                try:
+                    return future.result(timeout=0.5)
+                except FutureTimeoutError:
+                    continue
+            pid, started_at = started
+            remaining = started_at + self.timeout + self.kill_grace - time.time()
+            try:
+                return future.result(timeout=max(0.0, remaining))
+            except FutureTimeoutError:
+                pass
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            with self._lock:
+                self.kills += 1
+            raise RenderTimeout(pid)
+
+    def _run(self, task: Callable[..., Any], inline: Callable[[], Any], *args, retry: bool = True) -> Any:
+        pool = self._get_pool()
+        if pool is None:
+            with self._lock:
+                self.inline += 1
+            return inline()
+        with self._lock:
+            self.tasks += 1
+        task_id = uuid.uuid4().hex
+        try:
+            future = pool.submit(_tracked_task, task_id, self.timeout, task, *args)
+        except (BrokenProcessPool, RuntimeError):
+            self._reset_pool(pool)
+            with self._lock:
+                self.failures += 1
+            return inline()
+        try:
+            return self._wait(future, task_id)
+        except RenderTimeout as e:
+            if e.args:
+                # 子进程已被终止，进程池不可再用；其他进行中的任务会收到 BrokenProcessPool 并在新池中重试
+                self._reset_pool(pool)
+            with self._lock:
+                self.timeouts += 1
+            raise Exception(f"Render timed out after {self.timeout}s")
+        except (BrokenProcessPool, CancelledError):
+            # 子进程崩溃（或超时任务所在子进程被终止，排队的任务随旧进程池取消）：
+            # 重建进程池后重试一次，仍失败才在当前进程内渲染
+            self._reset_pool(pool)
+            with self._lock:
+                self.failures += 1
+            if retry:
+                with self._lock:
+                    self.retries += 1
+                return self._run(task, inline, *args, retry=False)
+            return inline()
+        finally:
+            with self._lock:
+                self._started.pop(task_id, None)
+
+    def prewarm(self, size: Tuple[int, int], background: Dict[str, Any]):
+        """
+        提前生成背景层（不等待结果）：LLM 还在输出文案时，模板与配色一确定就开始准备背景。
+        每个子进程各自缓存背景，向池中提交 pool_size 个任务，尽量让空闲的子进程都预热到
+        """
+        size = (int(size[0]), int(size[1]))
+        with self._lock:
+            self.prewarms += 1
+        pool = self._get_pool()
+        if pool is None:
+            threading.Thread(target=self.renderer.backgrounds.render, args=(size, background),
+                             name='background-prewarm', daemon=True).start()
+            return
+        try:
+            for _ in range(self.pool_size):
+                pool.submit(_prewarm_task, size, background)
+        except (BrokenProcessPool, RuntimeError):
+            # 预热失败不影响正式渲染，正式渲染时会重建进程池
+            pass
+
+    def render(self, poster_data: Dict[str, Any], format: str = "PNG",
+               params: Optional[Dict[str, Any]] = None) -> BytesIO:
+        """渲染海报（同 PosterRenderer.render）"""
+        return self.render_encoded(poster_data, format, params)[0]
+
+    def render_encoded(self, poster_data: Dict[str, Any], format: str = "PNG",
+                       params: Optional[Dict[str, Any]] = None) -> Tuple[BytesIO, Dict[str, Any]]:
+        """渲染海报并返回编码信息（同 PosterRenderer.render_encoded）"""
+        def inline():
+            output, info = self.renderer.render_encoded(poster_data, format=format, params=params)
+            return output.getvalue(), info
+
+        data, info = self._run(_render_task, inline, poster_data, format, params)
+        self.encoding.record(info)
+        return BytesIO(data), info
+
+    def render_to_pdf(self, poster_data: Dict[str, Any]) -> BytesIO:
+        """渲染为 PDF（同 PosterRenderer.render_to_pdf）"""
+        data = self._run(_render_pdf_task, lambda: self.renderer.render_to_pdf(poster_data).getvalue(),
+                         poster_data)
+        return BytesIO(data)
+    
+    def render_update(self, old_data: Dict[str, Any], new_data: Dict[str, Any], base_path: str,
+                      format: str = "PNG", dirty_ids: Optional[Iterable[str]] = None,
+                      params: Optional[Dict[str, Any]] = None) -> Tuple[BytesIO, Dict[str, Any]]:
+        """增量渲染（同 PosterRenderer.render_update，底图以文件路径传给子进程）"""
+        ids = list(dirty_ids) if dirty_ids is not None else None
+        
+        def inline():
+            output, info = self.renderer.render_update(old_data, new_data, base_path, format=format,
+                                                       dirty_ids=ids, params=params)
+            return output.getvalue(), info
+        
+        data, info = self._run(_render_update_task, inline, old_data, new_data, base_path, format, ids, params)
+        self.encoding.record(info.get('encode'))
+        return BytesIO(data), info
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'running': self._pool is not None and self._pool_pid == os.getpid(),
+                'timeout': self.timeout,
+                'tasks': self.tasks,
+                'timeouts': self.timeouts,
+                'failures': self.failures,
+                'kills': self.kills,
+                'retries': self.retries,
+                'inline': self.inline,
+                'prewarms': self.prewarms,
+                'encoding': self.encoding.stats(),
+            }
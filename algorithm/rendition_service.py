@@ -0,0 +1,130 @@
+"""
+海报缩略图 / 多分辨率版本模块
+/poster/<id>/image?w=&format= 按需从已存 PNG 缩放并转码，生成一次后落盘复用。
+版本号取自源 PNG 的 (mtime, size)：ETag / Last-Modified 只需 stat，不读图片内容；
+海报更新后源 PNG 变化，旧版本文件随之失效并在更新时清理
+"""
+import os
+import shutil
+import threading
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image
+
+from encoder import IMAGE_FORMATS, encode_image, resolve_encoder
+from path_utils import touch
+from poster_store import PosterStore
+
+
+class Rendition:
+    """一个可发送的图片版本"""
+
+    __slots__ = ('path', 'mimetype', 'etag', 'last_modified')
+
+    def __init__(self, path: str, mimetype: str, etag: str, last_modified: float):
+        self.path = path
+        self.mimetype = mimetype
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class RenditionStore:
+    """海报图片的尺寸 / 格式版本：懒生成 + 磁盘持久化"""
+
+    def __init__(self, posters: PosterStore, renditions_dir: str, widths: Optional[Tuple[int, ...]] = None):
+        """
+        Args:
+            posters: 海报存储（源 PNG 所在）
+            renditions_dir: 版本文件目录，按海报 id 分子目录
+            widths: 允许的宽度，默认 RENDITION_WIDTHS 或 200,400,800；请求宽度向上取整到其中之一
+        """
+        self.posters = posters
+        self.renditions_dir = renditions_dir
+        os.makedirs(renditions_dir, exist_ok=True)
+        raw_widths = widths or [int(w) for w in os.getenv('RENDITION_WIDTHS', '200,400,800').split(',') if w.strip()]
+        self.widths = tuple(sorted(set(w for w in raw_widths if w > 0)))
+        self._lock = threading.Lock()
+        self.generated = 0
+        self.reused = 0
+
+    def resolve(self, poster_id: str, width: Optional[int] = None,
+                fmt: Optional[str] = None) -> Optional[Rendition]:
+        """
+        只根据源文件 stat 计算版本信息（用于条件请求判断），不生成文件
+
+        Returns:
+            Rendition（path 可能尚不存在）；海报不存在时返回 None
+
+        Raises:
+            ValueError: 不支持的格式
+        """
+        fmt = (fmt or 'png').lower()
+        if fmt not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported format: {fmt}")
+        source = self.posters.png_path(poster_id)
+        if source is None:
+            return None
+        try:
+            st = os.stat(source)
+        except FileNotFoundError:
+            return None
+        _, ext, mimetype = IMAGE_FORMATS[fmt]
+        version = f"{st.st_mtime_ns:x}{st.st_size:x}"
+        width = self._snap_width(width)
+        if width is None and ext == 'png':
+            # 原尺寸 PNG 即源文件本身
+            return Rendition(source, mimetype, f"{poster_id}-{version}", st.st_mtime)
+        label = width or 'full'
+        path = os.path.join(self.renditions_dir, poster_id, f"{version}-{label}.{ext}")
+        return Rendition(path, mimetype, f"{poster_id}-{version}-{label}-{ext}", st.st_mtime)
+
+    def ensure(self, poster_id: str, rendition: Rendition, width: Optional[int], fmt: Optional[str]) -> Rendition:
+        """版本文件不存在时从源 PNG 生成（缩放 + 转码，原子写入）"""
+        if os.path.isfile(rendition.path):
+            # 版本号取自源 PNG，刷新版本文件自身的 mtime 不影响 ETag，只供 LRU 淘汰参考
+            if rendition.path.startswith(self.renditions_dir + os.sep):
+                touch(rendition.path)
+            with self._lock:
+                self.reused += 1
+            return rendition
+        pil_format = IMAGE_FORMATS[(fmt or 'png').lower()][0]
+        width = self._snap_width(width)
+        source = self.posters.png_path(poster_id)
+        if source is None:
+            raise FileNotFoundError(f"Poster image not found: {poster_id}")
+        with Image.open(source) as img:
+            if width is not None and width < img.width:
+                height = max(1, round(img.height * width / img.width))
+                img = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=2.0)
+            # 网页展示统一用 web 档位（PNG 量化、WEBP / JPEG 有损）
+            output, _ = encode_image(img, pil_format, resolve_encoder(pil_format, 'web')[1])
+        os.makedirs(os.path.dirname(rendition.path), exist_ok=True)
+        tmp_path = f"{rendition.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(output.getvalue())
+        os.replace(tmp_path, rendition.path)
+        with self._lock:
+            self.generated += 1
+        return rendition
+
+    def _snap_width(self, width: Optional[int]) -> Optional[int]:
+        """宽度向上取整到允许值，超过最大值时返回 None（原尺寸）"""
+        if not width or width <= 0:
+            return None
+        for w in self.widths:
+            if w >= width:
+                return w
+        return None
+
+    def invalidate(self, poster_id: str):
+        """海报更新后删除其全部版本文件"""
+        shutil.rmtree(os.path.join(self.renditions_dir, poster_id), ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'widths': list(self.widths),
+                'generated': self.generated,
+                'reused': self.reused,
+            }
@@ -0,0 +1,49 @@
+"""
+嵌入式 SQLite 索引
+上传存储与海报存储共用：每个线程一个连接（fork 后重新打开），WAL 模式，
+写事务用 BEGIN IMMEDIATE，多个 gunicorn worker 之间安全
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class SQLiteIndex:
+    """线程本地连接 + 建表 + 写事务"""
+
+    def __init__(self, path: str, schema: str):
+        """
+        Args:
+            path: 数据库文件路径（所在目录不存在时创建）
+            schema: 建表语句（CREATE ... IF NOT EXISTS），首次连接时执行
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        self.connect().executescript(schema)
+
+    def connect(self) -> sqlite3.Connection:
+        """当前线程的连接（自动提交模式，显式事务见 transaction）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """写事务：进入时加写锁，异常时回滚"""
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
@@ -0,0 +1,103 @@
+"""
+模板预编译模块
+模板在加载时编译一次：元素按 id 建索引；
+应用设计时只为被覆盖的字段创建新 dict（写时复制），其余部分逐层浅拷贝，
+整个过程 O(元素数)，不再需要 json 序列化往返
+"""
+from typing import Any, Dict, Optional
+
+# 只接受顶层字段的旧版 LLM 返回：字段名 → 元素 id
+TOP_LEVEL_FIELDS = ('title', 'subtitle', 'description')
+
+
+def _copy_value(value: Any) -> Any:
+    """模板里的嵌套值（列表 / dict）复制一份，避免海报数据与模板共享可变对象"""
+    if isinstance(value, dict):
+        return {k: _copy_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_value(v) for v in value]
+    return value
+
+
+class CompiledElement:
+    """编译后的模板元素"""
+
+    __slots__ = ('id', 'type', 'base', 'position', 'style')
+
+    def __init__(self, element: Dict[str, Any]):
+        self.id = element.get('id')
+        self.type = element.get('type', 'text')
+        # 保留原字段顺序；position / style 在生成时单独处理
+        self.base = {k: _copy_value(v) for k, v in element.items()}
+        self.position = dict(element.get('position') or {})
+        self.style = dict(element.get('style') or {})
+
+    def materialize(self, content: Any = None, overlay: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """生成海报元素 dict：content 覆盖，position / style 与覆盖值浅合并"""
+        element = {k: v if k in ('position', 'style') else _copy_value(v) for k, v in self.base.items()}
+        position, style = self.position, self.style
+        if content is not None:
+            element['content'] = content
+        if overlay:
+            if 'content' in overlay:
+                element['content'] = overlay['content']
+            if isinstance(overlay.get('position'), dict):
+                position = {**position, **overlay['position']}
+            if isinstance(overlay.get('style'), dict):
+                style = {**style, **overlay['style']}
+        element['position'] = dict(position) if position is self.position else position
+        element['style'] = dict(style) if style is self.style else style
+        return element
+
+
+class CompiledTemplate:
+    """编译后的模板"""
+
+    __slots__ = ('id', 'name', 'category', 'size', 'background', 'extra',
+                 'elements', 'index', 'source')
+
+    def __init__(self, template: Dict[str, Any]):
+        self.source = template
+        self.id = template.get('id')
+        self.name = template.get('name')
+        self.category = template.get('category')
+        self.size = dict(template.get('size') or {})
+        self.background = dict(template.get('background') or {})
+        self.extra = {k: v for k, v in template.items()
+                      if k not in ('id', 'name', 'category', 'size', 'background', 'elements')}
+        self.elements = tuple(CompiledElement(el) for el in template.get('elements') or [])
+        self.index = {el.id: i for i, el in enumerate(self.elements) if el.id}
+
+    def apply_design(self, design: Dict[str, Any]) -> Dict[str, Any]:
+        """将设计应用到模板，返回新的海报数据（不修改模板）"""
+        # 1. 顶层 title / subtitle / description（兼容只返回字段的 LLM）
+        contents = {key: design.get(key, "") for key in TOP_LEVEL_FIELDS
+                    if key in design and key in self.index}
+        # 2. LLM 返回的 elements（按 id 覆盖 content / position / style）
+        overlays = {el['id']: el for el in design.get('elements') or []
+                    if isinstance(el, dict) and el.get('id') in self.index}
+
+        poster_data = {
+            'id': self.id,
+            'name': self.name,
+            'category': self.category,
+            'size': dict(self.size),
+            'background': _copy_value(self.background),
+            'elements': [el.materialize(contents.get(el.id), overlays.get(el.id)) for el in self.elements],
+        }
+        poster_data.update((k, _copy_value(v)) for k, v in self.extra.items())
+
+        # 3. 配色方案
+        if 'color_scheme' in design:
+            poster_data['color_scheme'] = design['color_scheme']
+            if poster_data['background'].get('type') == 'gradient':
+                cs = design['color_scheme']
+                primary = cs.get('primary', '#4A90E2')
+                secondary = cs.get('secondary', '#FFFFFF')
+                poster_data['background']['colors'] = [primary, secondary]
+        return poster_data
+
+
+def compile_template(template: Dict[str, Any]) -> CompiledTemplate:
+    """编译模板"""
+    return CompiledTemplate(template)
@@ -1,9 +1,10 @@
 """
 模板管理服务
 """
-import json
-import os
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
+
+from template_compiler import CompiledTemplate, compile_template
+from template_store import EMPTY_LISTING_BODY, EMPTY_LISTING_ETAG, TemplateStore
 
 # 默认模板库
 DEFAULT_TEMPLATES = {
@@ -143,78 +144,43 @@ DEFAULT_TEMPLATES = {
 class TemplateService:
     """模板管理服务"""
     
-    def __init__(self):
-        self.templates = DEFAULT_TEMPLATES.copy()
-        self._load_custom_templates()
+    def __init__(self, templates_dir: Optional[str] = None):
+        # 内置模板 + TEMPLATES_DIR 自定义模板，加载时校验、编译并建索引，目录变化时热加载
+        self.store = TemplateStore(DEFAULT_TEMPLATES, templates_dir=templates_dir)
     
-    def _load_custom_templates(self):
-        """加载自定义模板（从文件或数据库）"""
-        # 可以扩展从数据库或文件加载
-        pass
+    @property
+    def templates(self) -> Dict[str, Dict[str, Any]]:
+        return self.store.snapshot.templates
     
     def get_template(self, template_id: str) -> Dict[str, Any]:
         """获取模板"""
-        return self.templates.get(template_id)
+        return self.store.snapshot.templates.get(template_id)
+    
+    def get_compiled(self, template_id: str) -> Optional[CompiledTemplate]:
+        """获取编译后的模板"""
+        return self.store.snapshot.compiled.get(template_id)
     
     def list_templates(self, category: str = None) -> List[Dict[str, Any]]:
-        """获取模板列表"""
-        templates = list(self.templates.values())
-        
-        if category:
-            templates = [t for t in templates if t.get('category') == category]
+        """获取模板列表（只含基本信息，加载时已预先计算）"""
+        return self.list_templates_cached(category)[0]
+    
+    def list_templates_cached(self, category: str = None) -> Tuple[List[Dict[str, Any]], str, bytes]:
+        """
+        获取预先计算的模板列表
         
-        # 只返回基本信息
-        return [
-            {
-                "id": t["id"],
-                "name": t["name"],
-                "category": t["category"],
-                "size": t["size"]
-            }
-            for t in templates
-        ]
+        Returns:
+            (摘要列表, ETag, 序列化好的 {"templates": [...]} 响应体)
+        """
+        listing = self.store.snapshot.listings.get(category or None)
+        if listing is None:
+            # 不存在的分类：空列表
+            return [], EMPTY_LISTING_ETAG, EMPTY_LISTING_BODY
+        return listing
     
     def apply_design_to_template(self, template: Dict[str, Any], design: Dict[str, Any]) -> Dict[str, Any]:
         """将设计应用到模板（含 LLM 返回的 elements：content / position / style）"""
-        # 复制模板
-        poster_data = json.loads(json.dumps(template))
-        
-        # 1. 应用顶层 title / subtitle / description（兼容只返回字段的 LLM）
-        if "title" in design:
-            for element in poster_data["elements"]:
-                if element["id"] == "title":
-                    element["content"] = design["title"]
-        if "subtitle" in design:
-            for element in poster_data["elements"]:
-                if element["id"] == "subtitle":
-                    element["content"] = design.get("subtitle", "")
-        if "description" in design:
-            for element in poster_data["elements"]:
-                if element["id"] == "description":
-                    element["content"] = design.get("description", "")
-        
-        # 2. 应用 LLM 返回的 elements（按 id 覆盖 content / position / style）
-        design_elements = design.get("elements") or []
-        by_id = {el["id"]: el for el in design_elements if el.get("id")}
-        for element in poster_data["elements"]:
-            eid = element.get("id")
-            if eid not in by_id:
-                continue
-            de = by_id[eid]
-            if "content" in de:
-                element["content"] = de["content"]
-            if "position" in de and isinstance(de["position"], dict):
-                element["position"] = {**element.get("position", {}), **de["position"]}
-            if "style" in de and isinstance(de["style"], dict):
-                element["style"] = {**element.get("style", {}), **de["style"]}
-        
-        # 3. 应用配色方案
-        if "color_scheme" in design:
-            poster_data["color_scheme"] = design["color_scheme"]
-            if "background" in poster_data and poster_data["background"]["type"] == "gradient":
-                cs = design["color_scheme"]
-                primary = cs.get("primary", "#4A90E2")
-                secondary = cs.get("secondary", "#FFFFFF")
-                poster_data["background"]["colors"] = [primary, secondary]
-        
-        return poster_data
+        compiled = self.get_compiled(template.get("id"))
+        if compiled is None or compiled.source is not template:
+            # 不是已注册的模板（或调用方传入了修改过的副本）：临时编译
+            compiled = compile_template(template)
+        return compiled.apply_design(design)
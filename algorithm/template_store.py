@@ -0,0 +1,278 @@
+"""
+模板存储模块
+内置模板 + TEMPLATES_DIR 目录下的自定义模板（每个 *.json 为一个模板或模板数组）。
+模板加载时校验并编译一次，按 id / 分类建索引，列表摘要与 ETag 预先计算；
+后台线程按 mtime 轮询目录，只重新加载变化的文件，gunicorn worker 无需重启。
+读取方拿到的是整体替换的不可变快照，读路径不加锁
+"""
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from background_engine import parse_color
+from path_utils import safe_id
+from template_compiler import CompiledTemplate, compile_template
+
+BACKGROUND_TYPES = ('solid', 'gradient', 'radial')
+ELEMENT_TYPES = ('text', 'image')
+
+
+class TemplateValidationError(Exception):
+    """模板格式错误"""
+
+
+def _check_color(value: Any, where: str):
+    try:
+        parse_color(value)
+    except (AttributeError, ValueError):
+        raise TemplateValidationError(f"{where}: invalid color {value!r}")
+
+
+def validate_template(template: Any) -> Dict[str, Any]:
+    """
+    校验模板结构（只在加载时执行一次）
+
+    Raises:
+        TemplateValidationError: 缺少字段、尺寸/颜色非法或元素 id 重复
+    """
+    if not isinstance(template, dict):
+        raise TemplateValidationError("template must be an object")
+    tid = template.get('id')
+    if not isinstance(tid, str) or not safe_id(tid):
+        raise TemplateValidationError(f"template id must match [a-zA-Z0-9_-]+: {tid!r}")
+    for key in ('name', 'category'):
+        if not isinstance(template.get(key), str) or not template[key]:
+            raise TemplateValidationError(f"{tid}: {key} is required")
+
+    size = template.get('size')
+    if not isinstance(size, dict) or not all(
+            isinstance(size.get(k), int) and 0 < size[k] <= 10000 for k in ('width', 'height')):
+        raise TemplateValidationError(f"{tid}: size.width / size.height must be positive integers")
+
+    background = template.get('background', {'type': 'solid', 'color': '#FFFFFF'})
+    if not isinstance(background, dict) or background.get('type') not in BACKGROUND_TYPES:
+        raise TemplateValidationError(f"{tid}: background.type must be one of {BACKGROUND_TYPES}")
+    if background['type'] == 'solid':
+        _check_color(background.get('color', '#FFFFFF'), f"{tid}.background")
+    else:
+        for color in background.get('colors') or []:
+            _check_color(color, f"{tid}.background")
+
+    elements = template.get('elements')
+    if not isinstance(elements, list):
+        raise TemplateValidationError(f"{tid}: elements must be a list")
+    seen = set()
+    for element in elements:
+        if not isinstance(element, dict) or not element.get('id'):
+            raise TemplateValidationError(f"{tid}: every element needs an id")
+        eid = element['id']
+        if eid in seen:
+            raise TemplateValidationError(f"{tid}: duplicate element id {eid}")
+        seen.add(eid)
+        if element.get('type', 'text') not in ELEMENT_TYPES:
+            raise TemplateValidationError(f"{tid}.{eid}: unsupported element type {element.get('type')}")
+        position = element.get('position')
+        if not isinstance(position, dict) or not all(
+                isinstance(position.get(k), (int, float)) for k in ('x', 'y')):
+            raise TemplateValidationError(f"{tid}.{eid}: position.x / position.y are required")
+        style = element.get('style', {})
+        if not isinstance(style, dict):
+            raise TemplateValidationError(f"{tid}.{eid}: style must be an object")
+        if 'color' in style:
+            _check_color(style['color'], f"{tid}.{eid}")
+    return template
+
+
+def _summary(template: Dict[str, Any]) -> Dict[str, Any]:
+    """列表接口只返回基本信息"""
+    return {
+        "id": template["id"],
+        "name": template["name"],
+        "category": template["category"],
+        "size": template["size"]
+    }
+
+
+def _etag(payload: Any) -> str:
+    """列表内容的哈希，作为 ETag"""
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+
+# 不存在的分类：空列表（ETag 同样是内容哈希，不能为空字符串）
+EMPTY_LISTING_ETAG = _etag([])
+EMPTY_LISTING_BODY = json.dumps({'templates': []}).encode('utf-8')
+
+
+class _Snapshot:
+    """一次加载结果：模板、编译结果、分类索引与列表摘要（构建后不再修改）"""
+
+    __slots__ = ('templates', 'compiled', 'by_category', 'listings', 'version')
+
+    def __init__(self, templates: Dict[str, Dict[str, Any]], compiled: Dict[str, CompiledTemplate], version: int):
+        self.templates = templates
+        self.compiled = compiled
+        self.version = version
+        self.by_category: Dict[str, List[str]] = {}
+        for tid, template in templates.items():
+            self.by_category.setdefault(template['category'], []).append(tid)
+        # 列表摘要、ETag 与序列化好的响应体：key 为分类，None 表示全部
+        self.listings: Dict[Optional[str], Tuple[List[Dict[str, Any]], str, bytes]] = {}
+        self._add_listing(None, [_summary(t) for t in templates.values()])
+        for category, ids in self.by_category.items():
+            self._add_listing(category, [_summary(templates[tid]) for tid in ids])
+
+    def _add_listing(self, category: Optional[str], summaries: List[Dict[str, Any]]):
+        body = json.dumps({'templates': summaries}).encode('utf-8')
+        self.listings[category] = (summaries, _etag(summaries), body)
+
+
+class TemplateStore:
+    """模板存储：内置模板 + 目录模板，校验、编译、索引与热加载"""
+
+    def __init__(self, builtin: Dict[str, Dict[str, Any]], templates_dir: Optional[str] = None,
+                 interval: Optional[float] = None):
+        """
+        Args:
+            builtin: 内置模板（id → 模板）；目录中同 id 的模板会覆盖内置模板
+            templates_dir: 自定义模板目录，默认 TEMPLATES_DIR；未配置时只有内置模板
+            interval: 目录轮询间隔（秒），默认 TEMPLATE_RELOAD_INTERVAL 或 5；0 表示不热加载
+        """
+        self.templates_dir = templates_dir if templates_dir is not None else os.getenv('TEMPLATES_DIR', '')
+        self.interval = interval if interval is not None else float(os.getenv('TEMPLATE_RELOAD_INTERVAL', '5'))
+        self._builtin = {tid: validate_template(t) for tid, t in builtin.items()}
+        self._builtin_compiled = {tid: compile_template(t) for tid, t in self._builtin.items()}
+        self._lock = threading.Lock()
+        # 文件路径 → ((mtime_ns, size), [(模板, 编译结果)])
+        self._files: Dict[str, Tuple[Tuple[int, int], List[Tuple[Dict[str, Any], CompiledTemplate]]]] = {}
+        self._errors: Dict[str, str] = {}
+        self._listeners: List[Callable[[List[str]], None]] = []
+        self._snapshot = _Snapshot({}, {}, 0)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        self.reloads = 0
+        self.reload()
+
+    @property
+    def snapshot(self) -> _Snapshot:
+        self._ensure_watcher()
+        return self._snapshot
+
+    def add_listener(self, callback: Callable[[List[str]], None]):
+        """注册模板变更回调：callback(变化的模板 id 列表)，首次注册时以全部模板调用一次"""
+        with self._lock:
+            self._listeners.append(callback)
+            ids = list(self._snapshot.templates)
+        callback(ids)
+
+    def reload(self) -> List[str]:
+        """扫描目录，只重新加载新增 / 修改的文件，返回变化的模板 id"""
+        with self._lock:
+            changed = self._scan_locked()
+            listeners = list(self._listeners) if changed else []
+        for callback in listeners:
+            try:
+                callback(changed)
+            except Exception as e:
+                print(f"Template listener failed: {e}")
+        return changed
+
+    def _scan_locked(self) -> List[str]:
+        seen = set()
+        dirty = False
+        if self.templates_dir and os.path.isdir(self.templates_dir):
+            for entry in os.scandir(self.templates_dir):
+                if not entry.is_file() or not entry.name.endswith('.json'):
+                    continue
+                seen.add(entry.path)
+                st = entry.stat()
+                stamp = (st.st_mtime_ns, st.st_size)
+                cached = self._files.get(entry.path)
+                if cached is not None and cached[0] == stamp:
+                    continue
+                self._files[entry.path] = (stamp, self._load_file(entry.path))
+                dirty = True
+        for path in [p for p in self._files if p not in seen]:
+            del self._files[path]
+            self._errors.pop(path, None)
+            dirty = True
+        if not dirty and self._snapshot.version:
+            return []
+
+        templates = dict(self._builtin)
+        compiled = dict(self._builtin_compiled)
+        # 文件名排序，同 id 时后加载的覆盖先加载的
+        for path in sorted(self._files):
+            for template, compiled_template in self._files[path][1]:
+                templates[template['id']] = template
+                compiled[template['id']] = compiled_template
+        old = self._snapshot
+        changed = [tid for tid in templates
+                   if old.compiled.get(tid) is not compiled[tid]] + [tid for tid in old.templates
+                                                                       if tid not in templates]
+        self._snapshot = _Snapshot(templates, compiled, old.version + 1)
+        self.reloads += 1
+        return changed
+
+    def _load_file(self, path: str) -> List[Tuple[Dict[str, Any], CompiledTemplate]]:
+        """加载单个模板文件；校验失败的模板跳过并记录错误，不影响其他模板"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            self._errors[path] = str(e)
+            print(f"Failed to load templates from {path}: {e}")
+            return []
+        loaded = []
+        errors = []
+        for template in data if isinstance(data, list) else [data]:
+            try:
+                validate_template(template)
+                loaded.append((template, compile_template(template)))
+            except TemplateValidationError as e:
+                errors.append(str(e))
+        if errors:
+            self._errors[path] = '; '.join(errors)
+            print(f"Invalid templates in {path}: {self._errors[path]}")
+        else:
+            self._errors.pop(path, None)
+        return loaded
+
+    def _ensure_watcher(self):
+        """懒启动目录轮询线程；gunicorn fork 后按 pid 重新启动"""
+        if not self.templates_dir or self.interval <= 0:
+            return
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+                return
+            self._thread_pid = pid
+            self._thread = threading.Thread(target=self._watch, name='template-reloader', daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        stop = threading.Event()
+        while not stop.wait(self.interval):
+            try:
+                changed = self.reload()
+                if changed:
+                    print(f"Templates reloaded: {', '.join(changed)}")
+            except Exception as e:
+                print(f"Template reload failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        with self._lock:
+            return {
+                'templates': len(snapshot.templates),
+                'categories': len(snapshot.by_category),
+                'files': len(self._files),
+                'version': snapshot.version,
+                'reloads': self.reloads,
+                'errors': dict(self._errors),
+                'directory': self.templates_dir or None,
+            }
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 算法服务模块为扁平布局（gunicorn 以 algorithm 目录为工作目录启动），测试同样从该目录导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,126 @@
+"""
+海报接口：条件 GET 与导出缓存键（导出期间文档被改写时按实际渲染的文档缓存）
+"""
+import json
+from io import BytesIO
+
+import pytest
+
+import app as app_module
+from poster_store import PosterStore
+from render_cache import RenderCache, canonical_hash
+
+POSTER = {'size': {'width': 100, 'height': 100},
+          'elements': [{'id': 'title', 'type': 'text', 'content': 'v1', 'position': {'x': 50, 'y': 50}}]}
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, 'poster_store', PosterStore(str(tmp_path / 'posters')))
+    monkeypatch.setattr(app_module, 'render_cache', RenderCache(str(tmp_path / 'render_cache')))
+    return app_module.app.test_client()
+
+
+def _fake_pdf(monkeypatch):
+    rendered = []
+
+    def render_to_pdf(poster_data):
+        rendered.append(poster_data)
+        return BytesIO(json.dumps(poster_data).encode('utf-8'))
+
+    monkeypatch.setattr(app_module.render_executor, 'render_to_pdf', render_to_pdf)
+    return rendered
+
+
+def test_get_poster_conditional(client):
+    app_module.poster_store.save('p1', POSTER)
+    first = client.get('/poster/p1')
+    assert first.status_code == 200
+    etag = first.headers['ETag'].strip('"')
+    assert etag == canonical_hash(POSTER)[:32] == first.get_json()['version']
+    assert first.get_json()['poster_data'] == POSTER
+
+    again = client.get('/poster/p1', headers={'If-None-Match': f'"{etag}"'})
+    assert again.status_code == 304
+    assert client.get('/poster/p1', headers={'If-None-Match': '"stale"'}).status_code == 200
+    assert client.get('/poster/missing').status_code == 404
+
+
+def test_export_caches_under_loaded_document(client, monkeypatch):
+    store = app_module.poster_store
+    store.save('p1', POSTER)
+    updated = dict(POSTER, elements=[dict(POSTER['elements'][0], content='v2')])
+    rendered = _fake_pdf(monkeypatch)
+    load_header = store.load_header
+
+    def racing_load_header(poster_id):
+        # 读完头部后文档被并发改写
+        header = load_header(poster_id)
+        store.save(poster_id, updated)
+        return header
+
+    monkeypatch.setattr(store, 'load_header', racing_load_header)
+    response = client.post('/poster/p1/export', json={'format': 'pdf'})
+    assert response.status_code == 200
+    assert json.loads(response.data) == updated
+    assert rendered == [updated]
+
+    cache = app_module.render_cache
+    stale_key = cache.make_key(None, 'PDF', None, canonical_hash(POSTER))
+    assert cache.get('p1', stale_key, 'pdf')[0] is None
+
+    monkeypatch.setattr(store, 'load_header', load_header)
+    hit = client.post('/poster/p1/export', json={'format': 'pdf'})
+    assert hit.status_code == 200 and hit.headers['X-Render-Cache'] != 'miss'
+    assert json.loads(hit.data) == updated and len(rendered) == 1
+
+
+def _patch(client, body, **headers):
+    return client.patch('/poster/p1', json=body, headers=headers)
+
+
+def test_patch_version_conflict_returns_412(client):
+    app_module.poster_store.save('p1', POSTER)
+    operations = [{'op': 'replace', 'path': '/elements/0/content', 'value': 'v2'}]
+    response = _patch(client, operations, **{'If-Match': '"stale"'})
+    assert response.status_code == 412
+    assert response.get_json()['version'] == canonical_hash(POSTER)[:32]
+    response = _patch(client, {'operations': operations, 'version': 'stale'})
+    assert response.status_code == 412
+    assert app_module.poster_store.load('p1') == POSTER
+
+
+def test_patch_failed_test_returns_409(client):
+    app_module.poster_store.save('p1', POSTER)
+    response = _patch(client, [{'op': 'test', 'path': '/elements/0/content', 'value': 'other'},
+                               {'op': 'remove', 'path': '/elements/0'}])
+    assert response.status_code == 409
+    assert app_module.poster_store.load('p1') == POSTER
+
+
+@pytest.mark.parametrize('stored, body', [
+    (POSTER, [{'op': 'remove', 'path': '/elements/5'}]),
+    (POSTER, [{'op': 'remove', 'path': 5}]),
+    (POSTER, ['not-an-operation']),
+    (POSTER, {'elements': {'missing': {'content': 'x'}}}),
+    (POSTER, {'elements': {'title': 'not-a-dict'}}),
+    (dict(POSTER, elements=None), {'elements': {'title': {'content': 'x'}}}),
+    (dict(POSTER, elements=['title', 3]), {'elements': {'title': {'content': 'x'}}}),
+    (POSTER, [{'op': 'remove', 'path': '/size'}]),
+    (POSTER, [{'op': 'add', 'path': '/elements/-', 'value': 'oops'}]),
+])
+def test_patch_unappliable_returns_422(client, stored, body):
+    app_module.poster_store.save('p1', stored)
+    response = _patch(client, body)
+    assert response.status_code == 422, response.get_json()
+    assert app_module.poster_store.load('p1') == stored
+
+
+def test_patch_applies_with_matching_version(client):
+    app_module.poster_store.save('p1', POSTER)
+    version = canonical_hash(POSTER)[:32]
+    response = _patch(client, {'elements': {'title': {'content': 'v2'}}}, **{'If-Match': f'"{version}"'})
+    assert response.status_code == 200, response.get_json()
+    updated = app_module.poster_store.load('p1')
+    assert updated['elements'][0]['content'] == 'v2'
+    assert response.get_json()['version'] == canonical_hash(updated)[:32]
@@ -0,0 +1,31 @@
+"""
+背景渲染：只有 gradient / linear / radial 按渐变绘制，不认识的类型退回白底
+"""
+import pytest
+
+from background_engine import BackgroundEngine
+
+WHITE = (255, 255, 255)
+
+
+@pytest.mark.parametrize('spec', [
+    {'type': 'pattern', 'colors': ['#FF0000', '#0000FF']},
+    {'type': 'image', 'src': 'abc'},
+    {'type': None},
+])
+def test_unknown_type_falls_back_to_white(spec):
+    img = BackgroundEngine().render((8, 6), spec)
+    assert img.size == (8, 6)
+    assert set(img.getdata()) == {WHITE}
+
+
+@pytest.mark.parametrize('bg_type', ['gradient', 'linear', 'radial'])
+def test_gradient_types(bg_type):
+    img = BackgroundEngine().render((8, 8), {'type': bg_type, 'colors': ['#FF0000', '#0000FF']})
+    assert len(set(img.getdata())) > 1
+
+
+def test_solid_and_default():
+    engine = BackgroundEngine()
+    assert set(engine.render((4, 4), {'type': 'solid', 'color': '#102030'}).getdata()) == {(16, 32, 48)}
+    assert set(engine.render((4, 4), None).getdata()) == {WHITE}
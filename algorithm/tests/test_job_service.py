@@ -0,0 +1,100 @@
+"""
+异步任务：降级为 dummy 的任务记为 failed；所属进程已不在的任务查询时记为 failed；
+过期清理只删除已结束或已失联任务的状态文件
+"""
+import json
+import os
+import socket
+import threading
+import time
+
+from job_service import JobManager
+
+
+def _wait(manager, job_id, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = manager.get(job_id)
+        if job['state'] in ('stored', 'failed'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError('job did not finish')
+
+
+def test_job_states_follow_handler_result(tmp_path):
+    manager = JobManager(str(tmp_path), workers=1, max_queue=4, ttl=3600)
+
+    stored = _wait(manager, manager.submit('generate', {}, lambda p, progress: {'status': 'success'})['job_id'])
+    assert stored['state'] == 'stored' and stored['error'] is None
+
+    dummy = {'status': 'dummy', 'poster_url': 'https://via.placeholder.com/'}
+    failed = _wait(manager, manager.submit('generate', {}, lambda p, progress: dummy)['job_id'])
+    assert failed['state'] == 'failed' and failed['result'] == dummy and failed['error']
+
+    def boom(payload, progress):
+        raise RuntimeError('boom')
+    errored = _wait(manager, manager.submit('generate', {}, boom)['job_id'])
+    assert errored['state'] == 'failed' and errored['error'] == 'boom'
+
+
+def _dead_pid():
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    return pid
+
+
+def _write_job(directory, job_id, state, owner_pid, heartbeat_at, mtime=None):
+    path = os.path.join(str(directory), f"{job_id}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'job_id': job_id, 'state': state, 'version': 3, 'updated_at': heartbeat_at,
+                   'heartbeat_at': heartbeat_at, 'owner': {'host': socket.gethostname(), 'pid': owner_pid},
+                   'error': None}, f)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_job_of_exited_worker_is_reported_failed(tmp_path):
+    manager = JobManager(str(tmp_path), workers=1, ttl=3600)
+    now = time.time()
+    _write_job(tmp_path, 'orphan', 'designing', _dead_pid(), now)
+    _write_job(tmp_path, 'silent', 'queued', 1, now - 3600)
+    _write_job(tmp_path, 'alive', 'rendering', os.getppid(), now)
+
+    for job_id in ('orphan', 'silent'):
+        job = manager.get(job_id)
+        assert job['state'] == 'failed' and job['error'] and job['version'] == 4
+        # 结果已落盘，其他 worker 查询时看到同样的状态
+        with open(os.path.join(str(tmp_path), f"{job_id}.json"), encoding='utf-8') as f:
+            assert json.load(f)['state'] == 'failed'
+    assert manager.get('alive')['state'] == 'rendering'
+
+
+def test_heartbeat_keeps_running_job_fresh(tmp_path, monkeypatch):
+    monkeypatch.setenv('JOB_HEARTBEAT_SECONDS', '0.05')
+    manager = JobManager(str(tmp_path), workers=1, ttl=3600)
+    release = threading.Event()
+    job_id = manager.submit('generate', {}, lambda p, progress: release.wait(5) and {'status': 'success'})['job_id']
+    first = manager.get(job_id)['heartbeat_at']
+    time.sleep(0.3)
+    with open(os.path.join(str(tmp_path), f"{job_id}.json"), encoding='utf-8') as f:
+        on_disk = json.load(f)
+    assert on_disk['heartbeat_at'] > first and on_disk['owner']['pid'] == os.getpid()
+    release.set()
+    assert _wait(manager, job_id)['state'] == 'stored'
+
+
+def test_prune_keeps_unfinished_job_files(tmp_path):
+    manager = JobManager(str(tmp_path), workers=1, ttl=10)
+    now, old = time.time(), time.time() - 100
+    _write_job(tmp_path, 'done', 'stored', os.getpid(), old, mtime=old)
+    _write_job(tmp_path, 'running', 'rendering', os.getppid(), now, mtime=old)
+    _write_job(tmp_path, 'queued', 'queued', os.getppid(), now, mtime=old)
+    _write_job(tmp_path, 'orphan', 'designing', _dead_pid(), old, mtime=old)
+
+    manager._last_prune = 0
+    manager._maybe_prune()
+
+    assert sorted(os.listdir(tmp_path)) == ['queued.json', 'running.json']
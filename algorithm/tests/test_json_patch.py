@@ -0,0 +1,124 @@
+"""
+局部更新：RFC 6902 操作（示例取自 RFC 附录 A）、按元素 id 的增量与受影响元素推导
+"""
+import pytest
+
+from json_patch import (JsonPatchError, JsonPatchTestFailed, apply_element_deltas,
+                        apply_patch, patched_element_ids)
+
+
+@pytest.mark.parametrize('doc, operations, expected', [
+    # add
+    ({'foo': 'bar'}, [{'op': 'add', 'path': '/baz', 'value': 'qux'}], {'foo': 'bar', 'baz': 'qux'}),
+    ({'foo': ['bar', 'baz']}, [{'op': 'add', 'path': '/foo/1', 'value': 'qux'}], {'foo': ['bar', 'qux', 'baz']}),
+    ({'foo': ['bar']}, [{'op': 'add', 'path': '/foo/-', 'value': ['abc', 'def']}],
+     {'foo': ['bar', ['abc', 'def']]}),
+    ({'foo': 'bar'}, [{'op': 'add', 'path': '/child', 'value': {'grandchild': {}}}],
+     {'foo': 'bar', 'child': {'grandchild': {}}}),
+    # remove
+    ({'baz': 'qux', 'foo': 'bar'}, [{'op': 'remove', 'path': '/baz'}], {'foo': 'bar'}),
+    ({'foo': ['bar', 'qux', 'baz']}, [{'op': 'remove', 'path': '/foo/1'}], {'foo': ['bar', 'baz']}),
+    # replace
+    ({'baz': 'qux', 'foo': 'bar'}, [{'op': 'replace', 'path': '/baz', 'value': 'boo'}],
+     {'baz': 'boo', 'foo': 'bar'}),
+    ({'a': 1}, [{'op': 'replace', 'path': '', 'value': {'b': 2}}], {'b': 2}),
+    # move
+    ({'foo': {'bar': 'baz', 'waldo': 'fred'}, 'qux': {'corge': 'grault'}},
+     [{'op': 'move', 'from': '/foo/waldo', 'path': '/qux/thud'}],
+     {'foo': {'bar': 'baz'}, 'qux': {'corge': 'grault', 'thud': 'fred'}}),
+    ({'foo': ['all', 'grass', 'cows', 'eat']}, [{'op': 'move', 'from': '/foo/1', 'path': '/foo/3'}],
+     {'foo': ['all', 'cows', 'eat', 'grass']}),
+    # copy
+    ({'foo': {'bar': [1]}}, [{'op': 'copy', 'from': '/foo/bar', 'path': '/baz'}],
+     {'foo': {'bar': [1]}, 'baz': [1]}),
+    # test
+    ({'baz': 'qux', 'foo': ['a', 2, 'c']},
+     [{'op': 'test', 'path': '/baz', 'value': 'qux'}, {'op': 'test', 'path': '/foo/1', 'value': 2}],
+     {'baz': 'qux', 'foo': ['a', 2, 'c']}),
+    # ~0 / ~1 转义
+    ({'/': 9, '~1': 10}, [{'op': 'test', 'path': '/~01', 'value': 10},
+                          {'op': 'replace', 'path': '/~1', 'value': 1}], {'/': 1, '~1': 10}),
+    ({}, [{'op': 'add', 'path': '/a~1b~0c', 'value': True}], {'a/b~c': True}),
+])
+def test_rfc6902_operations(doc, operations, expected):
+    before = repr(doc)
+    assert apply_patch(doc, operations) == expected
+    # 不修改入参
+    assert repr(doc) == before
+
+
+@pytest.mark.parametrize('doc, operations', [
+    ({'foo': 'bar'}, [{'op': 'add', 'path': '/baz/bat', 'value': 'qux'}]),
+    ({'foo': ['bar']}, [{'op': 'add', 'path': '/foo/2', 'value': 'x'}]),
+    ({'foo': ['bar']}, [{'op': 'add', 'path': '/foo/01', 'value': 'x'}]),
+    ({'foo': ['bar']}, [{'op': 'remove', 'path': '/foo/-'}]),
+    ({'foo': 'bar'}, [{'op': 'remove', 'path': '/missing'}]),
+    ({'foo': 'bar'}, [{'op': 'replace', 'path': '/missing', 'value': 1}]),
+    ({'foo': {'bar': 1}}, [{'op': 'move', 'from': '/foo', 'path': '/foo/bar'}]),
+    ({'foo': 'bar'}, [{'op': 'copy', 'path': '/baz'}]),
+    ({'foo': 'bar'}, [{'op': 'add', 'path': 'baz', 'value': 1}]),
+    ({'foo': 'bar'}, [{'op': 'add', 'path': '/baz'}]),
+    ({'foo': 'bar'}, [{'op': 'frobnicate', 'path': '/foo'}]),
+    ({'foo': 'bar'}, [{'op': 'move', 'from': 3, 'path': '/x'}]),
+    ({'foo': 'bar'}, [{'op': 'remove', 'path': 7}]),
+    ({'foo': 'bar'}, ['not-an-operation']),
+    ({'foo': 'bar'}, {'op': 'remove', 'path': '/foo'}),
+])
+def test_invalid_operations_raise(doc, operations):
+    with pytest.raises(JsonPatchError):
+        apply_patch(doc, operations)
+
+
+def test_failed_test_is_atomic():
+    doc = {'foo': 'bar'}
+    operations = [{'op': 'add', 'path': '/baz', 'value': 1},
+                  {'op': 'test', 'path': '/foo', 'value': 'other'}]
+    with pytest.raises(JsonPatchTestFailed):
+        apply_patch(doc, operations)
+    assert doc == {'foo': 'bar'}
+
+
+POSTER = {
+    'size': {'width': 100, 'height': 100},
+    'elements': [
+        {'id': 'title', 'type': 'text', 'content': 'a', 'style': {'color': '#000', 'font_size': 20}},
+        {'id': 'logo', 'type': 'image', 'position': None},
+    ],
+}
+
+
+def test_element_deltas_merge_position_and_style():
+    result = apply_element_deltas(POSTER, {
+        'title': {'content': 'b', 'style': {'color': '#FFF'}, 'id': 'ignored'},
+        'logo': {'position': {'x': 1, 'y': 2}},
+    })
+    assert result['elements'][0] == {'id': 'title', 'type': 'text', 'content': 'b',
+                                     'style': {'color': '#FFF', 'font_size': 20}}
+    assert result['elements'][1]['position'] == {'x': 1, 'y': 2}
+    assert POSTER['elements'][0]['content'] == 'a'
+
+
+@pytest.mark.parametrize('doc, deltas', [
+    (POSTER, {'missing': {'content': 'x'}}),
+    (POSTER, {'title': 'not-a-dict'}),
+    (POSTER, ['title']),
+    (dict(POSTER, elements=None), {'title': {'content': 'x'}}),
+    (dict(POSTER, elements={'title': {}}), {'title': {'content': 'x'}}),
+    (dict(POSTER, elements=['title', None, 3]), {'title': {'content': 'x'}}),
+    (dict(POSTER, elements=[{'id': ['title']}]), {'title': {'content': 'x'}}),
+])
+def test_malformed_deltas_raise_patch_error(doc, deltas):
+    with pytest.raises(JsonPatchError):
+        apply_element_deltas(doc, deltas)
+
+
+def test_patched_element_ids():
+    operations = [{'op': 'replace', 'path': '/elements/0/content', 'value': 'b'}]
+    after = apply_patch(POSTER, operations)
+    assert patched_element_ids(POSTER, after, operations) == {'title'}
+    # 触及元素以外的字段需要完整比较
+    operations = [{'op': 'replace', 'path': '/size/width', 'value': 200}]
+    assert patched_element_ids(POSTER, apply_patch(POSTER, operations), operations) is None
+    # 元素不是对象时同样退回完整比较
+    operations = [{'op': 'add', 'path': '/elements/0', 'value': 'oops'}]
+    assert patched_element_ids(POSTER, apply_patch(POSTER, operations), operations) is None
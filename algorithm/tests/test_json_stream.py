@@ -0,0 +1,91 @@
+"""
+增量 JSON 解析：任意切块位置（转义、\\uXXXX 跨块）、嵌套对象、前置说明文字与截断输入
+"""
+import json
+
+import pytest
+
+from json_stream import IncrementalJSONParser
+
+DOCUMENT = {
+    'template_id': 'summer_sale',
+    'count': 3,
+    'ratio': -1.5e2,
+    'enabled': True,
+    'missing': None,
+    'color_scheme': {'primary': '#FF0000', 'nested': {'list': [1, {'a': '}]'}, []]}},
+    'tags': ['促销', '{not an object}', 'a,b'],
+    'description': 'quote " backslash \\ slash / tab \t newline \n 中文 é \U0001F389 \u0000',
+}
+TEXT = json.dumps(DOCUMENT, ensure_ascii=True, indent=2)
+
+
+def _feed_all(chunks):
+    parser = IncrementalJSONParser()
+    completed = []
+    for chunk in chunks:
+        completed.extend(parser.feed(chunk))
+    return parser, completed
+
+
+def _check(parser, completed):
+    assert parser.done
+    assert parser.result() == DOCUMENT
+    assert completed == list(DOCUMENT.items())
+    assert parser.fields == DOCUMENT
+
+
+def test_single_chunk():
+    _check(*_feed_all([TEXT]))
+
+
+def test_character_by_character():
+    _check(*_feed_all(list(TEXT)))
+
+
+def test_every_split_point():
+    # 覆盖切在 \" \\ 与 \uXXXX 中间、键与冒号之间、数字中间等所有位置
+    for split in range(1, len(TEXT)):
+        _check(*_feed_all([TEXT[:split], TEXT[split:]]))
+
+
+def test_unicode_escape_split_across_chunks():
+    text = '{"title": "\\u590f\\u65e5\\ud83c\\udf89", "n": 1}'
+    start = text.index('\\u')
+    chunks = [text[:start + 1], text[start + 1:start + 4], text[start + 4:start + 15], text[start + 15:]]
+    parser, completed = _feed_all(chunks)
+    assert completed == [('title', '夏日\U0001F389'), ('n', 1)]
+
+
+def test_fields_become_available_as_they_complete():
+    seen = []
+    parser = IncrementalJSONParser(on_field=lambda key, value: seen.append(key))
+    assert parser.feed('好的，下面是设计方案：\n```json\n{"template_id": "a", "co') == [('template_id', 'a')]
+    assert parser.feed('lor_scheme": {"primary": "#FFF"') == []
+    assert parser.feed('}, "count": 12') == [('color_scheme', {'primary': '#FFF'})]
+    # 数字要到逗号或右括号才算结束
+    assert parser.feed('3}\n```\n后续说明 {"ignored": true}') == [('count', 123)]
+    assert seen == ['template_id', 'color_scheme', 'count']
+    assert parser.result() == {'template_id': 'a', 'color_scheme': {'primary': '#FFF'}, 'count': 123}
+
+
+@pytest.mark.parametrize('cut', [
+    '{"template_id": "a", "description": "unterminated',
+    '{"template_id": "a", "count": 12',
+    '{"template_id": "a", "color_scheme": {"primary": "#FFF"',
+    '{"template_id": "a", "desc": "ends with escape \\',
+    '{"template_id": "a", "desc": "half escape \\u00',
+])
+def test_truncated_input(cut):
+    parser, completed = _feed_all([cut])
+    assert not parser.done
+    assert completed == [('template_id', 'a')]
+    with pytest.raises(ValueError):
+        parser.result()
+
+
+def test_no_object():
+    parser, completed = _feed_all(['没有 JSON', ''])
+    assert completed == [] and not parser.done
+    with pytest.raises(ValueError):
+        parser.result()
@@ -0,0 +1,155 @@
+"""
+提供商路由：对冲、熔断、半开试探，以及不合法响应（ValueError）不计入失败
+"""
+import json
+import threading
+import time
+
+import pytest
+
+from llm_providers import FakeProvider
+from llm_router import CircuitBreaker, HedgeCancelled, ProviderRouter
+
+
+def call(provider, cancel: threading.Event):
+    """与 LLMService 相同的消费方式：逐段读取，被取消时关闭流"""
+    chunks = provider.stream('system', 'user')
+    parts = []
+    try:
+        for chunk in chunks:
+            if cancel.is_set():
+                raise HedgeCancelled()
+            parts.append(chunk)
+    finally:
+        chunks.close()
+    return json.loads(''.join(parts))
+
+
+def make_router(providers, **kwargs):
+    options = dict(hedge=False, hedge_delay=0.1, hedge_min_delay=0.1, hedge_min_samples=1000,
+                   breaker_failures=2, breaker_cooldown=60, max_workers=4)
+    options.update(kwargs)
+    return ProviderRouter(providers, **options)
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_slow_primary_is_hedged_and_loser_cancelled():
+    slow = FakeProvider(delay=3, name='slow')
+    fast = FakeProvider(delay=0.05, name='fast')
+    router = make_router([slow, fast], hedge=True)
+
+    started = time.time()
+    result, winner = router.call(call)
+
+    assert winner == 'fast'
+    assert result['template_id'] == 'template_001'
+    assert time.time() - started < 1.5
+    assert router.hedges == 1 and router.hedge_wins == 1
+    # 落败的首选请求收到取消后停止读取，记为 cancelled，不计入错误也不影响熔断
+    assert wait_until(lambda: router.latency['slow'].cancelled == 1)
+    assert router.latency['slow'].errors == 0
+    assert router.breakers['slow'].state == CircuitBreaker.CLOSED
+
+
+def test_no_hedge_before_deadline():
+    primary = FakeProvider(delay=0.02, name='primary')
+    backup = FakeProvider(delay=0.02, name='backup')
+    router = make_router([primary, backup], hedge=True, hedge_delay=1, hedge_min_delay=1)
+
+    _, winner = router.call(call)
+
+    assert winner == 'primary'
+    assert router.hedges == 0 and backup.calls == 0
+
+
+def test_breaker_opens_after_failures_and_is_skipped():
+    bad = FakeProvider(delay=0.01, failure_rate=1, name='bad')
+    good = FakeProvider(delay=0.01, name='good')
+    router = make_router([bad, good])
+
+    for _ in range(2):
+        assert router.call(call)[1] == 'good'
+    assert router.breakers['bad'].state == CircuitBreaker.OPEN
+    assert router.failovers == 2
+
+    assert router.call(call)[1] == 'good'
+    assert bad.calls == 2
+    assert router.failovers == 2
+
+
+def test_half_open_trial_success_closes_breaker():
+    bad = FakeProvider(delay=0.01, failure_rate=1, name='bad')
+    good = FakeProvider(delay=0.01, name='good')
+    router = make_router([bad, good], breaker_cooldown=0.2)
+    for _ in range(2):
+        router.call(call)
+    assert router.breakers['bad'].state == CircuitBreaker.OPEN
+
+    bad.failure_rate = 0
+    time.sleep(0.25)
+    assert router.breakers['bad'].state == CircuitBreaker.HALF_OPEN
+    assert router.call(call)[1] == 'bad'
+    assert router.breakers['bad'].state == CircuitBreaker.CLOSED
+    assert router.breakers['bad'].stats()['consecutive_failures'] == 0
+
+
+def test_half_open_trial_failure_reopens_breaker():
+    bad = FakeProvider(delay=0.01, failure_rate=1, name='bad')
+    good = FakeProvider(delay=0.01, name='good')
+    router = make_router([bad, good], breaker_cooldown=0.2)
+    for _ in range(2):
+        router.call(call)
+
+    time.sleep(0.25)
+    assert router.call(call)[1] == 'good'
+    # 只放行了一个试探请求，失败后立即重新打开
+    assert bad.calls == 3
+    assert router.breakers['bad'].state == CircuitBreaker.OPEN
+    assert router.breakers['bad'].opens == 2
+    assert router.call(call)[1] == 'good'
+    assert bad.calls == 3
+
+
+def test_half_open_admits_a_single_trial():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    # 试探被取消（对冲落败）时归还名额
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_invalid_response_does_not_count_as_failure():
+    garbled = FakeProvider(delay=0.01, text='not json', name='garbled')
+    router = make_router([garbled], breaker_failures=1)
+
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            router.call(call)
+
+    assert garbled.calls == 3
+    assert router.breakers['garbled'].state == CircuitBreaker.CLOSED
+    stats = router.latency['garbled'].stats()
+    assert stats['invalid'] == 3 and stats['errors'] == 0
+
+
+def test_invalid_response_preferred_over_transport_error():
+    garbled = FakeProvider(delay=0.01, text='not json', name='garbled')
+    down = FakeProvider(delay=0.01, failure_rate=1, name='down')
+    router = make_router([garbled, down])
+
+    with pytest.raises(ValueError):
+        router.call(call)
+    assert down.calls == 1
+    assert router.breakers['down'].stats()['consecutive_failures'] == 1
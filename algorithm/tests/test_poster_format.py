@@ -0,0 +1,129 @@
+"""
+海报二进制格式：编码 / 解码往返、头部哈希、损坏文件，以及 PosterStore 的格式转换与条件读取
+"""
+import json
+import os
+
+import pytest
+
+import poster_format
+from poster_format import FORMAT_VERSION, PosterFormatError
+from poster_store import PosterStore
+from render_cache import canonical_hash
+
+POSTERS = {
+    'unicode': {
+        'size': {'width': 800, 'height': 1200},
+        'background': {'type': 'linear', 'colors': ['#fff', '#000']},
+        'elements': [
+            {'id': 'title', 'type': 'text', 'content': '夏日促销 🎉 "引号" \\ 反斜杠'},
+            {'id': 'logo', 'type': 'image', 'src': 'abc', 'position': {'x': 1, 'y': 2}},
+        ],
+    },
+    'empty_elements': {'size': {'width': 10, 'height': 10}, 'elements': []},
+    'null_elements': {'size': {'width': 10, 'height': 10}, 'elements': None},
+    'no_elements': {'size': {'width': 10, 'height': 10}, 'template_id': 't1'},
+    'odd_ids': {
+        'elements': [
+            {'type': 'text', 'content': '无 id'},
+            {'id': 'dup', 'content': 1},
+            {'id': 'dup', 'content': 2},
+            {'id': 7, 'content': 'int id'},
+            'not-a-dict',
+        ],
+        'size': {'width': 1, 'height': 1},
+    },
+}
+
+
+@pytest.mark.parametrize('name', sorted(POSTERS))
+def test_round_trip_keeps_document(name):
+    poster = POSTERS[name]
+    decoded = poster_format.decode(poster_format.encode(poster))
+    assert decoded == poster
+    # 字段顺序也保留（elements 在 HEAD 中占位）
+    assert list(decoded) == list(poster)
+
+
+@pytest.mark.parametrize('name', sorted(POSTERS))
+def test_header_carries_canonical_hash(tmp_path, name):
+    poster = POSTERS[name]
+    path = tmp_path / 'p.poster'
+    path.write_bytes(poster_format.encode(poster))
+    head, meta = poster_format.read_header(str(path))
+    assert meta['hash'] == canonical_hash(poster)
+    assert 'elements' not in head
+    elements = poster.get('elements')
+    assert meta['elements'] == (len(elements) if isinstance(elements, list) else None)
+    assert poster_format.read(str(path)) == poster
+
+
+def test_read_unless_skips_elements_when_unchanged(tmp_path):
+    poster = POSTERS['unicode']
+    path = tmp_path / 'p.poster'
+    path.write_bytes(poster_format.encode(poster))
+    seen = []
+
+    def unchanged(content_hash):
+        seen.append(content_hash)
+        return True
+
+    assert poster_format.read_unless(str(path), unchanged) == (None, canonical_hash(poster))
+    assert poster_format.read_unless(str(path), lambda _: False) == (poster, canonical_hash(poster))
+    assert seen == [canonical_hash(poster)]
+
+
+def test_corrupt_documents_raise_format_error():
+    data = poster_format.encode(POSTERS['unicode'])
+    with pytest.raises(PosterFormatError):
+        poster_format.decode(b'JSON' + data[4:])
+    newer = bytearray(data)
+    newer[4:6] = (FORMAT_VERSION + 1).to_bytes(2, 'big')
+    with pytest.raises(PosterFormatError):
+        poster_format.decode(bytes(newer))
+    with pytest.raises(PosterFormatError):
+        poster_format.decode(data[:len(data) - 5])
+
+
+def _store(tmp_path, document_format):
+    return PosterStore(str(tmp_path / 'posters'), document_format=document_format)
+
+
+def test_convert_between_formats(tmp_path):
+    store = _store(tmp_path, 'json')
+    for name, poster in POSTERS.items():
+        store.save(name, poster)
+    assert all(store.document_path(name).endswith('.json') for name in POSTERS)
+    json_bytes = sum(os.path.getsize(store.document_path(name)) for name in POSTERS)
+
+    dry = store.convert('binary', dry_run=True)
+    assert dry['converted'] == len(POSTERS) and dry['bytes_before'] == json_bytes
+    assert all(store.document_path(name).endswith('.json') for name in POSTERS)
+
+    result = store.convert('binary')
+    assert result == dry
+    for name, poster in POSTERS.items():
+        path = store.document_path(name)
+        assert path.endswith(f'.{poster_format.POSTER_FORMAT_EXT}')
+        assert not os.path.exists(path[:-len(poster_format.POSTER_FORMAT_EXT)] + 'json')
+        assert store.load(name) == poster
+    assert store.stats()['json_bytes'] == result['bytes_after']
+    # 可重复执行
+    assert store.convert('binary')['converted'] == 0
+
+    back = store.convert('json')
+    assert back['converted'] == len(POSTERS)
+    for name, poster in POSTERS.items():
+        with open(store.document_path(name), encoding='utf-8') as f:
+            assert json.load(f) == poster
+
+
+@pytest.mark.parametrize('document_format', ['binary', 'json'])
+def test_load_unless_matches_load(tmp_path, document_format):
+    store = _store(tmp_path, document_format)
+    poster = POSTERS['unicode']
+    store.save('p1', poster)
+    content_hash = canonical_hash(poster)
+    assert store.load_unless('p1', lambda _: False) == (poster, content_hash)
+    assert store.load_unless('p1', lambda h: h == content_hash) == (None, content_hash)
+    assert store.load_unless('missing', lambda _: False) is None
@@ -0,0 +1,115 @@
+"""
+增量渲染与整张渲染逐像素一致；整张渲染与逐个元素直接在画布上绘制文字的结果一致（含多行文字）
+"""
+import copy
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from image_source import ImageSourceResolver
+from poster_renderer import PosterRenderer
+from template_service import DEFAULT_TEMPLATES
+
+CONTENTS = ["Hello", "第一行\n第二行很长很长", "多行\n\n第三行"]
+
+
+@pytest.fixture(scope="module")
+def renderer(tmp_path_factory):
+    return PosterRenderer(str(tmp_path_factory.mktemp("posters")))
+
+
+def _pixels(image) -> np.ndarray:
+    if isinstance(image, BytesIO):
+        image = Image.open(image)
+    return np.asarray(image.convert("RGB")).astype(int)
+
+
+def _with_content(template, content):
+    poster = copy.deepcopy(template)
+    for element in poster["elements"]:
+        if element.get("type") == "text":
+            element["content"] = content
+    return poster
+
+
+def _reference(renderer, poster):
+    """直接在画布上逐个绘制文字（图层化之前的绘制方式）"""
+    size = poster["size"]
+    img = renderer.backgrounds.render((size["width"], size["height"]), poster.get("background", {})).copy()
+    draw = ImageDraw.Draw(img)
+    for element in poster["elements"]:
+        content = element.get("content", element.get("defaultContent", ""))
+        if element.get("type") != "text" or not content:
+            continue
+        style = element.get("style", {})
+        font = renderer.fonts.get_font(style.get("fontSize", 24), style.get("fontFamily"))
+        bbox = draw.textbbox((0, 0), content, font=font)
+        width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        x, y = element["position"]["x"], element["position"]["y"]
+        if style.get("textAlign", "left") == "center":
+            x -= width // 2
+        elif style.get("textAlign", "left") == "right":
+            x -= width
+        draw.text((x, y - height), content, fill=renderer._hex_to_rgb(style.get("color", "#000000")), font=font)
+    return img
+
+
+@pytest.mark.parametrize("template_id", sorted(DEFAULT_TEMPLATES))
+@pytest.mark.parametrize("content", CONTENTS)
+def test_full_render_matches_direct_drawing(renderer, template_id, content):
+    poster = _with_content(DEFAULT_TEMPLATES[template_id], content)
+    assert np.array_equal(_pixels(renderer.render(poster)), _pixels(_reference(renderer, poster)))
+
+
+@pytest.mark.parametrize("template_id", sorted(DEFAULT_TEMPLATES))
+@pytest.mark.parametrize("content", CONTENTS)
+def test_incremental_update_matches_full_render(renderer, template_id, content):
+    old = _with_content(DEFAULT_TEMPLATES[template_id], "Hello")
+    new = copy.deepcopy(old)
+    text_elements = [e for e in new["elements"] if e.get("type") == "text"]
+    text_elements[0]["content"] = content
+    output, _ = renderer.render_update(old, new, renderer.render(old))
+    assert np.array_equal(_pixels(output), _pixels(renderer.render(new)))
+
+
+def _image_poster(image_id, sized):
+    element = {"id": "img", "type": "image", "image_id": image_id, "position": {"x": 200, "y": 150}}
+    if sized:
+        element["size"] = {"width": 120, "height": 80}
+    return {
+        "size": {"width": 400, "height": 300},
+        "background": {"type": "solid", "color": "#FFFFFF"},
+        "elements": [element, {"id": "title", "type": "text", "content": "Hello",
+                               "position": {"x": 20, "y": 60}, "style": {"fontSize": 24}}],
+    }
+
+
+def _renderer_with_uploads(uploads_dir):
+    """图片缓存独立的渲染器（相当于另一个渲染进程）"""
+    renderer = PosterRenderer(str(uploads_dir))
+    renderer.images = ImageSourceResolver(str(uploads_dir))
+    return renderer
+
+
+@pytest.mark.parametrize("sized", [True, False])
+def test_removed_image_with_missing_upload_is_cleared(tmp_path, sized):
+    image_id = "ab" * 16
+    path = tmp_path / f"{image_id}.png"
+    Image.new("RGB", (120, 80), (255, 0, 0)).save(path)
+    old = _image_poster(image_id, sized)
+    base = _renderer_with_uploads(tmp_path).render(old)
+    assert _pixels(base)[150, 200].tolist() == [255, 0, 0]
+    base.seek(0)
+
+    # 上传已被删除，另一个进程（没有图片缓存）删除该图片元素
+    path.unlink()
+    renderer = _renderer_with_uploads(tmp_path)
+    new = copy.deepcopy(old)
+    new["elements"] = new["elements"][1:]
+    output, info = renderer.render_update(old, new, base)
+
+    assert info["mode"] == ("incremental" if sized else "full")
+    assert np.array_equal(_pixels(output), _pixels(renderer.render(new)))
+    assert _pixels(output)[150, 200].tolist() == [255, 255, 255]
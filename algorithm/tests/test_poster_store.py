@@ -0,0 +1,154 @@
+"""
+海报存储维护：扁平目录迁移、索引重建、上传图片引用补齐与过期清理
+"""
+import json
+import os
+import time
+
+from poster_store import PosterStore
+
+IMAGE_POSTER = {
+    'size': {'width': 100, 'height': 200},
+    'elements': [
+        {'id': 'photo', 'type': 'image', 'image_id': 'img1'},
+        {'id': 'remote', 'type': 'image', 'url': 'https://example.com/x.png'},
+        {'id': 'title', 'type': 'text', 'content': 'hi'},
+    ],
+}
+TEXT_POSTER = {'id': 'summer', 'size': {'width': 10, 'height': 20}, 'elements': []}
+
+
+def _write_flat(posters_dir, poster_id, poster_data, png=b'png-bytes', mtime=None):
+    path = os.path.join(posters_dir, f'{poster_id}.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(poster_data, f)
+    if png is not None:
+        with open(os.path.join(posters_dir, f'{poster_id}.png'), 'wb') as f:
+            f.write(png)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def _row(store, poster_id):
+    row = store.index.connect().execute('SELECT * FROM posters WHERE id = ?', (poster_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def _forget_references(store):
+    """模拟引用表出现之前建立的索引"""
+    with store.index.transaction() as conn:
+        conn.execute('DELETE FROM poster_images')
+    store.index.connect().execute('PRAGMA user_version = 0')
+
+
+def test_migrate_flat_files(tmp_path):
+    posters_dir = str(tmp_path)
+    _write_flat(posters_dir, 'a', IMAGE_POSTER, mtime=1_000_000)
+    _write_flat(posters_dir, 'b', TEXT_POSTER, png=None)
+    store = PosterStore(posters_dir, document_format='json')
+    # 扁平目录中的海报还没有引用记录
+    assert not store.references_complete()
+    assert store.load('a') == IMAGE_POSTER
+
+    assert store.migrate(dry_run=True) == {'moved': 2, 'indexed': 0, 'skipped': 0}
+    assert os.path.isfile(os.path.join(posters_dir, 'a.json')) and store.count() == 0
+
+    assert store.migrate() == {'moved': 2, 'indexed': 0, 'skipped': 0}
+    for poster_id in ('a', 'b'):
+        assert not os.path.exists(os.path.join(posters_dir, f'{poster_id}.json'))
+        assert os.path.dirname(store.document_path(poster_id)) == store.shard_dir(poster_id)
+    assert store.load('a') == IMAGE_POSTER
+    assert os.path.dirname(store.png_path('a')) == store.shard_dir('a')
+    assert not os.path.exists(os.path.join(posters_dir, 'a.png'))
+
+    a, b = _row(store, 'a'), _row(store, 'b')
+    assert (a['width'], a['height'], a['created_at']) == (100, 200, 1_000_000)
+    assert a['png_bytes'] == len(b'png-bytes') and a['json_bytes'] == os.path.getsize(store.document_path('a'))
+    assert (b['template_id'], b['png_bytes']) == ('summer', 0)
+    assert store.referenced_images(['img1', 'x', 'other']) == {'img1'}
+    assert store.references_complete()
+
+    # 可重复执行
+    assert store.migrate() == {'moved': 0, 'indexed': 0, 'skipped': 0}
+    assert store.count() == 2
+
+
+def test_migrate_skips_unreadable_and_resumes(tmp_path):
+    posters_dir = str(tmp_path)
+    with open(os.path.join(posters_dir, 'broken.json'), 'w') as f:
+        f.write('{not json')
+    _write_flat(posters_dir, 'a', IMAGE_POSTER)
+    store = PosterStore(posters_dir)
+    # 模拟上次迁移在移动 PNG 之后中断
+    os.makedirs(store.shard_dir('a'), exist_ok=True)
+    os.replace(os.path.join(posters_dir, 'a.png'), os.path.join(store.shard_dir('a'), 'a.png'))
+
+    assert store.migrate() == {'moved': 1, 'indexed': 0, 'skipped': 1}
+    assert store.load('a') == IMAGE_POSTER and _row(store, 'a')['png_bytes'] == len(b'png-bytes')
+    # 无法读取的扁平文件仍在，引用索引不能视为完整
+    assert not store.references_complete()
+    os.remove(os.path.join(posters_dir, 'broken.json'))
+    assert store.references_complete()
+
+
+def test_migrate_backfills_references_for_old_index(tmp_path):
+    store = PosterStore(str(tmp_path))
+    store.save('a', IMAGE_POSTER)
+    store.save('b', TEXT_POSTER)
+    _forget_references(store)
+
+    reopened = PosterStore(str(tmp_path))
+    assert not reopened.references_complete()
+    assert reopened.referenced_images(['img1']) == set()
+
+    assert reopened.migrate() == {'moved': 0, 'indexed': 0, 'skipped': 0}
+    assert reopened.referenced_images(['img1']) == {'img1'}
+    assert reopened.references_complete()
+    assert PosterStore(str(tmp_path)).references_complete()
+
+
+def test_migrate_rebuilds_lost_index(tmp_path):
+    store = PosterStore(str(tmp_path / 'posters'))
+    store.save('a', IMAGE_POSTER, png=b'x' * 10)
+    store.save('b', TEXT_POSTER)
+    os.remove(store.index_path)
+
+    rebuilt = PosterStore(str(tmp_path / 'posters'))
+    assert rebuilt.count() == 0
+    assert rebuilt.migrate(dry_run=True)['indexed'] == 2 and rebuilt.count() == 0
+    assert rebuilt.migrate() == {'moved': 0, 'indexed': 2, 'skipped': 0}
+    assert _row(rebuilt, 'a')['png_bytes'] == 10
+    assert rebuilt.referenced_images(['img1']) == {'img1'}
+    assert rebuilt.references_complete()
+
+
+def test_new_store_on_empty_index_has_complete_references(tmp_path):
+    store = PosterStore(str(tmp_path))
+    assert store.references_complete()
+    store.save('a', IMAGE_POSTER)
+    assert store.referenced_images(['img1']) == {'img1'}
+
+
+def test_cleanup_removes_old_posters_and_references(tmp_path):
+    store = PosterStore(str(tmp_path))
+    now = time.time()
+    for poster_id, age_days in (('old1', 30), ('old2', 20), ('new', 1)):
+        store.save(poster_id, IMAGE_POSTER, png=b'png')
+        with store.index.transaction() as conn:
+            conn.execute('UPDATE posters SET created_at = ? WHERE id = ?', (now - age_days * 86400, poster_id))
+    cutoff = now - 7 * 86400
+
+    assert store.cleanup(cutoff, dry_run=True) == ['old1', 'old2']
+    assert store.exists('old1') and store.count() == 3
+
+    assert store.cleanup(cutoff, limit=1) == ['old1']
+    assert store.cleanup(cutoff) == ['old2']
+    for poster_id in ('old1', 'old2'):
+        assert not store.exists(poster_id) and store.png_path(poster_id) is None
+        assert _row(store, poster_id) is None
+    rows = store.index.connect().execute('SELECT poster_id FROM poster_images').fetchall()
+    assert [row[0] for row in rows] == ['new']
+    assert store.referenced_images(['img1']) == {'img1'}
+
+    store.cleanup(now + 1)
+    assert store.count() == 0 and store.referenced_images(['img1']) == set()
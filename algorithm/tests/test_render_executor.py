@@ -0,0 +1,109 @@
+"""
+渲染进程池：超时从任务开始执行时计算；超时的任务被中断，子进程与其他任务不受影响；
+忽略中断的任务只终止它所在的子进程，其他进行中的任务在新进程池中重试
+"""
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from poster_renderer import PosterRenderer
+from render_executor import RenderExecutor
+from template_service import DEFAULT_TEMPLATES
+
+
+def _sleep_pid(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def _stubborn(seconds):
+    """屏蔽 SIGALRM，模拟卡在 C 代码里收不到信号的任务"""
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM})
+    try:
+        time.sleep(seconds)
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGALRM})
+    return os.getpid()
+
+
+def _inline():
+    raise AssertionError('should not render inline')
+
+
+@pytest.fixture
+def make_executor(tmp_path):
+    executors = []
+
+    def make(pool_size, timeout):
+        executor = RenderExecutor(PosterRenderer(str(tmp_path)), pool_size=pool_size, timeout=timeout)
+        executor.kill_grace = 0.5
+        # 先把子进程启动起来，避免把 spawn 耗时算进测试
+        assert executor._get_pool().submit(os.getpid).result(timeout=60)
+        executors.append(executor)
+        return executor
+
+    yield make
+    for executor in executors:
+        executor.shutdown()
+
+
+def _in_thread(fn, *args):
+    result = {}
+
+    def run():
+        try:
+            result['value'] = fn(*args)
+        except Exception as e:
+            result['error'] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, result
+
+
+def test_timeout_interrupts_task_and_keeps_worker(make_executor):
+    executor = make_executor(pool_size=1, timeout=1)
+    pid = executor._run(_sleep_pid, _inline, 0)
+
+    started = time.time()
+    with pytest.raises(Exception, match="timed out"):
+        executor._run(_sleep_pid, _inline, 30)
+    assert time.time() - started < 5
+
+    # 同一个子进程继续服务
+    assert executor._run(_sleep_pid, _inline, 0) == pid
+    stats = executor.stats()
+    assert stats['timeouts'] == 1 and stats['kills'] == 0 and stats['inline'] == 0
+
+
+def test_queue_wait_does_not_count_against_timeout(make_executor):
+    executor = make_executor(pool_size=1, timeout=1)
+    first = _in_thread(executor._run, _sleep_pid, _inline, 0.8)
+    time.sleep(0.1)
+    second = _in_thread(executor._run, _sleep_pid, _inline, 0.8)
+    for thread, result in (first, second):
+        thread.join(timeout=30)
+        assert 'error' not in result, result.get('error')
+    assert executor.stats()['timeouts'] == 0
+
+
+def test_stubborn_task_kills_only_its_worker(make_executor):
+    executor = make_executor(pool_size=2, timeout=2)
+    stubborn = _in_thread(executor._run, _stubborn, _inline, 30)
+    time.sleep(1)
+    # 子进程被终止时（开始后约 2.5 秒）这个任务仍在执行
+    healthy = _in_thread(executor._run, _sleep_pid, _inline, 1.8)
+
+    stubborn[0].join(timeout=30)
+    assert 'timed out' in str(stubborn[1].get('error'))
+
+    healthy[0].join(timeout=60)
+    # 正常任务在新进程池中重试完成，而不是退回 gunicorn worker 内渲染
+    assert 'error' not in healthy[1], healthy[1].get('error')
+    stats = executor.stats()
+    assert stats['kills'] == 1 and stats['inline'] == 0 and stats['retries'] == 1
+
+    output = executor.render(DEFAULT_TEMPLATES['template_001'])
+    assert output.getvalue().startswith(b'\x89PNG')
@@ -0,0 +1,26 @@
+"""
+模板列表：分类不存在时返回空列表，ETag 仍为内容哈希（条件请求不会误判为未变化）
+"""
+import json
+
+import app as app_module
+from template_service import TemplateService
+
+
+def test_unknown_category_has_real_etag(tmp_path):
+    service = TemplateService(templates_dir=str(tmp_path))
+    summaries, etag, body = service.list_templates_cached('no-such-category')
+    assert summaries == [] and json.loads(body) == {'templates': []}
+    assert len(etag) == 32
+    assert etag != service.list_templates_cached(None)[1]
+
+
+def test_unknown_category_conditional_get():
+    client = app_module.app.test_client()
+    response = client.get('/templates?category=no-such-category', headers={'If-None-Match': '""'})
+    assert response.status_code == 200
+    assert response.get_json() == {'templates': []}
+    etag = response.headers['ETag']
+    assert etag != '""'
+    again = client.get('/templates?category=no-such-category', headers={'If-None-Match': etag})
+    assert again.status_code == 304
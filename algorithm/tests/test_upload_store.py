@@ -0,0 +1,133 @@
+"""
+上传存储：持有引用期间文件一定存在（lookup / put 与 release 并发时也成立）
+"""
+import hashlib
+import os
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from poster_store import PosterStore
+from upload_store import UploadStore
+
+PARAMS = UploadStore.params_key('PNG', (100, 100), 90)
+
+
+def _image():
+    output = BytesIO()
+    Image.new('RGB', (16, 16), (200, 40, 40)).save(output, format='PNG')
+    info = {'output': {'format': 'PNG', 'width': 16, 'height': 16}}
+    return hashlib.sha256(output.getvalue()).hexdigest(), output, info
+
+
+def _path(store, record):
+    return os.path.join(store.uploads_dir, f"{record['image_id']}.{record['ext']}")
+
+
+def test_put_after_release_recreates_file(tmp_path):
+    store = UploadStore(str(tmp_path), phash=False)
+    raw, output, info = _image()
+    record = store.put(raw, PARAMS, output, info)
+    assert store.release(record['image_id'], record['release_token']) == {'refcount': 0, 'deleted': True}
+    assert not os.path.exists(_path(store, record))
+    assert store.lookup(raw, PARAMS) is None
+
+    again = store.put(raw, PARAMS, output, info)
+    assert again['image_id'] == record['image_id'] and again['refcount'] == 1
+    assert os.path.isfile(_path(store, again))
+
+
+def test_put_restores_missing_file_of_existing_blob(tmp_path):
+    store = UploadStore(str(tmp_path), phash=False)
+    raw, output, info = _image()
+    record = store.put(raw, PARAMS, output, info)
+    os.remove(_path(store, record))
+
+    again = store.put(raw, PARAMS, output, info)
+    assert again is not None and again['refcount'] == 2
+    assert os.path.isfile(_path(store, again))
+
+
+def test_reference_holders_always_see_the_file(tmp_path):
+    store = UploadStore(str(tmp_path), phash=False)
+    raw, output, info = _image()
+    errors = []
+
+    def worker():
+        for _ in range(60):
+            record = store.lookup(raw, PARAMS) or store.put(raw, PARAMS, BytesIO(output.getvalue()), info)
+            if not os.path.isfile(_path(store, record)):
+                errors.append(record['image_id'])
+            store.release(record['image_id'], record['release_token'])
+
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert store.stats()['references'] == 0
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.png')]
+
+
+def test_release_requires_the_callers_token(tmp_path):
+    store = UploadStore(str(tmp_path), phash=False)
+    raw, output, info = _image()
+    first = store.put(raw, PARAMS, output, info)
+    second = store.lookup(raw, PARAMS)
+
+    assert store.release(first['image_id'], 'forged') is None
+    assert store.release(first['image_id'], first['release_token']) == {'refcount': 1, 'deleted': False}
+    # 同一个凭证不能重复释放
+    assert store.release(first['image_id'], first['release_token']) is None
+    assert os.path.isfile(_path(store, second))
+
+
+def test_referenced_image_survives_release(tmp_path):
+    store = UploadStore(str(tmp_path / 'uploads'), phash=False)
+    posters = PosterStore(str(tmp_path / 'posters'))
+    raw, output, info = _image()
+    record = store.put(raw, PARAMS, output, info)
+    posters.save('p1', {'size': {'width': 10, 'height': 10},
+                        'elements': [{'id': 'img', 'type': 'image', 'image_id': record['image_id']}]})
+
+    released = store.release(record['image_id'], record['release_token'],
+                             referenced=lambda image_id: bool(posters.referenced_images([image_id])))
+    assert released == {'refcount': 0, 'deleted': False}
+    assert os.path.isfile(_path(store, record))
+    assert store.get(record['image_id'])['refcount'] == 0
+    # 再次上传同样内容仍复用这份文件
+    again = store.lookup(raw, PARAMS)
+    assert again['image_id'] == record['image_id'] and again['refcount'] == 1
+
+
+def _age(store, record, seconds):
+    """把图片的创建时间与最近使用时间往前推"""
+    old = time.time() - seconds
+    store.index.connect().execute('UPDATE blobs SET created_at = ? WHERE image_id = ?', (old, record['image_id']))
+    os.utime(_path(store, record), (old, old))
+
+
+def test_evict_skips_image_reused_after_scan(tmp_path):
+    store = UploadStore(str(tmp_path), phash=False)
+    raw, output, info = _image()
+    record = store.put(raw, PARAMS, output, info)
+    _age(store, record, 100)
+    before = time.time() - 50
+    [expired] = store.expired(before)
+    assert expired['refcount'] == 1 and expired['used_at'] < before
+
+    # 扫描之后被重复上传复用：引用增加、文件被 touch
+    store.lookup(raw, PARAMS)
+    assert store.evict(record['image_id'], unused_since=before, refcount=expired['refcount']) == 0
+    # 只看引用计数也能发现复用（如 mtime 被外部改回）
+    _age(store, record, 100)
+    assert store.evict(record['image_id'], unused_since=before, refcount=expired['refcount']) == 0
+    assert os.path.isfile(_path(store, record))
+
+    [expired] = store.expired(before)
+    assert store.evict(record['image_id'], unused_since=before, refcount=expired['refcount']) > 0
+    assert not os.path.exists(_path(store, record))
@@ -0,0 +1,169 @@
+"""
+模板缩略图模块
+启动时及模板热加载后，在后台线程里用模板的 defaultContent 渲染每个模板，
+缩放到固定宽度并编码为 WebP / PNG 写入 THUMBNAILS_DIR。
+文件名带模板内容哈希，模板修改后自动生成新文件，多个 worker 共享同一份结果
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image
+
+from encoder import encode_image, resolve_encoder
+from render_cache import canonical_hash
+
+THUMBNAIL_FORMATS = {'webp': ('WEBP', 'image/webp'), 'png': ('PNG', 'image/png')}
+
+
+class ThumbnailService:
+    """模板缩略图：后台预渲染 + 磁盘缓存"""
+
+    def __init__(self, template_service, render_executor, thumbnails_dir: str,
+                 widths: Optional[Iterable[int]] = None):
+        """
+        Args:
+            template_service: 模板服务（提供编译后的模板与变更通知）
+            render_executor: 渲染执行器（整张模板在渲染进程池里渲染）
+            thumbnails_dir: 缩略图目录
+            widths: 预渲染宽度，默认 THUMBNAIL_WIDTHS 或 160,320,640
+        """
+        self.template_service = template_service
+        self.render_executor = render_executor
+        self.thumbnails_dir = thumbnails_dir
+        os.makedirs(thumbnails_dir, exist_ok=True)
+        raw_widths = widths or [int(w) for w in os.getenv('THUMBNAIL_WIDTHS', '160,320,640').split(',') if w.strip()]
+        self.widths: Tuple[int, ...] = tuple(sorted(set(int(w) for w in raw_widths if int(w) > 0)))
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._pending = set()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        self.rendered = 0
+        self.failures = 0
+
+    def start(self):
+        """注册模板变更回调：启动时全部模板、热加载后变化的模板进入后台渲染队列"""
+        if multiprocessing.parent_process() is not None:
+            # 渲染进程池子进程导入主模块时不做预渲染
+            return
+        self.template_service.store.add_listener(self.schedule)
+
+    def schedule(self, template_ids: List[str]):
+        """把模板加入后台渲染队列（已在队列中的跳过）"""
+        self._ensure_worker()
+        for tid in template_ids:
+            with self._lock:
+                if tid in self._pending:
+                    continue
+                self._pending.add(tid)
+            self._queue.put(tid)
+
+    def pick_width(self, width: Optional[int]) -> int:
+        """请求宽度向上取整到最近的预渲染宽度（超过最大值时取最大值）"""
+        if not width:
+            return self.widths[len(self.widths) // 2]
+        for w in self.widths:
+            if w >= width:
+                return w
+        return self.widths[-1]
+
+    def get(self, template_id: str, width: Optional[int] = None,
+            fmt: str = 'webp') -> Optional[Tuple[str, str, str]]:
+        """
+        获取缩略图；后台尚未渲染到时当场渲染
+
+        Returns:
+            (文件路径, mimetype, ETag)；模板不存在时返回 None
+        """
+        template = self.template_service.get_template(template_id)
+        if template is None:
+            return None
+        fmt = fmt if fmt in THUMBNAIL_FORMATS else 'webp'
+        width = self.pick_width(width)
+        version = canonical_hash(template)[:12]
+        path = self._path(template_id, version, width, fmt)
+        if not os.path.isfile(path):
+            self._render(template_id)
+        return path, THUMBNAIL_FORMATS[fmt][1], f"{template_id}-{version}-{width}-{fmt}"
+
+    def _path(self, template_id: str, version: str, width: int, fmt: str) -> str:
+        return os.path.join(self.thumbnails_dir, f"{template_id}-{version}-{width}.{fmt}")
+
+    def _render(self, template_id: str):
+        """渲染一个模板的所有宽度与格式（文件已存在的跳过）"""
+        template = self.template_service.get_template(template_id)
+        compiled = self.template_service.get_compiled(template_id)
+        if template is None or compiled is None:
+            return
+        version = canonical_hash(template)[:12]
+        targets = [(w, fmt) for w in self.widths for fmt in THUMBNAIL_FORMATS
+                   if not os.path.isfile(self._path(template_id, version, w, fmt))]
+        if not targets:
+            return
+        # 模板默认文案渲染整张图，再逐级缩小
+        full = Image.open(self.render_executor.render(compiled.apply_design({}), format='PNG'))
+        full.load()
+        for width, fmt in targets:
+            height = max(1, round(full.height * width / full.width))
+            img = full.resize((width, height), Image.Resampling.LANCZOS)
+            pil_format, params = resolve_encoder(fmt, 'web')
+            output, _ = encode_image(img, pil_format, params)
+            self._write(self._path(template_id, version, width, fmt), output.getvalue())
+        self._remove_stale(template_id, version)
+        with self._lock:
+            self.rendered += 1
+
+    def _write(self, path: str, data: bytes):
+        """原子写入（先写临时文件再替换），并发渲染同一模板也不会读到半个文件"""
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _remove_stale(self, template_id: str, version: str):
+        """删除同一模板旧版本的缩略图"""
+        prefix = f"{template_id}-"
+        try:
+            for entry in os.scandir(self.thumbnails_dir):
+                name = entry.name
+                if name.startswith(prefix) and not name.startswith(f"{prefix}{version}-") \
+                        and name[len(prefix):].count('-') == 1:
+                    os.remove(entry.path)
+        except OSError:
+            pass
+
+    def _ensure_worker(self):
+        """懒启动后台渲染线程；gunicorn fork 后按 pid 重新启动"""
+        pid = os.getpid()
+        with self._lock:
+            if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+                return
+            self._thread_pid = pid
+            self._thread = threading.Thread(target=self._work, name='thumbnail-renderer', daemon=True)
+            self._thread.start()
+
+    def _work(self):
+        while True:
+            tid = self._queue.get()
+            with self._lock:
+                self._pending.discard(tid)
+            try:
+                self._render(tid)
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                print(f"Failed to render thumbnails for {tid}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'widths': list(self.widths),
+                'formats': list(THUMBNAIL_FORMATS),
+                'pending': len(self._pending),
+                'rendered': self.rendered,
+                'failures': self.failures,
+            }
@@ -0,0 +1,375 @@
+"""
+上传图片内容寻址存储模块
+处理后的图片按内容 sha256 命名（image_id 取前 32 位），以实际格式的扩展名落盘（.png / .jpg），
+同样的输出只存一份并做引用计数；原始上传内容的 sha256 + 处理参数 → image_id 的映射
+让重复上传只需一次查表，不再解码 / 缩放 / 编码。
+每次上传（含重复上传）得到一个释放凭证（release_token），只有持有凭证才能释放对应的那一次引用。
+可选的感知哈希（dHash，64 位）索引按 8 段分桶，用于查找近似重复的图片。
+索引存放在 UPLOADS_DIR 下的 SQLite 数据库中，多个 gunicorn worker 共享
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+from io import BytesIO
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from path_utils import touch
+from sqlite_index import SQLiteIndex
+
+# 输出格式 → (扩展名, mimetype)
+UPLOAD_FORMATS = {
+    'PNG': ('png', 'image/png'),
+    'JPEG': ('jpg', 'image/jpeg'),
+}
+
+# 按扩展名查找上传文件（旧版本上传的文件一律是 .jpg）
+UPLOAD_EXTENSIONS = {ext: mimetype for ext, mimetype in UPLOAD_FORMATS.values()}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    image_id TEXT PRIMARY KEY,
+    ext TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    dhash INTEGER,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (
+    raw_sha256 TEXT NOT NULL,
+    params TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    PRIMARY KEY (raw_sha256, params)
+);
+CREATE INDEX IF NOT EXISTS sources_image ON sources (image_id);
+CREATE TABLE IF NOT EXISTS dhash_bands (
+    band INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    image_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dhash_bands_lookup ON dhash_bands (band, value);
+CREATE INDEX IF NOT EXISTS dhash_bands_image ON dhash_bands (image_id);
+CREATE TABLE IF NOT EXISTS holds (
+    token TEXT PRIMARY KEY,
+    image_id TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS holds_image ON holds (image_id);
+"""
+
+# dHash 分成 8 段、每段 8 位：汉明距离小于 8 的两张图至少有一段完全相同
+_DHASH_BANDS = 8
+
+
+def upload_path(uploads_dir: str, image_id: str) -> Optional[Tuple[str, str]]:
+    """
+    按扩展名查找上传文件（不查索引，渲染子进程也可直接使用）
+
+    Returns:
+        (路径, mimetype)；不存在时返回 None。image_id 需已经过 safe_id 校验
+    """
+    for ext, mimetype in UPLOAD_EXTENSIONS.items():
+        path = os.path.join(uploads_dir, f"{image_id}.{ext}")
+        if os.path.isfile(path):
+            return path, mimetype
+    return None
+
+
+def dhash(img: Image.Image) -> int:
+    """64 位差值哈希：缩到 9x8 灰度，比较相邻像素"""
+    small = img.convert('L').resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def _hold(conn, image_id: str) -> str:
+    """登记一次引用，返回释放凭证"""
+    token = uuid.uuid4().hex
+    conn.execute('INSERT INTO holds (token, image_id, created_at) VALUES (?, ?, ?)', (token, image_id, time.time()))
+    return token
+
+
+def _to_signed(value: int) -> int:
+    """SQLite INTEGER 为有符号 64 位"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+class UploadStore:
+    """内容寻址的上传图片存储 + 原始内容 / 感知哈希索引"""
+
+    def __init__(self, uploads_dir: str, index_path: Optional[str] = None,
+                 phash: Optional[bool] = None, phash_distance: Optional[int] = None):
+        """
+        Args:
+            uploads_dir: 上传目录
+            index_path: SQLite 索引路径，默认 UPLOAD_INDEX_PATH 或 <uploads_dir>/uploads.sqlite3
+            phash: 是否建立感知哈希索引，默认 UPLOAD_PHASH 或开启
+            phash_distance: 视为近似重复的最大汉明距离，默认 UPLOAD_PHASH_DISTANCE 或 6（上限 7）
+        """
+        self.uploads_dir = uploads_dir
+        os.makedirs(uploads_dir, exist_ok=True)
+        self.index_path = index_path or os.getenv(
+            'UPLOAD_INDEX_PATH', os.path.join(uploads_dir, 'uploads.sqlite3'))
+        self.phash = phash if phash is not None else os.getenv('UPLOAD_PHASH', '1').lower() not in (
+            '0', 'false', 'no')
+        distance = phash_distance if phash_distance is not None else int(os.getenv('UPLOAD_PHASH_DISTANCE', '6'))
+        self.phash_distance = max(0, min(_DHASH_BANDS - 1, distance))
+        self.index = SQLiteIndex(self.index_path, _SCHEMA)
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.stored = 0
+        self.shared = 0
+        self.near_duplicates = 0
+
+    @staticmethod
+    def params_key(output_format: str, max_size: Tuple[int, int], quality: int) -> str:
+        """处理参数（决定输出内容），与原始内容哈希一起作为查表键"""
+        return f"{output_format}:{max_size[0]}x{max_size[1]}:q{quality}"
+
+    def lookup(self, raw_sha256: str, params: str) -> Optional[Dict[str, Any]]:
+        """
+        按原始内容哈希查找已处理过的图片；命中时增加一次引用
+
+        Returns:
+            图片记录（见 get），另含 release_token；未命中或文件已丢失时返回 None
+        """
+        # 查表、文件存在性检查与引用计数在同一个写事务内，不会与 release / evict 交错
+        with self.index.transaction() as conn:
+            row = conn.execute(
+                'SELECT image_id FROM sources WHERE raw_sha256 = ? AND params = ?', (raw_sha256, params)
+            ).fetchone()
+            if row is None:
+                return None
+            record = self.get(row['image_id'])
+            if record is None:
+                # 文件被外部删除：丢弃失效映射，按未命中处理
+                conn.execute('DELETE FROM sources WHERE raw_sha256 = ? AND params = ?', (raw_sha256, params))
+                return None
+            conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE image_id = ?', (record['image_id'],))
+            record['release_token'] = _hold(conn, record['image_id'])
+            # 重复上传算一次使用，推迟未被海报引用时的过期清理（在事务内更新，evict 据此判断是否被复用）
+            touch(os.path.join(self.uploads_dir, f"{record['image_id']}.{record['ext']}"))
+        with self._lock:
+            self.exact_hits += 1
+        record['refcount'] += 1
+        return record
+
+    def put(self, raw_sha256: str, params: str, output: BytesIO, info: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        保存处理后的图片（内容相同则复用已有文件）并增加一次引用
+
+        Args:
+            raw_sha256: 原始上传内容的 sha256
+            params: params_key 的结果
+            output: 处理后的图片
+            info: ImageService 的处理信息（取 output.format / width / height）
+
+        Returns:
+            图片记录（见 get），另含 release_token 与 similar：近似重复的 [{image_id, distance}]
+            （未开启感知哈希时为空）
+        """
+        data = output.getvalue()
+        image_id = hashlib.sha256(data).hexdigest()[:32]
+        out = info['output']
+        ext, _ = UPLOAD_FORMATS[out['format']]
+        path = os.path.join(self.uploads_dir, f"{image_id}.{ext}")
+        value = None
+        if self.phash:
+            with Image.open(BytesIO(data)) as img:
+                value = dhash(img)
+
+        with self.index.transaction() as conn:
+            created = conn.execute(
+                'INSERT OR IGNORE INTO blobs (image_id, ext, bytes, width, height, dhash, refcount, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, 0, ?)',
+                (image_id, ext, len(data), out['width'], out['height'],
+                 _to_signed(value) if value is not None else None, time.time())
+            ).rowcount == 1
+            # 文件在事务内落盘：release / evict 在同一把写锁内删除文件，新建的记录一定有文件
+            if created or not os.path.isfile(path):
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE image_id = ?', (image_id,))
+            token = _hold(conn, image_id)
+            conn.execute('INSERT OR REPLACE INTO sources (raw_sha256, params, image_id) VALUES (?, ?, ?)',
+                         (raw_sha256, params, image_id))
+            if created and value is not None:
+                conn.executemany(
+                    'INSERT INTO dhash_bands (band, value, image_id) VALUES (?, ?, ?)',
+                    [(band, (value >> (band * 8)) & 0xFF, image_id) for band in range(_DHASH_BANDS)]
+                )
+        with self._lock:
+            if created:
+                self.stored += 1
+            else:
+                self.shared += 1
+        record = self.get(image_id)
+        record['release_token'] = token
+        record['similar'] = self.similar(image_id) if value is not None and created else []
+        if record['similar']:
+            with self._lock:
+                self.near_duplicates += 1
+        return record
+
+    def get(self, image_id: str) -> Optional[Dict[str, Any]]:
+        """图片记录 {image_id, ext, mimetype, bytes, width, height, refcount}；文件不存在时返回 None"""
+        row = self.index.connect().execute(
+            'SELECT image_id, ext, bytes, width, height, refcount FROM blobs WHERE image_id = ?', (image_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        if not os.path.isfile(os.path.join(self.uploads_dir, f"{image_id}.{record['ext']}")):
+            return None
+        record['mimetype'] = UPLOAD_EXTENSIONS[record['ext']]
+        return record
+
+    def similar(self, image_id: str, max_distance: Optional[int] = None) -> List[Dict[str, Any]]:
+        """感知哈希近似的其他图片（按汉明距离升序）"""
+        max_distance = self.phash_distance if max_distance is None else min(max_distance, _DHASH_BANDS - 1)
+        conn = self.index.connect()
+        row = conn.execute('SELECT dhash FROM blobs WHERE image_id = ?', (image_id,)).fetchone()
+        if row is None or row['dhash'] is None:
+            return []
+        value = row['dhash'] & ((1 << 64) - 1)
+        clauses = ' OR '.join('(band = ? AND value = ?)' for _ in range(_DHASH_BANDS))
+        args: List[int] = []
+        for band in range(_DHASH_BANDS):
+            args.extend((band, (value >> (band * 8)) & 0xFF))
+        candidates = conn.execute(
+            f'SELECT DISTINCT b.image_id, b.dhash FROM dhash_bands d JOIN blobs b ON b.image_id = d.image_id '
+            f'WHERE ({clauses}) AND d.image_id != ?', (*args, image_id)
+        ).fetchall()
+        matches = []
+        for candidate in candidates:
+            distance = bin((candidate['dhash'] & ((1 << 64) - 1)) ^ value).count('1')
+            if distance <= max_distance:
+                matches.append({'image_id': candidate['image_id'], 'distance': distance})
+        matches.sort(key=lambda m: m['distance'])
+        return matches
+
+    def release(self, image_id: str, token: str,
+                referenced: Optional[Callable[[str], bool]] = None) -> Optional[Dict[str, Any]]:
+        """
+        凭上传时拿到的释放凭证释放那一次引用；引用归零且没有海报使用时删除文件与索引
+
+        Args:
+            token: lookup / put 返回的 release_token（每个凭证只能用一次）
+            referenced: referenced(image_id) 为 True 表示仍有已保存的海报使用该图片，
+                        此时引用归零也保留文件，由存储生命周期在不再被使用后清理
+
+        Returns:
+            {refcount: 剩余引用数, deleted: 是否已删除}；图片不在索引中或凭证无效时返回 None
+        """
+        with self.index.transaction() as conn:
+            row = conn.execute('SELECT ext, refcount FROM blobs WHERE image_id = ?', (image_id,)).fetchone()
+            if row is None:
+                return None
+            if conn.execute('DELETE FROM holds WHERE token = ? AND image_id = ?',
+                            (token, image_id)).rowcount != 1:
+                return None
+            remaining = max(0, row['refcount'] - 1)
+            conn.execute('UPDATE blobs SET refcount = ? WHERE image_id = ?', (remaining, image_id))
+            deleted = not remaining and not (referenced is not None and referenced(image_id))
+            if deleted:
+                for table in ('blobs', 'sources', 'dhash_bands', 'holds'):
+                    conn.execute(f'DELETE FROM {table} WHERE image_id = ?', (image_id,))
+                self._remove_file(image_id, row['ext'])
+        return {'refcount': remaining, 'deleted': deleted}
+
+    def expired(self, before: float, limit: int = 100,
+                after: Optional[Tuple[float, str]] = None) -> List[Dict[str, Any]]:
+        """
+        创建时间早于 before 的图片，按 (created_at, image_id) 升序分页
+
+        Args:
+            after: 上一页最后一条的 (created_at, image_id)
+
+        Returns:
+            [{image_id, ext, bytes, refcount, created_at, used_at}]，used_at 为文件 mtime（最近一次使用）
+        """
+        query = 'SELECT image_id, ext, bytes, refcount, created_at FROM blobs WHERE created_at < ?'
+        args: List[Any] = [before]
+        if after is not None:
+            query += ' AND (created_at, image_id) > (?, ?)'
+            args.extend(after)
+        query += ' ORDER BY created_at, image_id LIMIT ?'
+        args.append(limit)
+        records = []
+        for row in self.index.connect().execute(query, args).fetchall():
+            record = dict(row)
+            try:
+                record['used_at'] = os.path.getmtime(
+                    os.path.join(self.uploads_dir, f"{record['image_id']}.{record['ext']}"))
+            except OSError:
+                record['used_at'] = record['created_at']
+            records.append(record)
+        return records
+
+    def evict(self, image_id: str, unused_since: Optional[float] = None, refcount: Optional[int] = None) -> int:
+        """
+        不论引用计数直接删除图片文件与索引（由存储生命周期对已无海报使用的过期图片调用）
+
+        Args:
+            unused_since: 文件 mtime（最近一次使用）不早于该时间时视为已被复用，不删除
+            refcount: expired() 时看到的引用计数；此后引用增加（被重复上传复用）则不删除
+
+        Returns:
+            释放的字节数；不在索引中或已被复用时返回 0
+        """
+        with self.index.transaction() as conn:
+            row = conn.execute('SELECT ext, bytes, refcount FROM blobs WHERE image_id = ?',
+                               (image_id,)).fetchone()
+            if row is None:
+                return 0
+            # 与 lookup 在同一把写锁下复查：lookup 增加引用并 touch 文件后提交
+            if refcount is not None and row['refcount'] > refcount:
+                return 0
+            if unused_since is not None:
+                try:
+                    used_at = os.path.getmtime(os.path.join(self.uploads_dir, f"{image_id}.{row['ext']}"))
+                except OSError:
+                    used_at = None
+                if used_at is not None and used_at >= unused_since:
+                    return 0
+            for table in ('blobs', 'sources', 'dhash_bands', 'holds'):
+                conn.execute(f'DELETE FROM {table} WHERE image_id = ?', (image_id,))
+            self._remove_file(image_id, row['ext'])
+        return row['bytes']
+
+    def _remove_file(self, image_id: str, ext: str):
+        """在写事务内删除文件，避免与 put 重新写入同一文件交错"""
+        try:
+            os.remove(os.path.join(self.uploads_dir, f"{image_id}.{ext}"))
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        row = self.index.connect().execute(
+            'SELECT COUNT(*) AS images, COALESCE(SUM(bytes), 0) AS bytes, '
+            'COALESCE(SUM(refcount), 0) AS refs FROM blobs'
+        ).fetchone()
+        with self._lock:
+            return {
+                'images': row['images'],
+                'bytes': row['bytes'],
+                'references': row['refs'],
+                'stored': self.stored,
+                'shared': self.shared,
+                'exact_hits': self.exact_hits,
+                'near_duplicates': self.near_duplicates,
+                'phash': self.phash,
+            }